@@ -2,11 +2,11 @@
 
 '''
 
+import sys
 import json
 import logging
 import traceback
 import asyncio
-from pathlib import Path
 from typing import TYPE_CHECKING, Optional, List, Dict, Union
 
 import psutil
@@ -18,6 +18,9 @@ from discord.ext import commands
 import db
 import embeds
 import miscUtils
+from utils.contentCompression import content_compressor
+from utils.tracing import tracer
+from utils.logSetup import setup_logging
 
 
 from bot import GGBot
@@ -25,6 +28,7 @@ from bot import GGBot
 if TYPE_CHECKING:
     from events.memberJoinLeave import MemberJoinLeave
 
+# Replaced by setup_logging once the config is loaded.
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s")
 
 client = GGBot(command_prefix="g!",
@@ -128,31 +132,17 @@ async def on_message(message: discord.Message):
 
         message_contents = message.content if message.content != '' else None
 
-        # TODO: Use Path Objects instead of strings for paths.
-        attachments = None
-        if len(message.attachments) > 0 and message.guild.id in config['restricted_features']:
-            attachments = []
-            for attachment in message.attachments:
-                # logging.info("ID: {}, Filename: {}, Height: {}, width: {}, Size: {}, Proxy URL: {}, URL: {}"
-                #              .format(attachment.id, attachment.filename, attachment.height, attachment.width, attachment.size, attachment.proxy_url, attachment.url))
-
-                attachment_filename = "{}_{}".format(attachment.id, attachment.filename)
-                logging.info("Saving Attachment from {}".format(message.guild.id))
-                try:
-                    await attachment.save("./image_cache/{}/{}".format(message.guild.id, attachment_filename))
-                    attachments.append(attachment_filename)
-                except FileNotFoundError as e:
-                    # If the directory(s) do not exist, create them and then re-save
-                    Path("./image_cache/{}".format(message.guild.id)).mkdir(parents=True, exist_ok=True)
-                    await attachment.save("./image_cache/{}/{}".format(message.guild.id, attachment_filename))
-                    attachments.append(attachment_filename)
-                except Exception as e:
-                    await miscUtils.log_error_msg(client, e)
-
-        if message_contents is not None or attachments is not None:
+        # Attachments are downloaded in the background and added to the cached message once they have been saved.
+        download_attachments = len(message.attachments) > 0 and message.guild.id in config['restricted_features']
+
+        # Only cache messages that would actually be logged if they get deleted or edited.
+        if (message_contents is not None or download_attachments) and await client.cache_policy.should_cache(message):
             webhook_author_name = message.author.display_name if message.webhook_id is not None else None
             await db.cache_message(client.db_pool, message.guild.id, message.id, message.author.id, message_content=message_contents,
-                                   attachments=attachments, webhook_author_name=webhook_author_name)
+                                   webhook_author_name=webhook_author_name)
+
+            if download_attachments:
+                client.attachment_downloader.enqueue(message)
 
     await client.process_commands(message)
 
@@ -161,10 +151,6 @@ async def on_message(message: discord.Message):
 async def on_error(event_name, *args):
     logging.exception("Exception from event {}".format(event_name))
 
-    if 'error_log_channel' not in config:
-        return
-    error_log_channel = client.get_channel(config['error_log_channel'])
-
     embed = None
     # Determine if we can get more info, otherwise post without embed
     if args and type(args[0]) == discord.Message:
@@ -176,9 +162,10 @@ async def on_error(event_name, *args):
             logging.error("Before Content:{}.".format(args[0].cached_message.content))
     # Todo: Add more
 
-    traceback_message = "```python\n{}```".format(traceback.format_exc())
-    traceback_message = (traceback_message[:1993] + ' ...```') if len(traceback_message) > 2000 else traceback_message
-    await error_log_channel.send(content=traceback_message, embed=embed)
+    # Goes through the error reporter so an error that hits every event doesn't flood the error log channel.
+    traceback_message = traceback.format_exc()
+    traceback_message = ('... ' + traceback_message[-1980:]) if len(traceback_message) > 1980 else traceback_message
+    await client.error_reporter.report_exception(sys.exc_info()[1], traceback_message, header=f"Exception from event {event_name}")
 
 
 @client.event
@@ -205,6 +192,7 @@ async def on_guild_remove(guild: discord.Guild):
     # Todo: Find a less fragile way to do this, or a back up. Maybe a DB clean up that runs every day/week?
     log_msg = "Gabby Gums has left {} ({}). Removing guild from database!".format(guild.name, guild.id)
     logging.warning(log_msg)
+    client.cache_policy.forget(guild.id)
 
     if 'error_log_channel' not in config:
         await db.remove_server(client.db_pool, guild.id)
@@ -219,11 +207,8 @@ async def on_guild_unavailable(guild: discord.Guild):
     log_msg = "{} ({}) is unavailable.".format(guild.name, guild.id)
     logging.warning(log_msg)
 
-    if 'error_log_channel' not in config:
-        return
-
-    error_log_channel = client.get_channel(config['error_log_channel'])
-    await error_log_channel.send(log_msg)
+    # Every guild goes unavailable at once during a Discord outage, so these are summarized.
+    await client.error_reporter.report_text(log_msg, fingerprint="guild_unavailable")
 
 
 if __name__ == '__main__':
@@ -231,15 +216,27 @@ if __name__ == '__main__':
     with open('config.json') as json_data_file:
         config = json.load(json_data_file)
 
-    db_pool: asyncpg.pool.Pool = asyncio.get_event_loop().run_until_complete(db.create_db_pool(config['db_uri']))
-    asyncio.get_event_loop().run_until_complete(db.create_tables(db_pool))
+    log_listener = setup_logging(config)
+
+    db_pool: asyncpg.pool.Pool = asyncio.get_event_loop().run_until_complete(db.create_db_pool(config['db_uri'], config.get('db_statement_cache_size', 100)))
+    content_compressor.configure(config.get('compress_message_cache', False), config.get('message_cache_dictionaries'))
+    tracer.configure(config.get('slow_trace_ms', tracer.slow_threshold))
+    client.event_scheduler.configure(config.get('max_concurrent_events', client.event_scheduler.max_concurrent),
+                                     config.get('max_events_in_flight_per_guild', client.event_scheduler.max_in_flight_per_guild),
+                                     config.get('max_events_queued_per_guild', client.event_scheduler.max_queued_per_guild))
+    unlogged_message_cache = config.get('message_cache_storage', "logged") == "unlogged"
+    asyncio.get_event_loop().run_until_complete(db.create_tables(db_pool, unlogged_message_cache))
 
     client.config = config
     client.db_pool = db_pool
     client.command_prefix = config['bot_prefix']
     client.hmac_key = bytes(config['hmac_key'], encoding='utf-8')
 
+    if config.get('metrics_port') is not None:
+        asyncio.get_event_loop().run_until_complete(client.metrics_server.start(config.get('metrics_host', "127.0.0.1"), config['metrics_port']))
+
     client.load_cogs()
     client.run(config['token'])
 
     logging.info("cleaning Up and shutting down")
+    log_listener.stop()  # Flush anything still queued.
@@ -2,17 +2,26 @@
 
 """
 import sys
+import time
 import logging
 import traceback
 from collections import defaultdict
-from typing import Optional, Dict, Tuple, List, Union
+from typing import Optional, Dict, Tuple, List, Union, Set
 
 import discord
 from discord.ext import commands, tasks
 import asyncpg
 
 import db
-from utils.errors import handle_permissions_error
+from utils.imageCache import AttachmentDownloader, ImageCacheEvictor, disk_usage
+from utils.cachePolicy import MessageCachePolicy
+from utils.logQueue import OutboundLogQueue
+from utils.logOutbox import LogOutbox
+from utils.logPermissions import LogPermissions
+from utils.eventScheduler import EventScheduler, LANE_WEIGHTS
+from utils.errorReporter import ErrorReporter
+from utils.metrics import metrics, MetricsServer, RateLimitCounter, executor_queue_depth
+from utils import tracing
 from miscUtils import log_error_msg
 
 log = logging.getLogger(__name__)
@@ -47,11 +56,95 @@ class GGBot(commands.Bot):
         self.config: Optional[Dict] = None
         self.hmac_key: Optional[bytes] = None
         # self.alerted_guilds: List[Tuple[str, int]] = []  # Stores a list of guilds that have been alerted to permission problems.
-        self.has_permission_problems: List[int] = []
+        self.has_permission_problems: Set[int] = set()  # Guilds that have had logs lost to missing permissions.
         self.invites_initialized = False
         self.has_pk_cache = defaultdict(list)
+        self.attachment_downloader = AttachmentDownloader(self)
+        self.image_cache_evictor = ImageCacheEvictor(self)
+        self.cache_policy = MessageCachePolicy(self)
+        self.metrics_server = MetricsServer()
+        self.log_queue = OutboundLogQueue(self)
+        self.log_outbox = LogOutbox(self)
+        self.log_permissions = LogPermissions(self)
+        self.event_scheduler = EventScheduler(self)
+        self.error_reporter = ErrorReporter(self)
+        self.register_metrics()
 
         self.update_playing.start()
+        self.attachment_downloader.start()
+        self.image_cache_evictor.start()
+        self.log_outbox.start()
+        self.log_permissions.start()
+        self.error_reporter.start()
+
+
+    def register_metrics(self):
+        logging.getLogger('discord.http').addHandler(RateLimitCounter())
+        metrics.describe("discord_rate_limited_total", "429 responses from Discord, which discord.py waits out and retries.")
+        metrics.describe("event_handler_latency_ms", "Time taken by each event handler.")
+        metrics.describe("event_stage_latency_ms", "Time taken by each traced stage (cache fetch, PK lookup, routing, build, send) of an event.")
+        metrics.describe("logs_sent_total", "Logs sent by event type.")
+        metrics.describe("log_messages_sent_total", "Discord messages used to send logs. Batched messages carry up to 10 logs.")
+        metrics.describe("send_log_latency_ms", "Time taken to send a log message, including any rate limit waits.")
+        metrics.describe("send_log_forbidden_total", "Log messages that Discord rejected due to missing permissions.")
+        metrics.describe("logs_lost_total", "Logs that were not sent because of missing permissions, by event type and reason.")
+        metrics.describe("events_shed_total", "Event handlers dropped because too many were waiting for their guild. Their logs are lost.")
+        metrics.describe("log_records_dropped_total", "Log records that were not written because of a rate limit or a full logging queue.")
+        metrics.describe("errors_reported_total", "Errors reported to the global error log channel, by whether they were posted right away or summarized.")
+        metrics.describe("pk_api_requests_total", "PluralKit API requests by endpoint and result.")
+        metrics.describe("pk_api_latency_ms", "PluralKit API request latency by endpoint.")
+        metrics.describe("pk_presence_lookups_total", "Checks for PluralKit being in a guild, by where the answer came from.")
+        metrics.add_latency_source("db_query_latency_ms", "query", db.db_perf.queries, "Time taken by each db function.")
+
+        metrics.add_gauge("db_query_errors_total", lambda: {(('query', key),): histogram.since_start.errors for key, histogram in db.db_perf.queries.items()},
+                          "Database errors by db function.", "counter")
+        metrics.add_gauge("guilds", lambda: len(self.guilds), "Guilds the bot is in.")
+        metrics.add_gauge("discord_message_cache_size", lambda: len(self.cached_messages), "Messages in discord.py's in memory message cache.")
+        metrics.add_gauge("message_cache_rows", lambda: db.message_cache_counter.count, "Messages in the message cache table.")
+        metrics.add_gauge("message_cache_inserted_total", lambda: db.message_cache_counter.inserted, "Messages added to the message cache.", "counter")
+        metrics.add_gauge("message_cache_deleted_total", lambda: db.message_cache_counter.deleted, "Messages removed from the message cache.", "counter")
+        metrics.add_gauge("message_cache_skipped_total", lambda: self.cache_policy.skipped, "Messages not cached because nothing would log them.", "counter")
+        metrics.add_gauge("cache_policy_guilds", lambda: len(self.cache_policy.policies), "Guilds with an in memory message cache policy.")
+        metrics.add_gauge("image_cache_files", lambda: disk_usage.files, "Files in the image cache.")
+        metrics.add_gauge("image_cache_bytes", lambda: disk_usage.bytes, "Bytes used by the image cache.")
+        metrics.add_gauge("image_cache_evicted_total", lambda: self.image_cache_evictor.evicted, "Attachment blobs evicted from the image cache.", "counter")
+        metrics.add_gauge("download_queue_depth", lambda: self.attachment_downloader.queued, "Attachments waiting to be downloaded.")
+        metrics.add_gauge("downloads_in_progress", lambda: self.attachment_downloader.in_progress, "Attachments being downloaded.")
+        metrics.add_gauge("downloads_total", lambda: {(('result', 'completed'),): self.attachment_downloader.completed,
+                                                      (('result', 'failed'),): self.attachment_downloader.failed,
+                                                      (('result', 'dropped'),): self.attachment_downloader.dropped},
+                          "Attachment downloads by result.", "counter")
+        metrics.add_gauge("log_queue_depth", lambda: sum(len(channel_queue.logs) for channel_queue in self.log_queue.channels.values()),
+                          "Logs waiting to be sent.")
+        metrics.add_gauge("log_outbox_total", lambda: {(('result', 'delivered'),): self.log_outbox.delivered,
+                                                       (('result', 'retried'),): self.log_outbox.retried,
+                                                       (('result', 'dropped'),): self.log_outbox.dropped},
+                          "Logs that went through the outbox by result.", "counter")
+        metrics.describe("log_outbox_resent_total", "Logs picked up by the outbox's background sender.")
+        metrics.describe("event_queue_time_ms", "Time event handlers spent waiting in the event scheduler, by event and priority.")
+        metrics.add_gauge("event_scheduler_queued", lambda: {(('priority', priority),): self.event_scheduler.queued[priority] for priority in LANE_WEIGHTS},
+                          "Event handlers waiting to run, by priority.")
+        metrics.add_gauge("event_scheduler_running", lambda: self.event_scheduler.running, "Event handlers started by the event scheduler that are still running.")
+        metrics.add_gauge("executor_queue_depth", lambda: executor_queue_depth(self.loop), "Jobs waiting for a thread in the default executor.")
+
+
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        # Log handlers are queued so a single busy guild can't hold up everyone else.
+        if self.event_scheduler.should_schedule(coro, event_name):
+            return self.event_scheduler.submit(coro, event_name, *args, **kwargs)
+        return super()._schedule_event(coro, event_name, *args, **kwargs)
+
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # Every handler runs in it's own trace so the stages it goes through can be timed.
+        with tracing.trace(event_name, handler=getattr(coro, '__qualname__', event_name)) as trace:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        metrics.observe("event_handler_latency_ms", trace.duration, event=event_name)
+
+
+    async def close(self):
+        await self.log_queue.webhooks.close()
+        await super().close()
 
 
     def load_cogs(self):
@@ -64,13 +157,36 @@ class GGBot(commands.Bot):
                 traceback.print_exc()
 
 
-    async def send_log(self, log_ch: discord.TextChannel, event_type: str, embed: Optional[discord.Embed] = None, file: Optional[discord.File] = None) -> discord.Message:
+    async def send_log(self, log_ch: discord.TextChannel, event_type: str, embed: Optional[discord.Embed] = None, file: Optional[discord.File] = None,
+                       outbox_id: Optional[int] = None) -> Optional[discord.Message]:
+        """
+        Sends a log. Logs without a file go through the outbox so they are retried if Discord is having problems.
+        outbox_id is for logs the caller already added to the outbox. Returns None if the log will be delivered later.
+        """
+        if not self.log_permissions.can_send(log_ch, embed is not None, file is not None):
+            # Discord would only reject it, and rejected requests count towards the invalid request limit.
+            if outbox_id is not None:
+                await db.remove_outbox_log(self.db_pool, outbox_id)  # Don't let the outbox retry it either.
+            await self.log_permissions.log_lost(log_ch, event_type, "missing_permissions")
+            return None
+
         log.info(f"sending {event_type} to {log_ch.name}")
+        start = time.perf_counter()
         try:
-            msg = await log_ch.send(embed=embed, file=file)
+            with tracing.stage("send"):
+                if file is None and embed is not None:
+                    msg = await self.log_outbox.send(log_ch, event_type, embed, outbox_id)
+                else:
+                    # Queued so logs to the same channel can share a message when they pile up.
+                    msg = await self.log_queue.send(log_ch, event_type, embed=embed, file=file)
+            metrics.inc("logs_sent_total", event_type=event_type)
             return msg
         except discord.Forbidden as e:
-            await handle_permissions_error(self, log_ch, event_type, e, None)
+            metrics.inc("send_log_forbidden_total", event_type=event_type)
+            self.log_permissions.invalidate(log_ch.guild.id)  # Our cached permissions were out of date.
+            await self.log_permissions.log_lost(log_ch, event_type, "forbidden", e)
+        finally:
+            metrics.observe("send_log_latency_ms", (time.perf_counter() - start) * 1000, event_type=event_type)
             # await alert_guild_permissions_error(self, log_ch, event_type, e, None)
 
 
@@ -95,42 +211,53 @@ class GGBot(commands.Bot):
 
     # region Get Logging Channel Methods
 
-    async def get_event_or_guild_logging_channel(self, guild_id: int, event_type: Optional[str] = None, user_id: Optional[int] = None, channel_id: Optional[int] = None) -> Optional[discord.TextChannel]:
+    async def get_event_or_guild_logging_channel(self, guild_id: int, event_type: Optional[str] = None, user_id: Optional[int] = None, channel_id: Optional[int] = None,
+                                                 pool: Optional[db.PoolOrConnection] = None) -> Optional[discord.TextChannel]:
+        with tracing.stage("routing"):
+            return await self.resolve_logging_channel(guild_id, event_type, user_id, channel_id, pool or self.db_pool)
+
+
+    async def resolve_logging_channel(self, guild_id: int, event_type: Optional[str], user_id: Optional[int], channel_id: Optional[int],
+                                      pool: db.PoolOrConnection) -> Optional[discord.TextChannel]:
+        uow = pool if isinstance(pool, db.UnitOfWork) else None
 
         # Check if there are any user overrides.
         if user_id is not None:
-            has_override, override_ch_id = await self.check_user_overrides(guild_id, user_id)
+            has_override, override_ch_id = await self.check_user_overrides(guild_id, user_id, pool)
             if has_override:
-                return await self.get_channel_safe(override_ch_id) if override_ch_id is not None else None
+                return await self.get_channel_safe(override_ch_id, uow) if override_ch_id is not None else None
 
         # Then check channel overrides.
         if channel_id is not None:
-            has_override, override_ch_id = await self.check_channel_overrides(guild_id, channel_id)
+            has_override, override_ch_id = await self.check_channel_overrides(guild_id, channel_id, pool)
             if has_override:
-                return await self.get_channel_safe(override_ch_id) if override_ch_id is not None else None
+                return await self.get_channel_safe(override_ch_id, uow) if override_ch_id is not None else None
 
         if event_type is not None:
-            log_configs = await db.get_server_log_configs(self.db_pool, guild_id)
+            log_configs = await db.get_server_log_configs(pool, guild_id)
             event_configs = log_configs[event_type]
             if event_configs is not None:
                 if event_configs.enabled is False:
                     return None  # Logs for this type are disabled. Exit now.
                 if event_configs.log_channel_id is not None:
-                    return await self.get_channel_safe(event_configs.log_channel_id)  # return event specific log channel
+                    return await self.get_channel_safe(event_configs.log_channel_id, uow)  # return event specific log channel
 
         # No valid event specific configs exist. Attempt to use default log channel.
-        _log_channel_id = await db.get_log_channel(self.db_pool, guild_id)
+        _log_channel_id = await db.get_log_channel(pool, guild_id)
         if _log_channel_id is not None:
-            return await self.get_channel_safe(_log_channel_id)
+            return await self.get_channel_safe(_log_channel_id, uow)
 
         # No valid event configs or global configs found. Only option is to silently fail
         return None
 
 
-    async def get_channel_safe(self, channel_id: int) -> Optional[discord.TextChannel]:
+    async def get_channel_safe(self, channel_id: int, uow: Optional[db.UnitOfWork] = None) -> Optional[discord.TextChannel]:
+        """Gets a channel from the cache, or from the API if it isn't cached. Any unit of work passed in is released before the API is called."""
         channel = self.get_channel(channel_id)
         if channel is None:
             log.info("bot.get_channel failed. Querying API...")
+            if uow is not None:
+                await uow.release()  # Don't hold on to a connection while waiting on Discord.
             try:
                 channel = await self.fetch_channel(channel_id)
             except discord.NotFound:
@@ -148,7 +275,7 @@ class GGBot(commands.Bot):
     #     return False
 
 
-    async def check_channel_overrides(self, guild_id: int, channel_id: int) -> Tuple[bool, Optional[int]]:
+    async def check_channel_overrides(self, guild_id: int, channel_id: int, pool: Optional[db.PoolOrConnection] = None) -> Tuple[bool, Optional[int]]:
         """
         Check to see if the channel is configures to be ignored or redirected
 
@@ -158,14 +285,14 @@ class GGBot(commands.Bot):
         """
         guild_id = int(guild_id)
         channel_id = int(channel_id)
-        channel_overrides = await db.get_channel_overrides(self.db_pool, guild_id)
+        channel_overrides = await db.get_channel_overrides(pool or self.db_pool, guild_id)
         for channel in channel_overrides:
             if channel['channel_id'] == channel_id:
                 return True, channel['log_ch']
         return False, None
 
 
-    async def check_user_overrides(self, guild_id: int, user_id: int) -> Tuple[bool, Optional[int]]:
+    async def check_user_overrides(self, guild_id: int, user_id: int, pool: Optional[db.PoolOrConnection] = None) -> Tuple[bool, Optional[int]]:
         """
         Check to see if the user is configures to be ignored or redirected
 
@@ -175,16 +302,16 @@ class GGBot(commands.Bot):
         """
         guild_id = int(guild_id)
         user_id = int(user_id)
-        user_overrides = await db.get_users_overrides(self.db_pool, guild_id)
+        user_overrides = await db.get_users_overrides(pool or self.db_pool, guild_id)
         for user in user_overrides:
             if user['user_id'] == user_id:
                 return True, user['log_ch']
         return False, None
 
 
-    async def is_category_ignored(self, guild_id: int, category: Optional[discord.CategoryChannel]) -> bool:
+    async def is_category_ignored(self, guild_id: int, category: Optional[discord.CategoryChannel], pool: Optional[db.PoolOrConnection] = None) -> bool:
         if category is not None:  # If channel is not in a category, don't bother querying DB
-            _ignored_categories = await db.get_ignored_categories(self.db_pool, int(guild_id))
+            _ignored_categories = await db.get_ignored_categories(pool or self.db_pool, int(guild_id))
             if category.id in _ignored_categories:
                 return True
         return False
@@ -196,6 +323,7 @@ class GGBot(commands.Bot):
         pk_user: Union[discord.User, discord.Member] = guild.get_member(self.pk_id)
         if pk_user is not None:
             self.has_pk_cache[f"{guild.name}\n{guild.id}"].append("get")
+            metrics.inc("pk_presence_lookups_total", source="cache")
             return True
 
         # Couldn't find PK in cache, attempting fetch.
@@ -203,10 +331,12 @@ class GGBot(commands.Bot):
             pk_user = await guild.fetch_member(self.pk_id)
             if pk_user is not None:
                 self.has_pk_cache[f"{guild.name}\n{guild.id}"].append("fetch")
+                metrics.inc("pk_presence_lookups_total", source="fetch")
                 return True
 
         except discord.NotFound:
             self.has_pk_cache[f"{guild.name}\n{guild.id}"].append("no_pk")
+            metrics.inc("pk_presence_lookups_total", source="no_pk")
             return False
 
 
@@ -4,12 +4,21 @@ Commands include:
     devtest
     dump
     past_messages
+    bench_mac
+    bench_msg_cache
+    bench_prepared
+    slow_traces
+    train_msg_dict
 
 Part of the Gabby Gums Discord Logger.
 """
 
+import time
 import asyncio
+import hashlib
 import logging
+from io import StringIO
+from functools import partial
 from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple
 
 import discord
@@ -18,6 +27,7 @@ import eCommands
 
 import db
 import miscUtils
+from utils import chatArchiver, contentCompression, tracing
 from utils.paginator import FieldPages
 
 if TYPE_CHECKING:
@@ -25,6 +35,8 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+MAX_DICTIONARY_SAMPLES = 50000  # Most cached messages train_msg_dict will load and train on.
+
 
 class Dev(commands.Cog):
     def __init__(self, bot: 'GGBot'):
@@ -68,7 +80,7 @@ class Dev(commands.Cog):
                 f"system_pkid: {row['system_pkid']}, member_pkid: {row['member_pkid']}, " \
                 f"PK Account: <@{row['pk_system_account_id']}> message: \n**{row['content']}**"
 
-            logging.info(log_msg)
+            log.info(log_msg)
             await miscUtils.send_long_msg(ctx, log_msg)
             await asyncio.sleep(1)
 
@@ -115,6 +127,152 @@ class Dev(commands.Cog):
         page.embed.title = f"Has PK Check Stats:"
         await page.paginate()
 
+    @commands.command(name="bench_mac")
+    async def bench_mac(self, ctx: commands.Context, size_mb: int = 8, rounds: int = 5):
+        """Compares the legacy archive signing (HMAC-SHA3-256 + a separate SHA-256 pass) against the current single pass signing."""
+        size_mb = max(1, min(size_mb, 64))
+        rounds = max(1, min(rounds, 20))
+        async with ctx.typing():
+            fn = partial(blocking_bench_mac, size_mb, rounds, self.bot.hmac_key)
+            results = await self.bot.loop.run_in_executor(None, fn)
+
+        msg = f"Archive signing benchmark ({size_mb} MB x {rounds} rounds):\n```\n"
+        for name, elapsed in results:
+            msg += f"{name:<24} {elapsed * 1000 / rounds:8.2f} ms/archive  {size_mb * rounds / elapsed:8.1f} MB/s\n"
+        msg += "```"
+        await ctx.send(msg)
+
+    @commands.command(name="bench_msg_cache")
+    async def bench_msg_cache(self, ctx: commands.Context, count: int = 2000):
+        """Compares message cache write throughput with a regular (logged) table against an UNLOGGED table."""
+        count = max(100, min(count, 20000))
+        msg = f"Message cache write benchmark ({count} messages, one statement per message):\n```\n"
+        async with ctx.typing():
+            for unlogged in (False, True):
+                timings = await db.benchmark_message_cache_writes(self.bot.db_pool, unlogged, count)
+                if timings is None:
+                    await ctx.send("Benchmark failed. Check the logs.")
+                    return
+                name = "unlogged" if unlogged else "logged"
+                for statement, elapsed in timings.items():
+                    msg += f"{name:<9} {statement:<7} {count / elapsed:10.1f} rows/s  ({elapsed * 1000 / count:.3f} ms/row)\n"
+        msg += "```"
+        await ctx.send(msg)
+
+    @commands.command(name="bench_prepared")
+    async def bench_prepared(self, ctx: commands.Context, count: int = 2000):
+        """Shows how the hot path queries have been run and compares the prepared statement registry with the implicit statement cache."""
+        count = max(100, min(count, 20000))
+        msg = "Hot path statements since startup:\n```\n"
+        for name, stats in db.prepared_statement_stats.stats().items():
+            msg += f"{name:<27} prepared: {stats['prepared']:<8} unprepared: {stats['unprepared']:<6} prepares: {stats['prepares']:<4} reprepares: {stats['reprepares']}\n"
+        msg += f"```\nImplicit statement cache vs prepared statement registry ({count} runs each):\n```\n"
+        async with ctx.typing():
+            timings = await db.benchmark_prepared_statements(self.bot.db_pool, count)
+            if timings is None:
+                await ctx.send("Benchmark failed. Check the logs.")
+                return
+            for name, results in timings.items():
+                implicit = results['implicit'] * 1000 / count
+                registry = results['registry'] * 1000 / count
+                msg += f"{name:<27} implicit: {implicit:.3f} ms  registry: {registry:.3f} ms  ({implicit / registry if registry > 0 else 0:.2f}x)\n"
+        msg += "```"
+        await ctx.send(msg)
+
+    @commands.command(name="slow_traces")
+    async def slow_traces(self, ctx: commands.Context, count: int = 10):
+        """Dumps the most recent event traces that were slower than the slow trace threshold."""
+        tracer = tracing.tracer
+        traces = list(tracer.slow_traces)[-max(1, count):]
+        header = (f"{tracer.slow} of {tracer.finished} traces since startup took longer than {tracer.slow_threshold} ms. "
+                  f"Showing the last {len(traces)}:\n")
+        if len(traces) == 0:
+            await ctx.send(header)
+            return
+        await miscUtils.send_long_msg(ctx, header + "\n\n".join(trace.format() for trace in reversed(traces)), code_block=True, code_block_lang="")
+
+
+    @commands.command(name="train_msg_dict")
+    async def train_msg_dict(self, ctx: commands.Context, samples: int = 10000):
+        """Trains a zstd dictionary for message cache compression on recently cached messages and starts using it."""
+        if contentCompression.zstandard is None:
+            await ctx.send("zstandard is not installed. Message cache compression is using zlib, which doesn't use a trained dictionary.")
+            return
+
+        dictionary_dir = self.bot.config.get('message_cache_dictionaries')
+        if dictionary_dir is None:
+            await ctx.send("`message_cache_dictionaries` needs to be set in the config to save the dictionary to.")
+            return
+
+        samples = min(max(100, samples), MAX_DICTIONARY_SAMPLES)
+        compressor = contentCompression.content_compressor
+        current_dictionary = compressor.dictionary.as_bytes() if compressor.dictionary is not None else None
+
+        async with ctx.typing():
+            contents = await db.get_cached_content_samples(self.bot.db_pool, samples) or []
+            if len(contents) < 100:
+                await ctx.send(f"Only found {len(contents)} cached messages. Need at least 100 to train on.")
+                return
+
+            try:
+                result = await self.bot.loop.run_in_executor(None, partial(blocking_train_msg_dict, contents, current_dictionary, dictionary_dir))
+            except FileExistsError as e:
+                await ctx.send(f"A dictionary with the same ID is already saved at `{e.filename}`. Not overwriting it.")
+                return
+
+            # Saved dictionaries are never overwritten, so the older ones stay loaded for the content they compressed.
+            compressor.add_dictionary(result.dictionary, use=True)
+            compressor.build_compressor()
+
+        await ctx.send(f"Trained a {len(result.dictionary) / 1024:.1f} KB dictionary on {result.sample_count} messages and saved it to `{result.path}`.\n"
+                       f"Stored size: {result.current_ratio:.1%} of raw before, {result.new_ratio:.1%} of raw with the new dictionary "
+                       f"(on the training sample, so a bit optimistic).")
+
+
+class TrainedDictionary(NamedTuple):
+    dictionary: bytes
+    path: str
+    sample_count: int
+    current_ratio: float
+    new_ratio: float
+
+
+def blocking_train_msg_dict(contents: List[Union[str, bytes]], current_dictionary: Optional[bytes], dictionary_dir: str) -> TrainedDictionary:
+    compressor = contentCompression.content_compressor
+    samples = [content if isinstance(content, str) else compressor.decompress(content) for content in contents]
+    samples = [sample for sample in samples if sample is not None]
+
+    # Compare against the dictionary currently in use on the same sample.
+    current_ratio = contentCompression.compression_ratio(samples, current_dictionary)
+    dictionary = contentCompression.train_dictionary(samples)
+    path = contentCompression.save_dictionary(dictionary_dir, dictionary)
+    new_ratio = contentCompression.compression_ratio(samples, dictionary)
+    return TrainedDictionary(dictionary, path, len(samples), current_ratio, new_ratio)
+
+
+def blocking_bench_mac(size_mb: int, rounds: int, security_key: bytes) -> List[Tuple[str, float]]:
+    line = "<div class=\"chatlog__message\"><span class=\"markdown\">Lorem ipsum dolor sit amet</span></div>\n"
+    html = line * (size_mb * 1024 * 1024 // len(line))
+    body = html.encode('utf-8')
+
+    results = []
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        archive = StringIO(html)
+        auth_code = chatArchiver.get_hmac(archive, security_key)
+        signed = archive.getvalue() + f"\n<!--{auth_code}-->"
+        hashlib.sha256(signed.encode('utf-8')).hexdigest()
+    results.append(("legacy (sha3 + sha256)", time.perf_counter() - start))
+
+    for algorithm in chatArchiver.mac_algorithms:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            chatArchiver.sign_archive(body, security_key, algorithm)
+        results.append((f"v2 {algorithm}", time.perf_counter() - start))
+
+    return results
+
 
 def setup(bot):
     bot.add_cog(Dev(bot))
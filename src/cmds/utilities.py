@@ -13,13 +13,15 @@ Part of the Gabby Gums Discord Logger.
 import os
 import time
 import logging
+from functools import partial
 from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple
 
 import psutil
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 import db
+from utils import imageCache, latencyHistogram
 from utils.paginator import FieldPages
 # from embeds import member_nick_update
 
@@ -29,9 +31,35 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 
 
+STATS_RECONCILE_INTERVAL = 6  # Hours between recounting the image cache and message cache for g!stats.
+
+
 class Utilities(commands.Cog):
     def __init__(self, bot: 'GGBot'):
         self.bot = bot
+        self.reconcile_stats.start()
+
+
+    def cog_unload(self):
+        self.reconcile_stats.cancel()
+
+
+    # noinspection PyCallingNonCallable
+    @tasks.loop(hours=STATS_RECONCILE_INTERVAL)
+    async def reconcile_stats(self):
+        """Recounts the image cache and message cache so the running totals used by g!stats can't drift too far."""
+        files, size = await self.bot.loop.run_in_executor(None, partial(imageCache.scan_image_cache))
+        imageCache.disk_usage.reconcile(files, size)
+
+        num_of_db_cached_messages = await db.get_number_of_rows_in_messages(self.bot.db_pool)
+        if num_of_db_cached_messages is not None:
+            db.message_cache_counter.reconcile(num_of_db_cached_messages)
+        log.info(f"Reconciled stats: {files} files ({size / 1024 / 1024:.2f} MB) in the image cache, {num_of_db_cached_messages} cached messages.")
+
+
+    @reconcile_stats.before_loop
+    async def before_reconcile_stats(self):
+        await self.bot.wait_until_ready()
 
     @commands.is_owner()
     @commands.cooldown(rate=1, per=10, type=commands.BucketType.default)
@@ -150,15 +178,6 @@ class Utilities(commands.Cog):
                       description='Shows various stats such as CPU, memory usage, disk space usage, and more.')
     async def stats_command(self, ctx: commands.Context):
 
-        def folder_size(path='.'):
-            total = 0
-            for entry in os.scandir(path):
-                if entry.is_file():
-                    total += entry.stat().st_size
-                elif entry.is_dir():
-                    total += folder_size(entry.path)
-            return total
-
         pid = os.getpid()
         py = psutil.Process(pid)
         memory_use = py.memory_info()[0] / 1024 / 1024
@@ -166,14 +185,12 @@ class Utilities(commands.Cog):
         disk_space_free = disk_usage.free / 1024 / 1024
         disk_space_used = disk_usage.used / 1024 / 1024
         disk_space_percent_used = disk_usage.percent
-        try:
-            image_cache_du_used = folder_size("./image_cache/") / 1024 / 1024
-            num_of_files_in_cache = sum([len(files) for r, d, files in os.walk("./image_cache/")])
-        except FileNotFoundError as e:
-            image_cache_du_used = -1
-            num_of_files_in_cache = -1
+        # These are running totals. -1 until they have been counted for the first time after start up.
+        image_cache_bytes = imageCache.disk_usage.bytes
+        image_cache_du_used = image_cache_bytes / 1024 / 1024 if image_cache_bytes is not None else -1
+        num_of_files_in_cache = imageCache.disk_usage.files if imageCache.disk_usage.files is not None else -1
 
-        num_of_db_cached_messages = await db.get_number_of_rows_in_messages(self.bot.db_pool)
+        num_of_db_cached_messages = db.message_cache_counter.count if db.message_cache_counter.count is not None else -1
         try:
             # noinspection PyUnresolvedReferences
             load_average = os.getloadavg()
@@ -189,6 +206,21 @@ class Utilities(commands.Cog):
                                      num_of_files_in_cache, num_of_db_cached_messages, len(self.bot.cached_messages),
                                      len(self.bot.guilds)), color=0x00b7fa)
 
+        downloads = self.bot.attachment_downloader.stats()
+        embed.add_field(name="Attachment downloads:",
+                        value="Queue: **{}/{}**, Downloading: **{}**\nCompleted: **{}**, Failed: **{}**, Dropped: **{}**\n"
+                              "Downloaded: **{:.2f} MB**, Throughput: **{:.2f} KB/s**".
+                        format(downloads.queue_depth, downloads.queue_size, downloads.in_progress, downloads.completed,
+                               downloads.failed, downloads.dropped, downloads.bytes_downloaded / 1024 / 1024,
+                               downloads.bytes_per_sec / 1024))
+
+        usage = imageCache.disk_usage
+        embed.add_field(name="Since start up:",
+                        value="Image cache: **{}** files (**{:.2f} MB**) written, **{}** files (**{:.2f} MB**) evicted\n"
+                              "Message cache: **{}** messages cached, **{}** deleted, **{}** not cached as they wouldn't be logged".
+                        format(usage.files_written, usage.bytes_written / 1024 / 1024, usage.files_removed, usage.bytes_removed / 1024 / 1024,
+                               db.message_cache_counter.inserted, db.message_cache_counter.deleted, self.bot.cache_policy.skipped))
+
         await ctx.send(embed=embed)
 
     # region Verbose Permissions Verification Command
@@ -634,11 +666,16 @@ class Utilities(commands.Cog):
     # region DB Performance Statistics Command
     @commands.cooldown(rate=1, per=10, type=commands.BucketType.default)
     @commands.command(aliases=["db_stats", "db_performance"],
-                      brief="Shows various time stats for the database.",)
-    async def db_perf(self, ctx: commands.Context):
+                      brief="Shows various time stats for the database.",
+                      usage="[1m|15m|all]")
+    async def db_perf(self, ctx: commands.Context, window: str = "all"):
+
+        if window not in latencyHistogram.WINDOWS:
+            await ctx.send(f"The window must be one of: {', '.join(latencyHistogram.WINDOWS)}")
+            return
 
         embed_entries = []
-        stats = db.db_perf.stats()
+        stats = db.db_perf.stats(window)
 
         for key, value in stats.items():
             # Don't bother showing stats for one offs
@@ -647,7 +684,7 @@ class Utilities(commands.Cog):
 
                 msg_list = []
                 for sub_key, sub_value in value.items():
-                    if sub_key == "calls":
+                    if sub_key in ("calls", "errors"):
                         msg_list.append(f"{sub_key}: {sub_value:.0f}")
                     else:
                         msg_list.append(f"{sub_key}: {sub_value:.2f}")
@@ -656,8 +693,12 @@ class Utilities(commands.Cog):
                     msg = "\n".join(msg_list)
                     embed_entries.append((header, msg))
 
+        if len(embed_entries) == 0:
+            await ctx.send(f"No database calls in the {window} window.")
+            return
+
         page = FieldPages(ctx, entries=embed_entries, per_page=15)
-        page.embed.title = f"DB Statistics:"
+        page.embed.title = f"DB Statistics ({'since startup' if window == 'all' else f'last {window}'}, times in ms):"
         await page.paginate()
     # endregion
 
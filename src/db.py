@@ -8,9 +8,9 @@ import time
 import json
 import logging
 import functools
-import statistics as stats
-from typing import List, Optional
+from typing import List, Optional, Dict, Set, Union
 from collections import defaultdict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
@@ -18,68 +18,260 @@ import asyncpg
 from discord import Invite, Message
 
 import GuildConfigs
+from utils.contentCompression import content_compressor
+from utils.latencyHistogram import WindowedHistogram, WINDOWS
+
+log = logging.getLogger(__name__)
 
 
 class DBPerformance:
+    """Latency and error counts for each db function, in fixed memory."""
 
     def __init__(self):
-        self.time = defaultdict(list)
+        self.queries: Dict[str, WindowedHistogram] = defaultdict(WindowedHistogram)
 
-    def avg(self, key: str):
-        return stats.mean(self.time[key])
+    def record(self, key: str, latency: float):
+        self.queries[key].add(latency)
 
-    def all_avg(self):
-        avgs = {}
-        for key, value in self.time.items():
-            avgs[key] = stats.mean(value)
-        return avgs
+    def error(self, key: str):
+        self.queries[key].error()
 
-    def stats(self):
+    def stats(self, window: str = 'all') -> Dict[str, Dict[str, float]]:
+        """Stats for every db function that was called within the window. window is one of latencyHistogram.WINDOWS."""
+        seconds = WINDOWS[window]
         statistics = {}
-        for key, value in self.time.items():
-            loop_stats = {}
-            try:
-                loop_stats['avg'] = stats.mean(value)
-            except stats.StatisticsError:
-                loop_stats['avg'] = -1
+        for key, histogram in self.queries.items():
+            window_histogram = histogram.window(seconds)
+            if window_histogram.count > 0 or window_histogram.errors > 0:
+                statistics[key] = window_histogram.stats()
+        return statistics
 
-            try:
-                loop_stats['med'] = stats.median(value)
-            except stats.StatisticsError:
-                loop_stats['med'] = -1
 
-            try:
-                loop_stats['max'] = max(value)
-            except stats.StatisticsError:
-                loop_stats['max'] = -1
+db_perf = DBPerformance()
 
-            try:
-                loop_stats['min'] = min(value)
-            except stats.StatisticsError:
-                loop_stats['min'] = -1
 
-            loop_stats['calls'] = len(value)
+class MessageCacheCounter:
+    """Running count of the rows in the messages table so g!stats doesn't need to count them every time.
+    Rows removed by cascades aren't seen here, so the count is periodically reconciled with the real count."""
 
-            statistics[key] = loop_stats
-        return statistics
+    def __init__(self):
+        self.reconciled_count: Optional[int] = None  # Unknown until the first reconcile.
+        self.reconciled_at: Optional[datetime] = None
+        self.inserted = 0
+        self.deleted = 0
+        self.inserted_since_reconcile = 0
+        self.deleted_since_reconcile = 0
+
+    @property
+    def count(self) -> Optional[int]:
+        if self.reconciled_count is None:
+            return None
+        return max(self.reconciled_count + self.inserted_since_reconcile - self.deleted_since_reconcile, 0)
 
+    def add(self, number: int):
+        self.inserted += number
+        self.inserted_since_reconcile += number
 
-db_perf = DBPerformance()
+    def remove(self, number: int):
+        self.deleted += number
+        self.deleted_since_reconcile += number
+
+    def reconcile(self, count: int):
+        self.reconciled_count = count
+        self.reconciled_at = datetime.utcnow()
+        self.inserted_since_reconcile = 0
+        self.deleted_since_reconcile = 0
+
+
+message_cache_counter = MessageCacheCounter()
+
+
+# Bumped every time a guilds logging configuration (log channels, event configs, overrides or ignored categories) is changed.
+# Lets anything that keeps an in memory copy of the configuration know that it's out of date.
+guild_config_versions: Dict[int, int] = defaultdict(int)
+
+
+def guild_config_changed(sid: int):
+    guild_config_versions[sid] += 1
+
+
+# The queries on the hot paths. These are explicitly prepared on every pool connection instead of relying on asyncpg's implicit statement cache.
+PREPARED_STATEMENTS: Dict[str, str] = {
+    'cache_message': "INSERT INTO messages(server_id, message_id, user_id, content, content_compressed, attachments, webhook_author_name) VALUES($1, $2, $3, $4, $5, $6, $7)",
+    'get_cached_message': "SELECT * FROM messages WHERE message_id = $1",
+    'delete_cached_message_refs': "DELETE FROM attachment_refs WHERE message_id = ANY($1::BIGINT[]) RETURNING digest",
+    'delete_cached_messages': "DELETE FROM messages WHERE message_id = ANY($1::BIGINT[])",
+    'release_unreferenced_blobs': """
+        DELETE FROM attachment_blobs b
+        WHERE b.digest = ANY($1::TEXT[])
+          AND NOT EXISTS (SELECT 1 FROM attachment_refs r WHERE r.digest = b.digest)
+        RETURNING b.digest""",
+    'get_server_log_configs': "SELECT log_configs FROM servers WHERE server_id = $1",
+}
 
-async def create_db_pool(uri: str) -> asyncpg.pool.Pool:
+
+class PreparedStatementStats:
+
+    def __init__(self):
+        self.executions: Dict[str, int] = defaultdict(int)  # Executed with a prepared statement from a connections registry.
+        self.unprepared: Dict[str, int] = defaultdict(int)  # Executed as plain query text because the connection had no registry.
+        self.prepares: Dict[str, int] = defaultdict(int)
+        self.reprepares: Dict[str, int] = defaultdict(int)  # Statements that had to be prepared again after a schema change invalidated them.
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: {'prepared': self.executions[name], 'unprepared': self.unprepared[name],
+                       'prepares': self.prepares[name], 'reprepares': self.reprepares[name]}
+                for name in PREPARED_STATEMENTS}
+
+
+prepared_statement_stats = PreparedStatementStats()
+
+
+class PreparedStatements:
+    """The PREPARED_STATEMENTS prepared on a single connection. Statements that could not be prepared up front are prepared on first use."""
+
+    def __init__(self, conn: asyncpg.connection.Connection):
+        self.conn = conn
+        self.statements: Dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+    async def prepare_all(self):
+        for name in PREPARED_STATEMENTS:
+            try:
+                await self.prepare(name)
+            except asyncpg.exceptions.PostgresError as e:
+                # Most likely the tables haven't been created yet on the very first start.
+                log.debug(f"Could not prepare {name} yet: {e}")
+
+    async def prepare(self, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        statement = await self.conn.prepare(PREPARED_STATEMENTS[name])
+        self.statements[name] = statement
+        prepared_statement_stats.prepares[name] += 1
+        return statement
+
+    async def get(self, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        statement = self.statements.get(name)
+        if statement is None:
+            statement = await self.prepare(name)
+        return statement
+
+
+class GGConnection(asyncpg.connection.Connection):
+    """Pool connection that carries it's own registry of prepared statements."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = PreparedStatements(self)
+
+
+async def run_prepared(conn: asyncpg.connection.Connection, name: str, method: str, *args):
+    """
+    Runs one of the PREPARED_STATEMENTS using the connections prepared statement.
+    method is the name of the fetch method to call (fetch, fetchrow or fetchval), or 'execute' to get the status message back like Connection.execute.
+    Falls back to running the query text if the connection doesn't have a registry (e.g. it wasn't made by create_db_pool).
+    """
+    registry: Optional[PreparedStatements] = getattr(conn, 'prepared_statements', None)
+    if registry is None:
+        prepared_statement_stats.unprepared[name] += 1
+        return await getattr(conn, method)(PREPARED_STATEMENTS[name], *args)
+
+    statement = await registry.get(name)
+    try:
+        result = await _run_statement(statement, method, args)
+    except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+        # The schema changed under the statement (e.g. create_tables added a column). Prepare it again.
+        registry.statements.pop(name, None)
+        prepared_statement_stats.reprepares[name] += 1
+        if conn.is_in_transaction():
+            raise  # The transaction is aborted, so it can't be retried here. The next call will use the new statement.
+        statement = await registry.get(name)
+        result = await _run_statement(statement, method, args)
+
+    prepared_statement_stats.executions[name] += 1
+    return result
+
+
+async def _run_statement(statement: asyncpg.prepared_stmt.PreparedStatement, method: str, args: tuple):
+    if method == 'execute':
+        await statement.fetch(*args)
+        return statement.get_statusmsg()
+    return await getattr(statement, method)(*args)
+
+
+async def create_db_pool(uri: str, statement_cache_size: int = 100) -> asyncpg.pool.Pool:
 
     # FIXME: Error Handling
-    async def init_connection(conn):
+    async def init_connection(conn: GGConnection):
         await conn.set_type_codec('json',
                                   encoder=json.dumps,
                                   decoder=json.loads,
                                   schema='pg_catalog')
+        await conn.prepared_statements.prepare_all()
 
-    pool: asyncpg.pool.Pool = await asyncpg.create_pool(uri, init=init_connection)
+    pool: asyncpg.pool.Pool = await asyncpg.create_pool(uri, init=init_connection, connection_class=GGConnection,
+                                                        statement_cache_size=statement_cache_size)
 
     return pool
 
 
+class UnitOfWork:
+    """
+    Runs a group of queries (typically everything a single event handler does) on one pool connection instead of acquiring a connection per query.
+    The connection is acquired on first use and can be handed back early with release() (e.g. before waiting on Discord or the PK API),
+    in which case the next query acquires a new one. Can be passed to any db function in place of the pool.
+    Not safe to share between concurrently running tasks.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self.conn: Optional[asyncpg.connection.Connection] = None
+        self.acquisitions = 0
+
+    async def __aenter__(self) -> 'UnitOfWork':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+    async def connection(self) -> asyncpg.connection.Connection:
+        if self.conn is None:
+            self.conn = await self.pool.acquire()
+            self.acquisitions += 1
+        return self.conn
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Runs every query made through this unit of work inside the block in one transaction."""
+        conn = await self.connection()
+        async with conn.transaction():
+            yield conn
+
+    async def release(self):
+        if self.conn is not None:
+            conn = self.conn
+            self.conn = None
+            await self.pool.release(conn)
+
+
+def unit_of_work(pool: asyncpg.pool.Pool) -> UnitOfWork:
+    return UnitOfWork(pool)
+
+
+# Anything the db functions can run their queries on.
+PoolOrConnection = Union[asyncpg.pool.Pool, UnitOfWork, asyncpg.connection.Connection]
+
+
+@asynccontextmanager
+async def acquire(pool: PoolOrConnection):
+    """Gets a connection to run queries on from a pool, a unit of work, or an already acquired connection."""
+    if isinstance(pool, UnitOfWork):
+        yield await pool.connection()
+    elif isinstance(pool, asyncpg.pool.Pool):
+        async with pool.acquire() as conn:
+            yield conn
+    else:
+        yield pool
+
+
 def db_deco(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
@@ -87,15 +279,16 @@ def db_deco(func):
         try:
             response = await func(*args, **kwargs)
             end_time = time.perf_counter()
-            db_perf.time[func.__name__].append((end_time - start_time) * 1000)
+            db_perf.record(func.__name__, (end_time - start_time) * 1000)
 
             if len(args) > 1:
-                logging.debug("DB Query {} from {} in {:.3f} ms.".format(func.__name__, args[1], (end_time - start_time) * 1000))
+                log.debug("DB Query {} from {} in {:.3f} ms.".format(func.__name__, args[1], (end_time - start_time) * 1000))
             else:
-                logging.debug("DB Query {} in {:.3f} ms.".format(func.__name__, (end_time - start_time) * 1000))
+                log.debug("DB Query {} in {:.3f} ms.".format(func.__name__, (end_time - start_time) * 1000))
             return response
         except asyncpg.exceptions.PostgresError:
-            logging.exception("Error attempting database query: {} for server: {}".format(func.__name__, args[1]))
+            db_perf.error(func.__name__)
+            log.exception("Error attempting database query: {} for server: {}".format(func.__name__, args[1]))
     return wrapper
 
 
@@ -103,7 +296,7 @@ async def ensure_server_exists(conn, sid: int):
     # TODO: Add name as well.
     response = await conn.fetchval("select exists(select 1 from servers where server_id = $1)", sid)
     if response is False:
-        logging.warning("SERVER {} WAS NOT IN DB. ADDING WITHOUT NAME!".format(sid))
+        log.warning("SERVER {} WAS NOT IN DB. ADDING WITHOUT NAME!".format(sid))
         await conn.execute(
             "INSERT INTO servers(server_id, server_name) VALUES($1, $2)",
             sid, "NOT_AVAILABLE")
@@ -112,7 +305,7 @@ async def ensure_server_exists(conn, sid: int):
 
 @db_deco
 async def add_server(pool, sid: int, name: str):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute(
             "INSERT INTO servers(server_id, server_name) VALUES($1, $2)",
             sid, name)
@@ -120,74 +313,96 @@ async def add_server(pool, sid: int, name: str):
 
 @db_deco
 async def remove_server(pool, sid: int):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM servers WHERE server_id = $1", sid)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def update_server_name(pool, sid: int, name: str):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await ensure_server_exists(conn, sid)
         await conn.execute("UPDATE servers SET server_name = $1 WHERE server_id = $2", name, sid)
 
 
 @db_deco
 async def update_log_channel(pool, sid: int, log_channel_id: int = None):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await ensure_server_exists(conn, sid)
         await conn.execute("UPDATE servers SET log_channel_id = $1 WHERE server_id = $2", log_channel_id, sid)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def get_log_channel(pool, sid: int) -> Optional[int]:  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         row = await conn.fetchrow('SELECT log_channel_id FROM servers WHERE server_id = $1', sid)
         return row['log_channel_id'] if row else None
 
 
 @db_deco
 async def update_log_enabled(pool, sid: int, log_enabled: bool):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await ensure_server_exists(conn, sid)
         await conn.execute("UPDATE servers SET logging_enabled = $1 WHERE server_id = $2", log_enabled, sid)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def set_server_log_configs(pool, sid: int, log_configs: GuildConfigs.GuildLoggingConfig):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await ensure_server_exists(conn, sid)
         await conn.execute("UPDATE servers SET log_configs = $1 WHERE server_id = $2", log_configs.to_dict(), sid)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def get_server_log_configs(pool, sid: int) -> GuildConfigs.GuildLoggingConfig:
-    async with pool.acquire() as conn:
-        value = await conn.fetchval('SELECT log_configs FROM servers WHERE server_id = $1', sid)
+    async with acquire(pool) as conn:
+        value = await run_prepared(conn, 'get_server_log_configs', 'fetchval', sid)
         # return GuildConfigs.load_nested_dict(GuildConfigs.GuildLoggingConfig, value) if value else GuildConfigs.GuildLoggingConfig()
         return GuildConfigs.GuildLoggingConfig.from_dict(value)
 
+
+@dataclass
+class ServerRouting:
+    log_channel_id: Optional[int]
+    log_configs: GuildConfigs.GuildLoggingConfig
+
+
+@db_deco
+async def get_server_routing(pool, sid: int) -> ServerRouting:
+    """Gets the guilds log channel and log configs in one query. A guild without a servers row gets empty routing, so None always means the query failed."""
+    async with acquire(pool) as conn:
+        row = await conn.fetchrow("SELECT log_channel_id, log_configs FROM servers WHERE server_id = $1", sid)
+        if row is None:
+            return ServerRouting(None, GuildConfigs.GuildLoggingConfig.from_dict(None))
+        return ServerRouting(row['log_channel_id'], GuildConfigs.GuildLoggingConfig.from_dict(row['log_configs']))
+
 # ----- Users Override DB Functions ----- #
 
 @db_deco
 async def add_user_override(pool, sid: int, ignored_user_id: int, override_log_ch: Optional[int]):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("""
                             INSERT INTO ignored_users(user_id, server_id, log_ch) VALUES($1, $2, $3)
                             ON CONFLICT (server_id, user_id)
                             DO UPDATE
                             SET log_ch = EXCLUDED.log_ch
                             """, ignored_user_id, sid, override_log_ch)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def remove_user_override(pool, sid: int, ignored_user_id: int):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM ignored_users WHERE server_id = $1 AND user_id = $2", sid, ignored_user_id)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def get_users_overrides(pool: asyncpg.pool.Pool, sid: int) -> List[asyncpg.Record]:  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         conn: asyncpg.connection.Connection
         # TODO: Optimise by replacing * with user_id
         raw_rows = await conn.fetch('SELECT * FROM ignored_users WHERE server_id = $1', sid)
@@ -199,24 +414,26 @@ async def get_users_overrides(pool: asyncpg.pool.Pool, sid: int) -> List[asyncpg
 
 @db_deco
 async def add_channel_override(pool, sid: int, ignored_channel_id: int, override_log_ch: Optional[int]):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("""
                             INSERT INTO ignored_channels(channel_id, server_id, log_ch) VALUES($1, $2, $3)
                             ON CONFLICT (server_id, channel_id)
                             DO UPDATE
                             SET log_ch = EXCLUDED.log_ch
                             """, ignored_channel_id, sid, override_log_ch)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def remove_channel_override(pool, sid: int, ignored_channel_id: int):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM ignored_channels WHERE server_id = $1 AND channel_id = $2", sid, ignored_channel_id)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def get_channel_overrides(pool, sid: int) -> List[asyncpg.Record]:  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         raw_rows = await conn.fetch('SELECT * FROM ignored_channels WHERE server_id = $1', sid)
     return raw_rows
 
@@ -227,19 +444,21 @@ async def get_channel_overrides(pool, sid: int) -> List[asyncpg.Record]:  # Good
 
 @db_deco
 async def add_ignored_category(pool, sid: int, ignored_category_id: int):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("INSERT INTO ignored_category(category_id, server_id) VALUES($1, $2)", ignored_category_id, sid)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def remove_ignored_category(pool, sid: int, ignored_category_id: int):  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM ignored_category WHERE server_id = $1 AND category_id = $2", sid, ignored_category_id)
+    guild_config_changed(sid)
 
 
 @db_deco
 async def get_ignored_categories(pool, sid: int) -> List[int]:  # Good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         raw_rows = await conn.fetch('SELECT category_id FROM ignored_category WHERE server_id = $1', sid)
         category_ids = [row["category_id"] for row in raw_rows]
     return category_ids
@@ -251,7 +470,7 @@ async def get_ignored_categories(pool, sid: int) -> List[int]:  # Good
 
 @db_deco
 async def store_invite(pool, sid: int, invite_id: str, invite_uses: int = 0, max_uses: Optional[int] = None, inviter_id: Optional[str] = None, created_at: Optional[datetime] = None):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         ts = math.floor(created_at.timestamp()) if created_at is not None else None
         await conn.execute(
             """
@@ -265,24 +484,24 @@ async def store_invite(pool, sid: int, invite_id: str, invite_uses: int = 0, max
 
 async def add_new_invite(pool, sid: int, invite_id: str, max_uses: int, inviter_id: str, created_at: datetime, invite_uses: int = 0):
     ts = math.floor(created_at.timestamp()) if created_at is not None else None
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("INSERT INTO invites(server_id, invite_id, uses, max_uses, inviter_id, created_ts) VALUES($1, $2, $3, $4, $5, $6)", sid, invite_id, invite_uses, max_uses, inviter_id, ts)
 
 
 async def update_invite_uses(pool, sid: int, invite_id: str, invite_uses: int):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("UPDATE invites SET uses = $1 WHERE server_id = $2 AND invite_id = $3", invite_uses, sid, invite_id)
 
 
 @db_deco
 async def update_invite_name(pool, sid: int, invite_id: str, invite_name: Optional[str] = None):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("UPDATE invites SET invite_name = $1 WHERE server_id = $2 AND invite_id = $3", invite_name, sid, invite_id)
 
 
 @db_deco
 async def remove_invite(pool, sid, invite_id):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM invites WHERE server_id = $1 AND invite_id = $2", sid, invite_id)
 
 
@@ -321,7 +540,7 @@ class StoredInvites:
 
 @db_deco
 async def get_invites(pool, sid: int) -> StoredInvites:
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         raw_rows = await conn.fetch('SELECT * FROM invites WHERE server_id = $1', sid)
         #Fixme: Does fetch return None or 0 length list when no entries are found?
         return StoredInvites(invites=[StoredInvite(**row) for row in raw_rows])
@@ -341,57 +560,226 @@ class CachedMessage:
     system_pkid: Optional[str]
     member_pkid: Optional[str]
     pk_system_account_id: Optional[int]
+    content_compressed: Optional[bytes] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        # Cached content may be stored compressed. Only decompress it here, on the (rare) read path.
+        if self.content_compressed is not None:
+            self.content = content_compressor.decompress(self.content_compressed)
+            self.content_compressed = None
 
 
 @db_deco
 async def cache_message(pool, sid: int, message_id: int, author_id: int, message_content: Optional[str] = None,
                         attachments: Optional[List[str]] = None, webhook_author_name: Optional[str] = None,
                         system_pkid: Optional[str] = None, member_pkid: Optional[str] = None, pk_system_account_id: Optional[int] = None):
-    async with pool.acquire() as conn:
-        await conn.execute("INSERT INTO messages(server_id, message_id, user_id, content, attachments, webhook_author_name) VALUES($1, $2, $3, $4, $5, $6)", sid, message_id, author_id, message_content, attachments, webhook_author_name)
+    compressed_content = content_compressor.compress(message_content)
+    if compressed_content is not None:
+        message_content = None
+    async with acquire(pool) as conn:
+        await run_prepared(conn, 'cache_message', 'execute',
+                           sid, message_id, author_id, message_content, compressed_content, attachments, webhook_author_name)
+        message_cache_counter.add(1)
+
+
+@db_deco
+async def add_cached_attachment(pool, sid: int, message_id: int, digest: str, size: int, attachment_name: str) -> bool:
+    """
+    Adds a downloaded attachment blob to a cached message.
+    The blob is registered first so that it is always tracked (and eventually garbage collected) even if the message is gone.
+    Returns False if the message is no longer cached.
+    """
+    async with acquire(pool) as conn:
+        async with conn.transaction():
+            await conn.execute("INSERT INTO attachment_blobs(digest, size) VALUES($1, $2) ON CONFLICT (digest) DO UPDATE SET last_used = NOW()", digest, size)
+            status = await conn.execute("UPDATE messages SET attachments = array_append(attachments, $2) WHERE message_id = $1", message_id, f"{digest}/{attachment_name}")
+            if status == "UPDATE 0":
+                return False
+            await conn.execute("INSERT INTO attachment_refs(message_id, server_id, digest) VALUES($1, $2, $3) ON CONFLICT DO NOTHING", message_id, sid, digest)
+            return True
+
+
+@db_deco
+async def get_attachment_blob_sizes(pool, digests: List[str]) -> Dict[str, int]:
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("SELECT digest, size FROM attachment_blobs WHERE digest = ANY($1::TEXT[])", digests)
+        return {row['digest']: row['size'] for row in rows}
+
+
+@db_deco
+async def get_legacy_attachment_names(pool) -> Dict[int, Set[str]]:
+    """Gets the attachments of cached messages that are still stored in the legacy per guild image cache directories, by guild ID."""
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT server_id, attachment FROM messages, unnest(attachments) AS attachment
+            WHERE attachments IS NOT NULL AND position('/' in attachment) = 0""")
+        legacy_names: Dict[int, Set[str]] = {}
+        for row in rows:
+            legacy_names.setdefault(row['server_id'], set()).add(row['attachment'])
+        return legacy_names
+
+
+@db_deco
+async def use_attachment_blobs(pool, digests: List[str]) -> Dict[str, int]:
+    """Gets the sizes of blobs that are about to be re-uploaded and marks them as used, so eviction is by least recently used."""
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("UPDATE attachment_blobs SET last_used = NOW() WHERE digest = ANY($1::TEXT[]) RETURNING digest, size", digests)
+        return {row['digest']: row['size'] for row in rows}
+
+
+async def release_unreferenced_blobs(conn: asyncpg.connection.Connection, digests: List[str]) -> List[str]:
+    """Removes the given blobs if nothing references them any more. Returns the digests that were removed.
+    Should be called inside the transaction that removed the refs."""
+    if len(digests) == 0:
+        return []
+    rows = await run_prepared(conn, 'release_unreferenced_blobs', 'fetch', list(set(digests)))
+    return [row['digest'] for row in rows]
+
+
+@db_deco
+async def evict_old_attachment_blobs(pool, max_age_days: int) -> List[str]:
+    """Evicts every attachment blob that has not been used in max_age_days. Returns the digests that were removed."""
+    async with acquire(pool) as conn:
+        async with conn.transaction():
+            rows = await conn.fetch("SELECT digest FROM attachment_blobs WHERE last_used < NOW() - make_interval(days => $1)", max_age_days)
+            digests = [row['digest'] for row in rows]
+            await conn.execute("DELETE FROM attachment_refs WHERE digest = ANY($1::TEXT[])", digests)
+            return await release_unreferenced_blobs(conn, digests)
+
+
+@db_deco
+async def evict_attachment_blobs_over_quota(pool, max_bytes: int) -> List[str]:
+    """Evicts the least recently used attachment blobs until the total size of the blob store is under max_bytes.
+    Returns the digests that were removed."""
+    async with acquire(pool) as conn:
+        async with conn.transaction():
+            rows = await conn.fetch("""
+                SELECT digest FROM (
+                    SELECT digest, SUM(size) OVER (ORDER BY last_used DESC, digest) AS total FROM attachment_blobs
+                ) AS blobs
+                WHERE total > $1""", max_bytes)
+            digests = [row['digest'] for row in rows]
+            await conn.execute("DELETE FROM attachment_refs WHERE digest = ANY($1::TEXT[])", digests)
+            return await release_unreferenced_blobs(conn, digests)
+
+
+@db_deco
+async def evict_guild_attachments_over_quota(pool, max_bytes: int) -> List[str]:
+    """
+    Drops each guilds least recently used attachments until the blobs the guild references are under max_bytes.
+    Blobs shared with other guilds stay around for them. Returns the digests of the blobs that are no longer used by anyone.
+    """
+    async with acquire(pool) as conn:
+        async with conn.transaction():
+            rows = await conn.fetch("""
+                SELECT server_id, digest FROM (
+                    SELECT g.server_id, g.digest, SUM(b.size) OVER (PARTITION BY g.server_id ORDER BY b.last_used DESC, g.digest) AS total
+                    FROM (SELECT DISTINCT server_id, digest FROM attachment_refs) AS g
+                    JOIN attachment_blobs b ON b.digest = g.digest
+                ) AS guild_blobs
+                WHERE total > $1""", max_bytes)
+            if len(rows) == 0:
+                return []
+            await conn.execute("""
+                DELETE FROM attachment_refs r
+                USING unnest($1::BIGINT[], $2::TEXT[]) AS e(server_id, digest)
+                WHERE r.server_id = e.server_id AND r.digest = e.digest""",
+                               [row['server_id'] for row in rows], [row['digest'] for row in rows])
+            return await release_unreferenced_blobs(conn, [row['digest'] for row in rows])
+
+
+@db_deco
+async def delete_unused_attachment_blobs(pool, grace_minutes: int) -> List[str]:
+    """Removes every attachment blob that is no longer referenced by a cached message and returns their digests so the files can be deleted.
+    Blobs used within the last grace_minutes are kept so blobs that are in the middle of being attached to a message are not removed."""
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("""
+            DELETE FROM attachment_blobs b
+            WHERE b.last_used < NOW() - make_interval(mins => $1)
+              AND NOT EXISTS (SELECT 1 FROM attachment_refs r WHERE r.digest = b.digest)
+            RETURNING b.digest""", grace_minutes)
+        return [row['digest'] for row in rows]
 
 
 @db_deco
 async def get_cached_message(pool, sid: int, message_id: int) -> Optional[CachedMessage]:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM messages WHERE message_id = $1", message_id)
+    async with acquire(pool) as conn:
+        row = await run_prepared(conn, 'get_cached_message', 'fetchrow', message_id)
         return CachedMessage(**row) if row is not None else None
 
 
 
 @db_deco
-async def get_cached_message_for_archive(conn: asyncpg.connection.Connection, sid: int, message_id: int) -> Optional[CachedMessage]:
+async def get_cached_message_for_archive(pool: PoolOrConnection, sid: int, message_id: int) -> Optional[CachedMessage]:
     """This DB function is for bulk selects. As such to avoid wasting time reacquiring a connection for each call,
-    the connection should be obtained in the function calling this function."""
-    row = await conn.fetchrow("SELECT * FROM messages WHERE message_id = $1", message_id)
-    return CachedMessage(**row) if row is not None else None
+    the connection (or a unit of work) should be obtained in the function calling this function."""
+    async with acquire(pool) as conn:
+        row = await conn.fetchrow("SELECT * FROM messages WHERE message_id = $1", message_id)
+        return CachedMessage(**row) if row is not None else None
     # cached = CachedMsgPKInfo(message_id, sid, row['webhook_author_name'], row['system_pkid'], row['member_pkid'], row['pk_system_account_id']) if row is not None else None
     # return cached
 
 
+@db_deco
+async def get_cached_messages_for_archive(pool: PoolOrConnection, sid: int, message_ids: List[int]) -> Dict[int, CachedMessage]:
+    """Batched version of get_cached_message_for_archive. Fetches every cached message in message_ids with a single query.
+    Returns a dict keyed by message ID. Messages that are not in the cache are simply absent from the dict."""
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("SELECT * FROM messages WHERE message_id = ANY($1::BIGINT[])", message_ids)
+        return {row['message_id']: CachedMessage(**row) for row in rows}
+
+
 @db_deco
 async def update_cached_message(pool, sid: int, message_id: int, new_content: str):
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE messages SET content = $1 WHERE message_id = $2", new_content, message_id)
+    async with acquire(pool) as conn:
+        compressed_content = content_compressor.compress(new_content)
+        if compressed_content is not None:
+            new_content = None
+        await conn.execute("UPDATE messages SET content = $1, content_compressed = $2 WHERE message_id = $3", new_content, compressed_content, message_id)
 
 
 @db_deco
 async def update_cached_message_pk_details(pool, sid: int, message_id: int, system_pkid: str, member_pkid: str,
                                            pk_system_account_id: int):
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("UPDATE messages SET system_pkid = $1, member_pkid = $2, pk_system_account_id = $3 WHERE message_id = $4",
                            system_pkid, member_pkid, pk_system_account_id, message_id)
 
 
 @db_deco
-async def delete_cached_message(pool, sid: int, message_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM messages WHERE message_id = $1", message_id)
+async def delete_cached_message(pool, sid: int, message_id: int) -> List[str]:
+    """Deletes a cached message. Returns the digests of any attachment blobs that are no longer used so their files can be removed."""
+    return await delete_cached_messages(pool, sid, [message_id])
+
+
+@db_deco
+async def delete_cached_messages(pool, sid: int, message_ids: List[int]) -> List[str]:
+    """Batched version of delete_cached_message."""
+    async with acquire(pool) as conn:
+        async with conn.transaction():
+            rows = await run_prepared(conn, 'delete_cached_message_refs', 'fetch', message_ids)
+            status = await run_prepared(conn, 'delete_cached_messages', 'execute', message_ids)
+            message_cache_counter.remove(int(status.split()[-1]))
+            return await release_unreferenced_blobs(conn, [row['digest'] for row in rows])
 
 
 @db_deco
-async def get_number_of_rows_in_messages(pool, table: str = "messages") -> int:  # Slow! But only used for g!top so okay.
-    async with pool.acquire() as conn:
+async def get_cached_content_samples(pool, limit: int) -> List[Union[str, bytes]]:
+    """
+    Gets the content of the most recently cached messages. Used to train the compression dictionary.
+    Content that is stored compressed is returned still compressed (as bytes) so it can be decompressed off the event loop.
+    """
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("""
+            SELECT content, content_compressed FROM messages
+            WHERE content IS NOT NULL OR content_compressed IS NOT NULL
+            ORDER BY message_id DESC LIMIT $1""", limit)
+        return [row['content'] if row['content'] is not None else row['content_compressed'] for row in rows]
+
+
+@db_deco
+async def get_number_of_rows_in_messages(pool, table: str = "messages") -> int:  # Slow! Only used to periodically reconcile message_cache_counter.
+    async with acquire(pool) as conn:
         num_of_rows = await conn.fetchval("SELECT COUNT(*) FROM messages")
         return num_of_rows
 
@@ -408,14 +796,14 @@ class BannedUser:
 @db_deco
 async def add_banned_system(pool: asyncpg.pool.Pool, sid: int, system_id: str, user_id: int):
     """Adds a banned system and an associated Discord User ID to the banned systems table."""
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("""INSERT INTO banned_systems(server_id, user_id, system_id) VALUES($1, $2, $3)""", sid, user_id, system_id)
 
 
 @db_deco
 async def get_banned_system(pool: asyncpg.pool.Pool, server_id: int, system_id: str) -> List[BannedUser]:
     """Returns a list of known Discord user IDs that are linked to the given system ID."""
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         raw_rows = await conn.fetch(" SELECT * from banned_systems where server_id = $1 AND system_id = $2", server_id, system_id)
         banned_users = [BannedUser(**row) for row in raw_rows]
         return banned_users
@@ -424,7 +812,7 @@ async def get_banned_system(pool: asyncpg.pool.Pool, server_id: int, system_id:
 @db_deco
 async def get_banned_system_by_discordid(pool: asyncpg.pool.Pool, server_id: int, user_id: str) -> List[BannedUser]:
     """Returns a list of known Discord user IDs that are linked to the given system ID."""
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         # TODO: Optimise this to use only 1 DB call.
         row = await conn.fetchrow(" SELECT * from banned_systems where server_id = $1 AND user_id = $2", server_id, user_id)
         if row is None:
@@ -440,32 +828,122 @@ async def get_banned_system_by_discordid(pool: asyncpg.pool.Pool, server_id: int
 # @db_deco
 # async def remove_banned_user(pool: asyncpg.pool.Pool, sid: int, user_id: str):
 #     """Removes a discord account from the banned systems table"""
-#     async with pool.acquire() as conn:
+#     async with acquire(pool) as conn:
 #         await conn.execute("DELETE FROM banned_systems WHERE server_id = $1 AND user_id = $2", sid, user_id)
 
 
 @db_deco
 async def remove_banned_system(pool: asyncpg.pool.Pool, sid: int, system_id: str):
     """Removes a system and all associated discord accounts from the banned systems table"""
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute("DELETE FROM banned_systems WHERE server_id = $1 AND system_id = $2", sid, system_id)
 
 
 @db_deco
 async def any_banned_systems(pool: asyncpg.pool.Pool, sid: int) -> bool:
     """Check to see if there are any banned systems in the guild specified."""
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         response = await conn.fetchval("select exists(select 1 from banned_systems where server_id = $1)", sid)
         return response
 
 
+# ----- Log Webhook DB Functions ----- #
+
+@dataclass
+class LogWebhook:
+    server_id: int
+    channel_id: int
+    webhook_id: int
+    webhook_token: str
+
+
+@db_deco
+async def get_log_webhook(pool, channel_id: int) -> Optional[LogWebhook]:
+    async with acquire(pool) as conn:
+        row = await conn.fetchrow("SELECT * FROM log_webhooks WHERE channel_id = $1", channel_id)
+        return LogWebhook(**row) if row is not None else None
+
+
+@db_deco
+async def set_log_webhook(pool, sid: int, channel_id: int, webhook_id: int, webhook_token: str):
+    async with acquire(pool) as conn:
+        await ensure_server_exists(conn, sid)
+        await conn.execute("""
+                            INSERT INTO log_webhooks(server_id, channel_id, webhook_id, webhook_token) VALUES($1, $2, $3, $4)
+                            ON CONFLICT (channel_id)
+                            DO UPDATE
+                            SET webhook_id = EXCLUDED.webhook_id, webhook_token = EXCLUDED.webhook_token
+                            """, sid, channel_id, webhook_id, webhook_token)
+
+
+@db_deco
+async def remove_log_webhook(pool, channel_id: int):
+    async with acquire(pool) as conn:
+        await conn.execute("DELETE FROM log_webhooks WHERE channel_id = $1", channel_id)
+
+
+# ----- Log Outbox DB Functions ----- #
+
+@dataclass
+class OutboxLog:
+    id: int
+    server_id: int
+    channel_id: int
+    event_type: str
+    payload: Dict  # The embed, as produced by discord.Embed.to_dict()
+    attempts: int
+    created_at: datetime
+    next_attempt: datetime
+
+
+@db_deco
+async def add_outbox_log(pool, sid: int, channel_id: int, event_type: str, payload: Dict, claim_seconds: int) -> int:
+    """Persists a log until it's delivered. The background sender leaves it alone for claim_seconds to give the direct send a chance.
+    Returns the ID of the outbox entry."""
+    async with acquire(pool) as conn:
+        return await conn.fetchval("""
+            INSERT INTO log_outbox(server_id, channel_id, event_type, payload, next_attempt)
+            VALUES($1, $2, $3, $4, NOW() + make_interval(secs => $5))
+            RETURNING id""", sid, channel_id, event_type, payload, claim_seconds)
+
+
+@db_deco
+async def remove_outbox_log(pool, log_id: int):
+    async with acquire(pool) as conn:
+        await conn.execute("DELETE FROM log_outbox WHERE id = $1", log_id)
+
+
+@db_deco
+async def retry_outbox_log(pool, log_id: int, delay_seconds: int):
+    async with acquire(pool) as conn:
+        await conn.execute("UPDATE log_outbox SET attempts = attempts + 1, next_attempt = NOW() + make_interval(secs => $2) WHERE id = $1",
+                           log_id, delay_seconds)
+
+
+@db_deco
+async def claim_due_outbox_logs(pool, limit: int, claim_seconds: int) -> List[OutboxLog]:
+    """Gets the oldest logs that are due for delivery, and pushes their next attempt back by claim_seconds so they aren't picked up twice."""
+    async with acquire(pool) as conn:
+        rows = await conn.fetch("""
+            UPDATE log_outbox SET next_attempt = NOW() + make_interval(secs => $2)
+            WHERE id IN (SELECT id FROM log_outbox WHERE next_attempt <= NOW() ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED)
+            RETURNING *""", limit, claim_seconds)
+        return sorted((OutboxLog(**row) for row in rows), key=lambda outbox_log: outbox_log.id)
+
+
+@db_deco
+async def get_outbox_size(pool) -> int:
+    async with acquire(pool) as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM log_outbox")
+
+
 # ----- Debugging DB Functions ----- #
 
 @db_deco
 async def get_cached_messages_older_than(pool, hours: int):
     # This command is limited only to servers that we are Admin/Owner of for privacy reasons.
     # Servers: GGB, PN, AS
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         now = datetime.now()
         offset = timedelta(hours=hours)
         before = now - offset
@@ -475,14 +953,103 @@ async def get_cached_messages_older_than(pool, hours: int):
 
 @db_deco
 async def fetch_full_table(pool, table: str) -> List[int]:  # good
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         raw_rows = await conn.fetch('SELECT * FROM {}'.format(table))
     return raw_rows
 
 
-async def create_tables(pool):
+async def set_message_cache_storage(conn: asyncpg.connection.Connection, unlogged: bool):
+    """
+    Switches the message cache (messages & attachment_refs) between regular and UNLOGGED tables.
+    UNLOGGED tables skip the WAL, making cache writes much cheaper, but are truncated after a crash.
+    That's fine for the message cache as losing it only degrades logs. Everything else stays in regular tables.
+    Changing modes rewrites the tables, so it's only done when the mode actually changes.
+    """
+    persistence = await conn.fetchval("SELECT relpersistence FROM pg_class WHERE oid = 'messages'::regclass")
+    if persistence == ('u' if unlogged else 'p'):
+        return
+
+    log.warning(f"Switching the message cache to {'UNLOGGED' if unlogged else 'LOGGED'} tables.")
+    # Logged tables can not reference unlogged tables, so the order matters here.
+    async with conn.transaction():
+        if unlogged:
+            await conn.execute("ALTER TABLE attachment_refs SET UNLOGGED")
+            await conn.execute("ALTER TABLE messages SET UNLOGGED")
+        else:
+            await conn.execute("ALTER TABLE messages SET LOGGED")
+            await conn.execute("ALTER TABLE attachment_refs SET LOGGED")
+
+
+@db_deco
+async def benchmark_message_cache_writes(pool, unlogged: bool, count: int) -> Dict[str, float]:
+    """
+    Times the message cache write pattern (one INSERT, UPDATE and DELETE statement per message, each in it's own transaction)
+    against a scratch copy of the messages table. Returns the seconds taken for each type of statement.
+    """
+    table = "bench_messages_unlogged" if unlogged else "bench_messages_logged"
+    content = "A fairly typical message that someone might send in a busy channel. " * 2
+    timings = {}
+    async with acquire(pool) as conn:
+        await conn.execute(f"DROP TABLE IF EXISTS {table}")
+        await conn.execute(f"CREATE {'UNLOGGED' if unlogged else ''} TABLE {table} (LIKE messages INCLUDING DEFAULTS INCLUDING INDEXES)")
+        try:
+            start = time.perf_counter()
+            for message_id in range(count):
+                await conn.execute(f"INSERT INTO {table}(server_id, message_id, user_id, content) VALUES($1, $2, $3, $4)", 0, message_id, 0, content)
+            timings['insert'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for message_id in range(count):
+                await conn.execute(f"UPDATE {table} SET attachments = array_append(attachments, $2) WHERE message_id = $1", message_id, "attachment.png")
+            timings['update'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for message_id in range(count):
+                await conn.execute(f"DELETE FROM {table} WHERE message_id = $1", message_id)
+            timings['delete'] = time.perf_counter() - start
+        finally:
+            await conn.execute(f"DROP TABLE IF EXISTS {table}")
+    return timings
+
+
+@db_deco
+async def benchmark_prepared_statements(pool, count: int) -> Dict[str, Dict[str, float]]:
+    """
+    Times the read only hot path statements run as query text through asyncpg's implicit statement cache (how queries were run before)
+    against the same statements from the connections prepared statement registry. Returns the seconds taken for each.
+    The delete statements are run against message IDs that can't exist so nothing is actually removed.
+    """
+    statements = {
+        'get_cached_message': (1,),
+        'get_server_log_configs': (1,),
+        'delete_cached_message_refs': ([-1],),
+    }
+    timings = {}
+    async with acquire(pool) as conn:
+        registry: Optional[PreparedStatements] = getattr(conn, 'prepared_statements', None)
+        if registry is None:
+            raise RuntimeError("The pool connections don't have a prepared statement registry.")
+
+        for name, args in statements.items():
+            query = PREPARED_STATEMENTS[name]
+            await conn.fetch(query, *args)  # Warm up the implicit cache so both sides are compared with a prepared plan available.
+            start = time.perf_counter()
+            for _ in range(count):
+                await conn.fetch(query, *args)
+            implicit = time.perf_counter() - start
+
+            statement = await registry.get(name)
+            start = time.perf_counter()
+            for _ in range(count):
+                await statement.fetch(*args)
+            registered = time.perf_counter() - start
+            timings[name] = {'implicit': implicit, 'registry': registered}
+    return timings
+
+
+async def create_tables(pool, unlogged_message_cache: bool = False):
     # Create servers table
-    async with pool.acquire() as conn:
+    async with acquire(pool) as conn:
         await conn.execute('''
                            CREATE TABLE if not exists servers(
                                server_id       BIGINT PRIMARY KEY,
@@ -572,6 +1139,7 @@ async def create_tables(pool):
                                server_id            BIGINT NOT NULL REFERENCES servers(server_id) ON DELETE CASCADE,
                                user_id              BIGINT NOT NULL,
                                content              TEXT DEFAULT NULL,
+                               content_compressed   BYTEA DEFAULT NULL,
                                attachments          TEXT[] DEFAULT NULL,
                                ts                   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
                                webhook_author_name  TEXT DEFAULT NULL,
@@ -580,6 +1148,32 @@ async def create_tables(pool):
                                pk_system_account_id BIGINT DEFAULT NULL
                            )
                        ''')
+        await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_compressed BYTEA DEFAULT NULL")
+
+        # Create the attachment blob tables.
+        # Attachments in the image cache are stored once per unique file (by SHA-256).
+        # Each cached message that has an attachment holds a ref to the blob, which is removed along with the message.
+        await conn.execute('''
+                           CREATE TABLE if not exists attachment_blobs(
+                               digest       TEXT PRIMARY KEY,
+                               size         BIGINT NOT NULL,
+                               last_used    TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                           )
+                       ''')
+
+        await conn.execute('''
+                           CREATE TABLE if not exists attachment_refs(
+                               message_id   BIGINT NOT NULL REFERENCES messages(message_id) ON DELETE CASCADE,
+                               server_id    BIGINT NOT NULL,
+                               digest       TEXT NOT NULL REFERENCES attachment_blobs(digest),
+                               PRIMARY KEY (message_id, digest)
+                           )
+                       ''')
+        await conn.execute("CREATE INDEX if not exists attachment_refs_digest_idx ON attachment_refs(digest)")
+        await conn.execute("CREATE INDEX if not exists attachment_refs_server_id_idx ON attachment_refs(server_id)")
+        await conn.execute("CREATE INDEX if not exists attachment_blobs_last_used_idx ON attachment_blobs(last_used)")
+
+        await set_message_cache_storage(conn, unlogged_message_cache)
 
         # Create banned users table
         await conn.execute('''
@@ -591,5 +1185,30 @@ async def create_tables(pool):
                            )
                        ''')
 
+        # Create the outbox logs are kept in until they have been delivered.
+        await conn.execute('''
+                           CREATE TABLE if not exists log_outbox(
+                               id            BIGSERIAL PRIMARY KEY,
+                               server_id     BIGINT NOT NULL,
+                               channel_id    BIGINT NOT NULL,
+                               event_type    TEXT NOT NULL,
+                               payload       JSON NOT NULL,
+                               attempts      INT NOT NULL DEFAULT 0,
+                               created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                               next_attempt  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                           )
+                       ''')
+        await conn.execute("CREATE INDEX if not exists log_outbox_next_attempt_idx ON log_outbox(next_attempt)")
+
+        # Create the table of webhooks used to deliver logs when log_delivery is set to webhook.
+        await conn.execute('''
+                           CREATE TABLE if not exists log_webhooks(
+                               channel_id    BIGINT PRIMARY KEY,
+                               server_id     BIGINT NOT NULL REFERENCES servers(server_id) ON DELETE CASCADE,
+                               webhook_id    BIGINT NOT NULL,
+                               webhook_token TEXT NOT NULL
+                           )
+                       ''')
+
 
 
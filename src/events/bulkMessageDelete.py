@@ -9,11 +9,13 @@ Part of the Gabby Gums Discord Logger.
 import asyncio
 import time
 import logging
+import zipfile
 
-from io import StringIO
+from functools import partial
 from random import randint
+from collections import deque
 from datetime import datetime
-from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple, Match, Pattern
+from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple, Match, Pattern, Deque
 
 import discord
 from discord.ext import commands
@@ -23,8 +25,11 @@ from jinja2 import Markup, escape
 
 
 import db
+import miscUtils
 # import utils
 import utils.chatArchiver as chatArchiver
+from utils import tracing
+from utils.imageCache import MAX_FILES_PER_MESSAGE, UPLOAD_SIZE_HEADROOM
 from utils.discordMarkdownParser import markdown
 import eCommands
 
@@ -33,6 +38,32 @@ if TYPE_CHECKING:
 
 log = logging.getLogger(__name__)
 
+HISTORY_PAGE_SIZE = 100  # Number of messages Discord returns per history request.
+HISTORY_PIPELINE_DEPTH = 2  # Max number of fetched history pages waiting on the DB during an archive.
+MAX_ARCHIVE_MESSAGES = 10000
+MAX_COMPRESSED_ARCHIVE_MESSAGES = 50000
+
+BULK_DELETE_COALESCE_WINDOW = 2.0  # Seconds without a new bulk delete in a channel before its archive is generated.
+BULK_DELETE_MAX_WAIT = 10.0  # Max seconds a bulk delete will be held back while waiting for more deletes in the same channel.
+BULK_DELETE_MAX_MESSAGES = 2500  # Generate the archive early once this many deleted messages have been collected.
+
+
+def batch_upload_files(archive_files: List[chatArchiver.ArchiveFile], max_upload_size: int) -> List[List[chatArchiver.ArchiveFile]]:
+    """Packs the archive files (in order) into batches that fit within a single message upload."""
+    batches = []
+    batch = []
+    batch_size = 0
+    for archive_file in archive_files:
+        if len(batch) > 0 and (len(batch) >= MAX_FILES_PER_MESSAGE or batch_size + archive_file.size > max_upload_size):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(archive_file)
+        batch_size += archive_file.size
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
 
 class CannotReadMessageHistory(Exception):
     def __init__(self):
@@ -233,6 +264,10 @@ class MessageGroup:
         self.messages = [message]
         self.uncached_group = (not message.exists)
         self.author = message.author
+        self.build_header(message)
+
+    def build_header(self, message: CompositeMessage):
+        """Sets the info displayed at the top of the group from the first (oldest) message in the group."""
         self.created_at = message.created_at or FakeDateTime()
         self.author_pfp = message.author_pfp
         self.author_username = message.user_name_and_discrim
@@ -255,14 +290,27 @@ class MessageGroup:
         return len(self.messages)
 
 
-    def append(self, message: CompositeMessage):
+    def belongs_in_group(self, message: CompositeMessage) -> bool:
+        """Returns True if the message can be grouped with the messages already in this group."""
         if not message.exists and self.uncached_group:
             # Handle uncached messages specially.
-            self.messages.append(message)
-        elif message.author is not None and self.author is not None and self.author.id == self.author.id and message.author.name == self.author.name:
-            self.messages.append(message)
-        else:
+            return True
+        return message.author is not None and self.author is not None and message.author.id == self.author.id and message.author.name == self.author.name
+
+
+    def append(self, message: CompositeMessage):
+        if not self.belongs_in_group(message):
             raise ValueError
+        self.messages.append(message)
+
+
+    def prepend(self, message: CompositeMessage):
+        """Adds a message that is older than every message currently in the group.
+        The group header (timestamp & PK info) always comes from the oldest message, so it gets rebuilt here."""
+        if not self.belongs_in_group(message):
+            raise ValueError
+        self.messages.insert(0, message)
+        self.build_header(message)
 
     # @property
     # def content(self) -> str:
@@ -277,16 +325,23 @@ class MessageGroups:
     """List like Class that automatically sorts CompositeMessage into appropriate the appropriate message groups"""
 
     def __init__(self):
-        self._message_groups: List[MessageGroup] = []
+        self._message_groups: Deque[MessageGroup] = deque()
 
 
     def __getitem__(self, item):
         return self._message_groups[item]
 
+    def __iter__(self):
+        return iter(self._message_groups)
+
     def len(self):
         # TODO: Return total number of individual messages
         return len(self._message_groups)
 
+    @property
+    def first_message_group(self) -> MessageGroup:
+        return self._message_groups[0]
+
     @property
     def last_message_group(self) -> MessageGroup:
         return self._message_groups[-1]
@@ -300,6 +355,17 @@ class MessageGroups:
             except ValueError:
                 self._message_groups.append(MessageGroup(message))
 
+    def prepend(self, message: CompositeMessage):
+        """Same as append() but for a message that is older than every message currently stored.
+        Used when messages are being received newest first (e.g. from channel.history())"""
+        if len(self._message_groups) == 0:
+            self._message_groups.appendleft(MessageGroup(message))
+        else:
+            try:
+                self.first_message_group.prepend(message)
+            except ValueError:
+                self._message_groups.appendleft(MessageGroup(message))
+
 
 class Archive(commands.Cog):
     def __init__(self, bot: 'GGBot'):
@@ -373,79 +439,161 @@ class Archive(commands.Cog):
     @eCommands.command(name="archive",
                        brief="Creates an archive file for the number of messages specified.",
                        description="Creates an archive file for the number of messages specified.",
-                       usage="<# of messages to archive> [Channel] [Message ID]",
-                       examples=["100", "50 #main", "75 123456789123456789", "75 #main 987654321987654321"])
-    async def archive(self, ctx: commands.Context, number_of_msg: int, channel: Optional[discord.TextChannel], message_id: Optional[int]):
+                       usage="<# of messages to archive> [Channel] [Message ID] [gzip/zip]",
+                       examples=["100", "50 #main", "75 123456789123456789", "75 #main 987654321987654321", "25000 #main zip"])
+    async def archive(self, ctx: commands.Context, number_of_msg: int, channel: Optional[discord.TextChannel], message_id: Optional[int], compression: Optional[str]):
         """This command creates a HTML archive of a discord channel. To use this command, you must include the number of messages you wish to archive.
 
         By default it archives the channel the command is used in starting from the last posted message.
         However, you may specify what channel you want to archive by including the channel in the `[Channel]` field.
-        Additionally, if you have included a channel, you may also choose a different message to start archiving from by including the message ID in the `[Message ID]` field."""
+        Additionally, if you have included a channel, you may also choose a different message to start archiving from by including the message ID in the `[Message ID]` field.
+        Large archives are split into multiple linked parts. Adding `gzip` or `zip` to the end of the command compresses the archive, which allows for much larger archives."""
 
         if channel is None:
             channel: discord.TextChannel = ctx.channel
 
         timestamp = discord.Object(message_id) if message_id is not None else ctx.message
 
+        if compression is not None:
+            compression = compression.lower()
+            compression = "gzip" if compression == "gz" else compression
+            if compression not in chatArchiver.COMPRESSION_MODES:
+                await ctx.send(f"⚠ `{compression}` is not a valid compression type. Please use `gzip` or `zip`.")
+                return
+
         # Check for permissions
         permissions: discord.Permissions = ctx.channel.permissions_for(ctx.guild.me)
         if not permissions.read_message_history:
             raise CannotReadMessageHistory
 
-        if number_of_msg > 10000:
-            await ctx.send(f"The maximum number of achievable messages is 10000!")
-            number_of_msg = 10000
+        max_msgs = MAX_COMPRESSED_ARCHIVE_MESSAGES if compression is not None else MAX_ARCHIVE_MESSAGES
+        if number_of_msg > max_msgs:
+            await ctx.send(f"The maximum number of achievable messages is {max_msgs}!")
+            number_of_msg = max_msgs
 
         # Todo: Figure out the best number of max number of msg (Maybe User/Guild Daily Maximum?)
         # Todo: Add archive specific max concurancy error handling
 
+        with tracing.trace("archive", guild=ctx.guild.id, messages=number_of_msg, compression=compression):
+            await self.build_and_send_archive(ctx, channel, number_of_msg, timestamp, compression)
+
+
+    async def build_and_send_archive(self, ctx: commands.Context, channel: discord.TextChannel, number_of_msg: int, timestamp, compression: Optional[str]):
         start_time = time.perf_counter()
-        hist_start_time = time.perf_counter()
         async with ctx.channel.typing():
             # Construct CompositeMessages with the history we just got and DB data.
             message_groups: MessageGroups = MessageGroups()
-            actual_msg_count = 0
-            # Get the specified num of messages from this channel BEFORE the command was sent.
 
-            # flatten Implementation
-            messages = await channel.history(limit=number_of_msg, before=timestamp, oldest_first=False).flatten()
-            messages.reverse()
-            hist_end_time = time.perf_counter()
-            db_start_time = time.perf_counter()
-
-            async with self.bot.db_pool.acquire() as conn:  # Acquire the connection here so it only has to be done once for ALL the get_cached_message DB calls.
-                for msg in messages:
-                    actual_msg_count += 1
-                    db_msg = await db.get_cached_message_for_archive(conn, ctx.guild.id, msg.id)
-                    comp_msg = CompositeMessage(self.bot, msg.id, msg, db_msg)
-                    message_groups.append(comp_msg)
-            db_time = time.perf_counter() - db_start_time
+            # Get the specified num of messages from this channel BEFORE the command was sent.
+            # History pages are fetched in a separate task while the previous page is being enriched from the DB.
+            page_queue: asyncio.Queue = asyncio.Queue(maxsize=HISTORY_PIPELINE_DEPTH)
+            fetch_task = self.bot.loop.create_task(self.fetch_history_pages(channel, number_of_msg, timestamp, page_queue))
+            try:
+                actual_msg_count, db_time = await self.enrich_history_pages(ctx.guild.id, page_queue, message_groups)
+                hist_time = await fetch_task
+            finally:
+                if not fetch_task.done():
+                    fetch_task.cancel()
+            pipeline_time = time.perf_counter() - start_time
+        # History and DB fetches overlap, so these stages both start at the beginning of the pipeline.
+        tracing.add_stage("history_fetch", start_time, hist_time * 1000)
+        tracing.add_stage("cache_fetch", start_time, db_time * 1000)
 
         archive_start_time = time.perf_counter()
+        max_file_size = ctx.guild.filesize_limit - UPLOAD_SIZE_HEADROOM
+        with tracing.stage("archive_build"):
+            archive_files = await chatArchiver.generate_html_archive_parts(self.bot, channel, message_groups, self.bot.hmac_key,
+                                                                           max_file_size, compression)
+        archive_end_time = time.perf_counter()
 
-        with await chatArchiver.generate_html_archive(self.bot, channel, message_groups, actual_msg_count) as archive_file:
-            archive_end_time = time.perf_counter()
+        end_time = time.perf_counter()
+        log.info(f"hist: {hist_time:.2f}, DB: {db_time:.2f}, hist+DB pipeline: {pipeline_time:.2f}, archive (incl. HMAC & hash): {(archive_end_time-archive_start_time):.2f}, parts: {len(archive_files)}")
 
-            hmac_start = time.perf_counter()
-            chatArchiver.write_hmac(archive_file, security_key=self.bot.hmac_key)
-            log.info(f"HMAC: {(time.perf_counter()-hmac_start):.2f}")
+        with tracing.stage("send"):
+            await self.send_archive_files(ctx, archive_files, actual_msg_count, end_time - start_time, max_file_size)
 
-            hash_start_time = time.perf_counter()
-            sha_hash = chatArchiver.generate_SHA256_hash(archive_file)
-            hash_end_time = time.perf_counter()
 
-            file_name = f"{channel.name} - Archive.html"
-            end_time = time.perf_counter()
-            log.info(f"hist: {(hist_end_time-hist_start_time):.2f}, DB: {db_time:.2f}, archive: {(archive_end_time-archive_start_time):.2f}, hash: {(hash_end_time-hash_start_time):.2f}")
-            await ctx.send(f"Archived {actual_msg_count} messages in {(end_time - start_time):.2f} seconds.\n"
-                           f"SHA-256 Hash: `{sha_hash}`",
-                           file=discord.File(archive_file, filename=file_name))
+    @staticmethod
+    async def send_archive_files(ctx: commands.Context, archive_files: List[chatArchiver.ArchiveFile], actual_msg_count: int, elapsed: float, max_file_size: int):
+        if len(archive_files) == 1:
+            archive_file = archive_files[0]
+            await ctx.send(f"Archived {actual_msg_count} messages in {elapsed:.2f} seconds.\n"
+                           f"SHA-256 Hash: `{archive_file.sha256}`",
+                           file=discord.File(archive_file.file, filename=archive_file.filename))
+            return
+
+        await ctx.send(f"Archived {actual_msg_count} messages in {elapsed:.2f} seconds. "
+                       f"The archive was split into {len(archive_files)} files.")
+        for batch in batch_upload_files(archive_files, max_file_size):
+            hashes = "\n".join(f"`{archive_file.filename}` SHA-256 Hash: `{archive_file.sha256}`" for archive_file in batch)
+            await ctx.send(hashes, files=[discord.File(archive_file.file, filename=archive_file.filename) for archive_file in batch])
 
         # For debugging.
         # chatArchiver.save_html_archive(channel, message_groups, len(messages))
         # end_time = time.perf_counter()
         # log.info(f"Archived {number_of_msg} messages in {(end_time - start_time):.2f}s for storage in {ctx.guild.id}.")
 
+    @staticmethod
+    async def fetch_history_pages(channel: discord.TextChannel, limit: int, before, page_queue: asyncio.Queue) -> float:
+        """
+        Producer half of the archive pipeline.
+        Pulls the channel history (newest first) and puts it on the page_queue in lists of up to HISTORY_PAGE_SIZE messages.
+        A None is put on the queue once the history is exhausted. If fetching fails, the exception is put on the queue instead.
+
+        Returns the time (in seconds) spent waiting on Discord.
+        """
+        fetch_time = 0.0
+        page: List[discord.Message] = []
+        try:
+            page_start = time.perf_counter()
+            async for msg in channel.history(limit=limit, before=before, oldest_first=False):
+                page.append(msg)
+                if len(page) >= HISTORY_PAGE_SIZE:
+                    fetch_time += time.perf_counter() - page_start
+                    await page_queue.put(page)  # Blocks while the DB side is behind, keeping memory use bounded.
+                    page = []
+                    page_start = time.perf_counter()
+
+            fetch_time += time.perf_counter() - page_start
+            if len(page) > 0:
+                await page_queue.put(page)
+            await page_queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await page_queue.put(e)
+        return fetch_time
+
+
+    async def enrich_history_pages(self, guild_id: int, page_queue: asyncio.Queue, message_groups: MessageGroups) -> Tuple[int, float]:
+        """
+        Consumer half of the archive pipeline.
+        Enriches each page from fetch_history_pages with one batched DB query and adds the resulting CompositeMessages to message_groups.
+
+        Returns the number of messages archived and the time (in seconds) spent on the DB.
+        """
+        msg_count = 0
+        db_time = 0.0
+        while True:
+            page = await page_queue.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+
+            # A connection is only taken from the pool per page, so it isn't held while we wait on Discord for the next one.
+            db_start_time = time.perf_counter()
+            db_msgs = await db.get_cached_messages_for_archive(self.bot.db_pool, guild_id, [msg.id for msg in page]) or {}
+            db_time += time.perf_counter() - db_start_time
+
+            # Pages arrive newest first, so each message is older than everything already in message_groups.
+            for msg in page:
+                message_groups.prepend(CompositeMessage(self.bot, msg.id, msg, db_msgs.get(msg.id)))
+            msg_count += len(page)
+
+        return msg_count, db_time
+
+
     # TODO: Move to a commands cog once CompositeMessage is in it's own file.
     @commands.cooldown(rate=1, per=10, type=commands.BucketType.guild)
     @commands.max_concurrency(1, per=commands.BucketType.guild, wait=False)
@@ -458,44 +606,62 @@ class Archive(commands.Cog):
         """This command is able to verify that an archive file has not been tampered with or altered in any way. This can be very useful for using the archive files to file reports with other server administrators.
 
         To use this command, simply upload an archive file while using the command.
+        Compressed (gzip/zip) archives and multiple parts of a split archive can be uploaded at once and each part will be verified.
         """
         message: discord.Message = ctx.message
         if len(message.attachments) == 0:
             await ctx.send("No archive file uploaded!")
             return
         try:
-            authentic = await self.verify_archive_file(ctx.message)
+            results = await self.verify_archive_file(ctx.message)
         except CouldNotDownloadFile:
             await ctx.send("Could not retrieve the uploaded archive file. Discord may be having problems. Please try again in a little bit.")
             return
 
-        if authentic is None:
-            await ctx.send("Could not retrieve the uploaded archive file. Discord may be having problems. Please try again in a little bit.")
+        if len(results) == 0:
+            await ctx.send("Could not find any archive files in the uploaded file.")
             return
-        elif authentic:
-            await ctx.message.add_reaction("✅")
-            await ctx.send("✅ The archive file is unmodified!!!")
+        elif len(results) == 1:
+            authentic = list(results.values())[0]
+            if authentic is None:
+                await ctx.send("⚠ The archive file is too large to verify!!!")
+            elif authentic:
+                await ctx.message.add_reaction("✅")
+                await ctx.send("✅ The archive file is unmodified!!!")
+            else:
+                await ctx.message.add_reaction("❌")
+                await ctx.send("❌ The archive file has been modified!!!")
         else:
-            await ctx.message.add_reaction("❌")
-            await ctx.send("❌ The archive file has been modified!!!")
+            # Multi-part archive. Report on each part.
+            all_authentic = all(results.values())
+            await ctx.message.add_reaction("✅" if all_authentic else "❌")
+            statuses = {True: "✅ Unmodified", False: "❌ Modified", None: "⚠ Too large to verify"}
+            msg = "\n".join(f"{statuses[authentic]}: `{name}`" for name, authentic in results.items())
+            await miscUtils.send_long_msg(ctx, msg)
 
 
-    async def verify_archive_file(self, message: discord.Message) -> Optional[bool]:
+    async def verify_archive_file(self, message: discord.Message) -> Dict[str, Optional[bool]]:
+        """Verifies every archive part in every file attached to the message. (html, html.gz, & zip files are supported)
+        Returns a dict of the archive part names and whether they are authentic, or None if they were too large to verify."""
 
-        file: discord.Attachment = message.attachments[0]
-        archive = StringIO()
-
-        try:
-            file_bytes = await file.read()
-            written = archive.write(file_bytes.decode("utf-8"))
-        except (discord.HTTPException, discord.NotFound):
-            raise CouldNotDownloadFile()
+        results = {}
+        for file in message.attachments:
+            file: discord.Attachment
+            try:
+                file_bytes = await file.read()
+            except (discord.HTTPException, discord.NotFound):
+                raise CouldNotDownloadFile()
 
-        hmac_start = time.perf_counter()
-        authentic = chatArchiver.verify_file(archive, self.bot.hmac_key)
-        log.info(f"Verification Time: {(time.perf_counter() - hmac_start):.2f}")
+            hmac_start = time.perf_counter()
+            try:
+                fn = partial(chatArchiver.verify_archive_upload, file.filename, file_bytes, self.bot.hmac_key)
+                results.update(await self.bot.loop.run_in_executor(None, fn))
+            except (OSError, EOFError, zipfile.BadZipFile):
+                log.info(f"Could not unpack {file.filename}")
+                results[file.filename] = False
+            log.info(f"Verification Time: {(time.perf_counter() - hmac_start):.2f}")
 
-        return authentic
+        return results
 
     # ----- Events ----- #
 
@@ -511,7 +677,7 @@ class Archive(commands.Cog):
     #         file_name_parts = attachment.filename.split(".")  # split up the file name/extention
     #         if len(file_name_parts) > 1 and file_name_parts[-1].lower() == "html":  # Make sure it's an HTML file.
     #             try:
-    #                 authentic = await self.verify_archive_file(message)
+    #                 authentic = all((await self.verify_archive_file(message)).values())
     #             except (CouldNotDownloadFile, chatArchiver.CouldNotFindAuthenticationCode):
     #                 return  # If we error, do nothing.
     #
@@ -524,70 +690,172 @@ class Archive(commands.Cog):
 
 
 
+class PendingBulkDelete:
+    """Bulk deletes from a single channel that are being collected into one archive."""
+
+    def __init__(self, guild_id: int, channel_id: int):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_ids: List[int] = []
+        self.cached_messages: Dict[int, discord.Message] = {}
+        self.started = time.monotonic()
+        self.last_update = self.started
+        self.full = False
+        self.updated = asyncio.Event()
+
+    def add(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.message_ids.extend(payload.message_ids)
+        for message in payload.cached_messages:
+            self.cached_messages[message.id] = message
+        self.last_update = time.monotonic()
+        self.full = len(self.message_ids) >= BULK_DELETE_MAX_MESSAGES
+        self.updated.set()
+
+    def flush_now(self):
+        self.full = True
+        self.updated.set()
+
+    def deadline(self) -> float:
+        return min(self.last_update + BULK_DELETE_COALESCE_WINDOW, self.started + BULK_DELETE_MAX_WAIT)
+
+
 class BulkMsgDelete(commands.Cog):
     def __init__(self, bot: 'GGBot'):
         self.bot = bot
+        self.pending_deletes: Dict[int, PendingBulkDelete] = {}  # Keyed by channel ID.
+
+
+    def cog_unload(self):
+        # Don't drop anything that is still waiting to be archived.
+        for pending in self.pending_deletes.values():
+            pending.flush_now()
 
     # ----- Events ----- #
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
-        """Handles the 'on_bulk_message_delete' event."""
-        event_type = "message_delete"  # Share the Message Delete event type unless there is demand to make it it's own event type.
+        """Handles the 'on_bulk_message_delete' event.
+        Purges emit many of these events back to back for the same channel, so they are collected for a short time and logged as a single archive."""
 
         if payload.guild_id is None:  # In DMs
             return
 
+        pending = self.pending_deletes.get(payload.channel_id)
+        if pending is None:
+            pending = PendingBulkDelete(payload.guild_id, payload.channel_id)
+            self.pending_deletes[payload.channel_id] = pending
+            self.bot.loop.create_task(self.wait_for_bulk_deletes(pending))
+
+        pending.add(payload)
+        if pending.full:
+            # Any further deletes in this channel go into a new archive.
+            self.pending_deletes.pop(payload.channel_id, None)
+
+
+    async def wait_for_bulk_deletes(self, pending: PendingBulkDelete):
+        """Waits until no more bulk deletes have come in for the channel (or the max wait/size has been hit) and then logs them."""
+        while not pending.full:
+            remaining = pending.deadline() - time.monotonic()
+            if remaining <= 0:
+                break
+            pending.updated.clear()
+            try:
+                await asyncio.wait_for(pending.updated.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.pending_deletes.get(pending.channel_id) is pending:
+            del self.pending_deletes[pending.channel_id]
+
+        # Building the archive is the expensive part, so it waits it's turn with the other guilds' events.
+        self.bot.event_scheduler.submit(self.archive_bulk_deletes, "bulk_message_delete_archive", pending)
+
+
+    async def archive_bulk_deletes(self, pending: PendingBulkDelete):
+        """Run by the event scheduler, which gives it it's own trace and reports any errors."""
+        tracing.tag(guild=pending.guild_id, messages=len(pending.message_ids))
+        # Run all the DB queries for this archive on one connection.
+        async with db.unit_of_work(self.bot.db_pool) as uow:
+            await self.log_bulk_delete(pending, uow)
+
+
+    async def log_bulk_delete(self, pending: PendingBulkDelete, uow: db.UnitOfWork):
+        event_type = "message_delete"  # Share the Message Delete event type unless there is demand to make it it's own event type.
+        guild_id = pending.guild_id
+
+        msg_ids = sorted(set(pending.message_ids))  # Make sure the id's are sorted in chronological order (Thank goodness for snowflakes.)
+
+        # Pull as many messages as possible from the DB and the d.py mem cache.
+        with tracing.stage("cache_fetch"):
+            db_cached_messages = await db.get_cached_messages_for_archive(uow, guild_id, msg_ids) or {}
+
         async def cleanup_message_cache():
             if len(db_cached_messages) > 0:
-                for cached_msg in db_cached_messages:
-                    log.info(f"Cleaning msg {cached_msg.message_id} from db.")
-                    await db.delete_cached_message(self.bot.db_pool, payload.guild_id, cached_msg.message_id)
+                log.info(f"Cleaning {len(db_cached_messages)} msgs from db.")
+                released_blobs = await db.delete_cached_messages(uow, guild_id, list(db_cached_messages.keys()))
+                await uow.release()  # Done with the DB.
+                await self.bot.image_cache_evictor.release(released_blobs)
 
-        # Pull as many messages as possible from the DB and the d.py mem cache.
-        # Combine them in CompositeMessages and add them to the messages list.
-        db_cached_messages = []
-        # messages: List[CompositeMessage] = []
+        # Combine them in CompositeMessages and add them to the message groups.
         message_groups: MessageGroups = MessageGroups()
         msg_count = 0
-        msg_ids = sorted(payload.message_ids)  # Make sure the id's are sorted in chronological order (Thank goodness for snowflakes.)
         for msg_id in msg_ids:
-            db_msg = await db.get_cached_message(self.bot.db_pool, payload.guild_id, msg_id)
-            mem_msg = discord.utils.get(payload.cached_messages, id=msg_id)
-            if db_msg is not None:
-                db_cached_messages.append(db_msg)
-
-            comp_msg = CompositeMessage(self.bot, msg_id, mem_msg, db_msg)
+            comp_msg = CompositeMessage(self.bot, msg_id, pending.cached_messages.get(msg_id), db_cached_messages.get(msg_id))
             message_groups.append(comp_msg)
             msg_count += 1
-            # messages.append(comp_msg)
 
         # Check if the category we are in is ignored. If it is, bail
-        channel: discord.TextChannel = await self.bot.get_channel_safe(payload.channel_id)
-        if await self.bot.is_category_ignored(payload.guild_id, channel.category):
+        channel: discord.TextChannel = await self.bot.get_channel_safe(pending.channel_id, uow)
+        if await self.bot.is_category_ignored(guild_id, channel.category, uow):
             await cleanup_message_cache()
             return
 
-        log_channel = await self.bot.get_event_or_guild_logging_channel(payload.guild_id, event_type, channel_id=payload.channel_id)
+        log_channel = await self.bot.get_event_or_guild_logging_channel(guild_id, event_type, channel_id=pending.channel_id, pool=uow)
         if log_channel is None:
             # Silently fail if no log channel is configured.
             await cleanup_message_cache()
             return
+        await uow.release()  # Don't hold on to a connection while rendering and uploading the archive.
 
-        with await chatArchiver.generate_html_archive(self.bot, channel, message_groups, msg_count) as archive_file:
-            file_name = f"{channel.name} - Archive.html"
-            embed = self.get_bulk_delete_embed(msg_count, payload.channel_id)
-            # await log_channel.send(embed=embed, file=discord.File(archive_file, filename=file_name))
-            await self.bot.send_log(log_channel, event_type, embed=embed, file=discord.File(archive_file, filename=file_name))
+        # Purges can be coalesced into thousands of messages, so the archive is split the same way g!archive splits it.
+        max_file_size = log_channel.guild.filesize_limit - UPLOAD_SIZE_HEADROOM
+        with tracing.stage("archive_build"):
+            archive_files = await chatArchiver.generate_html_archive_parts(self.bot, channel, message_groups, self.bot.hmac_key, max_file_size)
+
+        embed = self.get_bulk_delete_embed(msg_count, pending.channel_id, len(archive_files))
+        if len(archive_files) == 1:
+            archive_file = archive_files[0]
+            await self.bot.send_log(log_channel, event_type, embed=embed, file=discord.File(archive_file.file, filename=archive_file.filename))
+        else:
+            await self.bot.send_log(log_channel, event_type, embed=embed)
+            with tracing.stage("archive_send"):
+                await self.send_archive_parts(log_channel, event_type, archive_files, max_file_size)
 
-        log.info(f"archived {msg_count} messages out of {len(payload.message_ids)} deleted messages.")
+        log.info(f"archived {msg_count} messages from {len(db_cached_messages)} cached messages.")
         await cleanup_message_cache()
 
 
+    async def send_archive_parts(self, log_channel: discord.TextChannel, event_type: str, archive_files: List[chatArchiver.ArchiveFile], max_file_size: int):
+        """Uploads the parts of a split archive, as many to a message as will fit."""
+        if not self.bot.log_permissions.can_send(log_channel, embed=False, file=True, via_log_queue=False):
+            await self.bot.log_permissions.log_lost(log_channel, event_type, "missing_permissions")
+            return
+
+        for batch in batch_upload_files(archive_files, max_file_size):
+            hashes = "\n".join(f"`{archive_file.filename}` SHA-256 Hash: `{archive_file.sha256}`" for archive_file in batch)
+            try:
+                await log_channel.send(hashes, files=[discord.File(archive_file.file, filename=archive_file.filename) for archive_file in batch])
+            except discord.HTTPException as e:
+                # Keep going so one failed upload doesn't lose the rest of the archive.
+                log.warning(f"Failed to upload {len(batch)} bulk delete archive parts to {log_channel.id}: {e}")
+
+
     @staticmethod
-    def get_bulk_delete_embed(number_deleted: int, channel_id: int):
+    def get_bulk_delete_embed(number_deleted: int, channel_id: int, parts: int = 1):
 
-        embed = discord.Embed(description=f"{number_deleted} Messages were deleted in <#{channel_id}>",
-                              color=discord.Color.purple(), timestamp=datetime.utcnow())
+        description = f"{number_deleted} Messages were deleted in <#{channel_id}>"
+        if parts > 1:
+            description += f"\nThe archive was split into {parts} files."
+        embed = discord.Embed(description=description, color=discord.Color.purple(), timestamp=datetime.utcnow())
         embed.set_author(name="Bulk Message Deletion")
         embed.set_footer(text="\N{Zero Width Space}")  # Workaround for timestamps not showing up on mobile.
 
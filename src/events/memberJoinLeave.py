@@ -23,6 +23,7 @@ import db
 from embeds import member_join, member_leave, member_kick
 from miscUtils import send_long_msg, get_audit_logs, MissingAuditLogPermissions, log_error_msg
 from utils.pluralKit import get_pk_system_from_userid, CouldNotConnectToPKAPI, UnknownPKError
+from utils import tracing
 
 if TYPE_CHECKING:
     from bot import GGBot
@@ -39,14 +40,15 @@ class MemberJoinLeave(commands.Cog):
 
         await self.bot.wait_until_ready()  # I really don't think this is necessary, but why not.
         await asyncio.sleep(1)
-        logging.info("Refreshing Invite Cache.")
+        log.info("Refreshing Invite Cache.")
         for guild in self.bot.guilds:
             await self.update_invite_cache(guild)
-        logging.info("Invite Cache Ready.")
+        log.info("Invite Cache Ready.")
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         event_type = "member_join"
+        tracing.tag(guild=member.guild.id)
         try:
             pk_response = await get_pk_system_from_userid(member.id)
         except CouldNotConnectToPKAPI:
@@ -63,13 +65,16 @@ class MemberJoinLeave(commands.Cog):
         event_type = "member_join"
 
         if member.guild.me.guild_permissions.manage_guild:
-            invite_used = await self.find_used_invite(member)
+            with tracing.stage("invite_lookup"):
+                invite_used = await self.find_used_invite(member)
             if invite_used is not None:
-                logging.info(
+                log.info(
                     "New user joined with link {} that has {} uses.".format(invite_used.invite_id, invite_used.uses))
-            embed = member_join(member, invite_used, pk_response)
+            with tracing.stage("embed_build"):
+                embed = member_join(member, invite_used, pk_response)
         else:
-            embed = member_join(member, None, pk_response, manage_guild=False)
+            with tracing.stage("embed_build"):
+                embed = member_join(member, None, pk_response, manage_guild=False)
 
         log_channel = await self.bot.get_event_or_guild_logging_channel(member.guild.id, event_type)
         if log_channel is None:
@@ -214,12 +219,8 @@ class MemberJoinLeave(commands.Cog):
             return valid_invites
 
         except discord.Forbidden as e:
-            logging.exception("update_invite_cache error: {}".format(e))
-
-            if 'error_log_channel' not in self.bot.config:
-                return
-            error_log_channel = self.bot.get_channel(self.bot.config['error_log_channel'])
-            await error_log_channel.send(e)
+            log.exception("update_invite_cache error: {}".format(e))
+            await log_error_msg(self.bot, str(e), header="[update_invite_cache]")
 
 
     async def remove_invalid_invites(self, guild_id: int, current_invites: List[discord.Invite],
@@ -314,7 +315,7 @@ class MemberJoinLeave(commands.Cog):
         log_msg = "UNABLE TO DETERMINE INVITE USED.\n Stored invites: {}, Current invites: {} \n" \
                   "Server: {}, Member: {}".format(stored_invites, current_invite_debug_msg, repr(member.guild),
                                                   repr(member))
-        logging.info(log_msg)
+        log.info(log_msg)
 
         try_again_for_current_invites: List[discord.Invite] = await member.guild.invites()
 
@@ -16,7 +16,9 @@ from discord.ext import commands
 import db
 import miscUtils
 from embeds import deleted_message_embed
+from utils.imageCache import AttachmentUpload, UPLOAD_SIZE_HEADROOM, get_attachment_uploads, shrink_oversized_uploads, plan_upload_batches
 from utils.pluralKit import get_pk_message, CouldNotConnectToPKAPI, UnknownPKError
+from utils import tracing
 
 if TYPE_CHECKING:
     from bot import GGBot
@@ -31,24 +33,33 @@ class MemberUpdate(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.guild_id is None:
+            return  # We are in a DM, Don't log the message
+
+        tracing.tag(guild=payload.guild_id)
+        # Run all the DB queries for this event on one connection.
+        async with db.unit_of_work(self.bot.db_pool) as uow:
+            await self.log_message_delete(payload, uow)
+
+
+    async def log_message_delete(self, payload: discord.RawMessageDeleteEvent, uow: db.UnitOfWork):
         event_type = "message_delete"
 
         # Exit function to ensure message is removed from the cache.
         async def cleanup_message_cache():
             if db_cached_message is not None:
-                await db.delete_cached_message(self.bot.db_pool, payload.guild_id, db_cached_message.message_id)
-
-
-        if payload.guild_id is None:
-            return  # We are in a DM, Don't log the message
+                released_blobs = await db.delete_cached_message(uow, payload.guild_id, db_cached_message.message_id)
+                await uow.release()  # Done with the DB.
+                await self.bot.image_cache_evictor.release(released_blobs)
 
         # Get the cached msg from the DB (if possible). Will be None if msg does not exist in DB
-        db_cached_message = await db.get_cached_message(self.bot.db_pool, payload.guild_id, payload.message_id)
+        with tracing.stage("cache_fetch"):
+            db_cached_message = await db.get_cached_message(uow, payload.guild_id, payload.message_id)
 
 
         # Check if the category we are in is ignored. If it is, bail
-        channel: discord.TextChannel = await self.bot.get_channel_safe(payload.channel_id)
-        if await self.bot.is_category_ignored(payload.guild_id, channel.category):
+        channel: discord.TextChannel = await self.bot.get_channel_safe(payload.channel_id, uow)
+        if await self.bot.is_category_ignored(payload.guild_id, channel.category, uow):
             await cleanup_message_cache()
             return
 
@@ -74,21 +85,22 @@ class MemberUpdate(commands.Cog):
             author_id = None
             author = None
 
+        await uow.release()  # Don't hold on to a connection while waiting on Discord or PK.
+
         # Not doing anything with this check yet. Leaving it here for now to ensure that it is reliable.
         guild: discord.Guild = self.bot.get_guild(payload.guild_id)
         if guild is not None:
             pk_is_here = await self.bot.is_pk_here(guild)
-
         try:
             pk_msg = await get_pk_message(payload.message_id)
             if pk_msg is not None and self.verify_message_is_preproxy_message(payload.message_id, pk_msg):
                 # We have confirmed that the message is a pre-proxied message.
-                await self.cache_pk_message_details(payload.guild_id, pk_msg)
+                await self.cache_pk_message_details(payload.guild_id, pk_msg, uow)
                 await cleanup_message_cache()
                 return  # Message was a pre-proxied message deleted by PluralKit. Return instead of logging message.
 
         except CouldNotConnectToPKAPI:
-            logging.warning("Could not connect to PK server with out errors. Assuming message should be logged.")
+            log.warning("Could not connect to PK server with out errors. Assuming message should be logged.")
         except UnknownPKError as e:
             await miscUtils.log_error_msg(self.bot, e)
 
@@ -100,46 +112,82 @@ class MemberUpdate(commands.Cog):
         effective_author_id = pk_system_owner.id if pk_system_owner is not None else author_id
 
         # Get the servers logging channel.
-        log_channel = await self.bot.get_event_or_guild_logging_channel(payload.guild_id, event_type, user_id=effective_author_id, channel_id=payload.channel_id)
+        log_channel = await self.bot.get_event_or_guild_logging_channel(payload.guild_id, event_type, user_id=effective_author_id, channel_id=payload.channel_id, pool=uow)
         if log_channel is None:
             # Silently fail if no log channel is configured.
             await cleanup_message_cache()
             return
 
-        attachments = self.load_attachments(db_cached_message, channel)  # Load any possible attachments
+        attachments = await self.load_attachments(db_cached_message, channel, uow)  # Load any possible attachments
 
-        embed = deleted_message_embed(message_content=msg, author=author, channel_id=channel_id,
-                                      message_id=payload.message_id, webhook_info=db_cached_message,
-                                      pk_system_owner=pk_system_owner, cached=cache_exists)
+        with tracing.stage("embed_build"):
+            embed = deleted_message_embed(message_content=msg, author=author, channel_id=channel_id,
+                                          message_id=payload.message_id, webhook_info=db_cached_message,
+                                          pk_system_owner=pk_system_owner, cached=cache_exists)
 
-        await self.bot.send_log(log_channel, event_type, embed=embed)
+        # Persist the log in the same transaction that removes the message from the cache, so a crash can't lose both.
+        released_blobs = []
+        async with uow.transaction():
+            outbox_id = await self.bot.log_outbox.add(log_channel, event_type, embed, uow)
+            if db_cached_message is not None:
+                released_blobs = await db.delete_cached_message(uow, payload.guild_id, db_cached_message.message_id) or []
+        await uow.release()  # Don't hold on to a connection while sending the logs.
+
+        await self.bot.send_log(log_channel, event_type, embed=embed, outbox_id=outbox_id)
         if len(attachments) > 0:
-            await log_channel.send(content="Deleted Attachments:",
-                                   files=attachments)  # Not going to bother using the safe log sender here yet.
+            with tracing.stage("attachment_send"):
+                await self.send_attachments(log_channel, attachments)
 
-        await cleanup_message_cache()
+        await self.bot.image_cache_evictor.release(released_blobs)  # Only now that the attachments have been sent.
 
 
-    def load_attachments(self, db_message: db.CachedMessage, channel: discord.TextChannel):
-        """Checks if we have any attachments saved on disk and returns them as a list of discord.Files"""
+    async def load_attachments(self, db_message: db.CachedMessage, channel: discord.TextChannel, pool: Optional[db.PoolOrConnection] = None) -> List[AttachmentUpload]:
+        """Checks if we have any attachments saved on disk and returns them (with their sizes) ready to be uploaded."""
 
         # Handle any attachments
-        attachments = []
-        if db_message is not None and db_message.attachments is not None:
-            for attachment_name in db_message.attachments:
-                spoil = True if "SPOILER" in attachment_name else False
-                if spoil is False:
-                    # channel = await get_channel_safe(payload.channel_id)
-                    if channel.is_nsfw():
-                        spoil = True  # Make ANY image from an NSFW board spoiled to keep log channels SFW.
+        if db_message is None or db_message.attachments is None:
+            return []
+
+        attachments = await get_attachment_uploads(self.bot, db_message.server_id, db_message.attachments, pool)
+        if channel.is_nsfw():
+            # Make ANY image from an NSFW board spoiled to keep log channels SFW.
+            attachments = [attachment._replace(spoiler=True) for attachment in attachments]
+        return attachments
+
+
+    async def send_attachments(self, log_channel: discord.TextChannel, attachments: List[AttachmentUpload]):
+        """Re-uploads the deleted attachments, split over as many messages as needed to stay under the upload limit."""
+        if not self.bot.log_permissions.can_send(log_channel, embed=False, file=True, via_log_queue=False):
+            await self.bot.log_permissions.log_lost(log_channel, "message_delete", "missing_permissions")
+            return
+
+        max_upload_size = log_channel.guild.filesize_limit - UPLOAD_SIZE_HEADROOM
+        attachments, too_big = await shrink_oversized_uploads(self.bot, attachments, max_upload_size)
+
+        for batch in plan_upload_batches(attachments, max_upload_size):
+            # Files are only opened right before they are sent. d.py closes them once the upload is done.
+            files = []
+            for attachment in batch:
                 try:
-                    # max file sizee 8000000  # TODO: Make sure that we don't send files bigger than 8000000 bytes.
-                    new_attachment = discord.File(f"./image_cache/{db_message.server_id}/{attachment_name}",
-                                                  filename=attachment_name, spoiler=spoil)
-                    attachments.append(new_attachment)
+                    files.append(attachment.to_file())
                 except FileNotFoundError:
-                    pass  # The file may have been too old and has since been deleted.
-        return attachments
+                    pass  # Evicted since we looked it up.
+            if len(files) == 0:
+                continue
+
+            try:
+                # Not going to bother using the safe log sender here yet.
+                await log_channel.send(content="Deleted Attachments:", files=files)
+            except discord.HTTPException as e:
+                # Keep going so one failed upload doesn't lose the rest of the attachments.
+                log.warning(f"Failed to upload {len(files)} deleted attachments to {log_channel.id}: {e}")
+
+        if len(too_big) > 0:
+            names = ", ".join(f"`{attachment.filename}`" for attachment in too_big)
+            try:
+                await log_channel.send(content=f"Deleted Attachments too large to upload: {names}")
+            except discord.HTTPException as e:
+                log.warning(f"Failed to list {len(too_big)} deleted attachments too large to upload in {log_channel.id}: {e}")
 
 
     def verify_message_is_preproxy_message(self, message_id: int, pk_response: Dict) -> bool:
@@ -158,7 +206,7 @@ class MemberUpdate(commands.Cog):
             return True
 
 
-    async def cache_pk_message_details(self, guild_id: int, pk_response: Dict):
+    async def cache_pk_message_details(self, guild_id: int, pk_response: Dict, pool: Optional[db.PoolOrConnection] = None):
 
         error_msg = []
         error_header = '[cache_pk_message_details]: '
@@ -168,7 +216,7 @@ class MemberUpdate(commands.Cog):
             # If we can not pull the message ID there is no point in continuing.
             msg = "'WARNING! 'id' not in PK msg API Data. Aborting JSON Decode!"
             error_msg.append(msg)
-            logging.warning(msg)
+            log.warning(msg)
             await miscUtils.log_error_msg(self.bot, error_msg, header=f"{error_header}!ERROR!")
             return
 
@@ -194,9 +242,9 @@ class MemberUpdate(commands.Cog):
             error_msg.append(msg)
 
         # TODO: Remove verbose Logging once feature deemed to be stable .
-        logging.debug(
+        log.debug(
             f"Updating msg: {message_id} with Sender ID: {sender_discord_id}, System ID: {system_pk_id}, Member ID: {member_pk_id}")
-        await db.update_cached_message_pk_details(self.bot.db_pool, guild_id, message_id, system_pk_id, member_pk_id,
+        await db.update_cached_message_pk_details(pool or self.bot.db_pool, guild_id, message_id, system_pk_id, member_pk_id,
                                                   sender_discord_id)
 
         if len(error_msg) > 0:
@@ -14,6 +14,7 @@ from discord.ext import commands
 
 import db
 from embeds import edited_message_embed
+from utils import tracing
 
 if TYPE_CHECKING:
     from bot import GGBot
@@ -39,52 +40,62 @@ class MemberUpdate(commands.Cog):
                 payload.data["guild_id"])  # guild_id needs to be typecast to int since raw payload id's are str.
             message_id = payload.message_id
 
-            db_cached_message = await db.get_cached_message(self.bot.db_pool, guild_id, payload.message_id)
-            if payload.cached_message is not None:
-                before_msg = payload.cached_message.content
-                author = payload.cached_message.author
-                author_id = author.id
-                channel_id = payload.cached_message.channel.id
-            else:
-                before_msg = db_cached_message.content if db_cached_message is not None else None
-
-                # author_id needs to be typecast to int since raw payload id's are str.
-                author_id = int(payload.data['author']['id'])
-                channel_id = payload.channel_id
-                author = None
-
-            if self.bot.user.id == author_id:
-                # This is a Gabby Gums message. Do not log the event.
-                return
-
-            if after_msg == before_msg:
-                # The message content has not changed. This is a pin/unpin, embed edit (which would be from a bot or discord)
-                return
-
-            channel: discord.TextChannel = await self.bot.get_channel_safe(channel_id)
-            if await self.bot.is_category_ignored(guild_id, channel.category):
-                return
-
-            log_channel = await self.bot.get_event_or_guild_logging_channel(guild_id, event_type, user_id=author_id, channel_id=channel_id)
-            if log_channel is None:
-                # Silently fail if no log channel is configured or if the event, user, or channel is ignored.
-                return
-
+            tracing.tag(guild=guild_id)
+            # Run all the DB queries for this event on one connection.
+            async with db.unit_of_work(self.bot.db_pool) as uow:
+                await self.log_message_edit(payload, uow, event_type, guild_id, message_id, after_msg)
+
+
+    async def log_message_edit(self, payload: discord.RawMessageUpdateEvent, uow: db.UnitOfWork, event_type: str, guild_id: int, message_id: int, after_msg: str):
+        with tracing.stage("cache_fetch"):
+            db_cached_message = await db.get_cached_message(uow, guild_id, payload.message_id)
+        if payload.cached_message is not None:
+            before_msg = payload.cached_message.content
+            author = payload.cached_message.author
+            author_id = author.id
+            channel_id = payload.cached_message.channel.id
+        else:
+            before_msg = db_cached_message.content if db_cached_message is not None else None
+
+            # author_id needs to be typecast to int since raw payload id's are str.
+            author_id = int(payload.data['author']['id'])
+            channel_id = payload.channel_id
+            author = None
+
+        if self.bot.user.id == author_id:
+            # This is a Gabby Gums message. Do not log the event.
+            return
+
+        if after_msg == before_msg:
+            # The message content has not changed. This is a pin/unpin, embed edit (which would be from a bot or discord)
+            return
+
+        channel: discord.TextChannel = await self.bot.get_channel_safe(channel_id, uow)
+        if await self.bot.is_category_ignored(guild_id, channel.category, uow):
+            return
+
+        log_channel = await self.bot.get_event_or_guild_logging_channel(guild_id, event_type, user_id=author_id, channel_id=channel_id, pool=uow)
+        if log_channel is None:
+            # Silently fail if no log channel is configured or if the event, user, or channel is ignored.
+            return
+        await uow.release()  # Don't hold on to a connection while talking to Discord.
+
+        if author is None:
+            await self.bot.wait_until_ready()
+            # TODO: Consider removing to prevent potential API call
+            author = self.bot.get_user(author_id)
             if author is None:
-                await self.bot.wait_until_ready()
-                # TODO: Consider removing to prevent potential API call
-                author = self.bot.get_user(author_id)
-                if author is None:
-                    logging.warning(f"get_user failed in raw msg_edit: {author_id}")
-                    author = await self.bot.fetch_user(author_id)
+                log.warning(f"get_user failed in raw msg_edit: {author_id}")
+                author = await self.bot.fetch_user(author_id)
 
+        with tracing.stage("embed_build"):
             embed = edited_message_embed(author_id, author.name, author.discriminator, channel_id, before_msg,
                                          after_msg, message_id, guild_id)
 
-            await self.bot.send_log(log_channel, event_type, embed=embed)
+        await self.bot.send_log(log_channel, event_type, embed=embed)
 
-            if db_cached_message is not None:
-                await db.update_cached_message(self.bot.db_pool, guild_id, payload.message_id, after_msg)
+        if db_cached_message is not None:
+            await db.update_cached_message(uow, guild_id, payload.message_id, after_msg)
 
 
 def setup(bot):
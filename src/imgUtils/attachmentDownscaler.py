@@ -0,0 +1,66 @@
+"""
+Shrinks cached image attachments that are too big to be re-uploaded to a log channel.
+Everything here is blocking and should be run in an executor.
+"""
+import os
+import math
+import logging
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+
+log = logging.getLogger(__name__)
+
+DOWNSCALE_ATTEMPTS = 4  # Number of progressively smaller sizes to try before giving up.
+DOWNSCALE_STEP = 0.75  # How much to shrink the image by after each attempt that was still too big.
+JPEG_QUALITY = 85
+
+
+def downscale_image(path: Path, max_size: int) -> Optional[Tuple[BytesIO, str]]:
+    """
+    Downscales (and if needed transcodes) the image at path so it fits in max_size bytes.
+    Images with transparency are saved as PNG, everything else as JPEG. Animated images are reduced to their first frame.
+    Returns the new image and its file extension, or None if the file is not an image or could not be made small enough.
+    """
+    try:
+        im = Image.open(path)
+    except (UnidentifiedImageError, OSError):
+        return None
+    except (Image.DecompressionBombError, ValueError) as e:
+        log.warning(f"Refusing to decode {path}: {e}")
+        return None
+
+    with im:
+        try:
+            has_alpha = im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info)
+            image_format, extension = ("PNG", ".png") if has_alpha else ("JPEG", ".jpg")
+            image = im.convert("RGBA" if has_alpha else "RGB")  # Also loads the first frame of animated images.
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            log.warning(f"Could not decode {path}: {e}")
+            return None
+
+    # Start at roughly the scale the size limit calls for and shrink from there.
+    scale = min(1.0, math.sqrt(max_size / max(os.stat(path).st_size, 1)))
+    for _ in range(DOWNSCALE_ATTEMPTS):
+        width = max(1, int(image.width * scale))
+        height = max(1, int(image.height * scale))
+        resized = image.resize((width, height), Image.LANCZOS) if scale < 1.0 else image
+
+        output = BytesIO()
+        try:
+            if image_format == "JPEG":
+                resized.save(output, image_format, quality=JPEG_QUALITY, optimize=True)
+            else:
+                resized.save(output, image_format, optimize=True)
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not encode {path}: {e}")
+            return None
+
+        if output.tell() <= max_size:
+            output.seek(0)
+            return output, extension
+        scale *= DOWNSCALE_STEP
+
+    return None
@@ -83,6 +83,7 @@ def split_text(text: Union[str, List], max_size: int = 2000, delimiter: str = "\
 async def log_error_msg(bot: 'GGBot', error_messages: Optional[Union[str, List[str], Exception]], header: Optional[str] = None, code_block: bool = False) -> bool:
     """
     Attempts to send a message to the Global Error Discord Channel.
+    Repeated errors are counted and summarized by the bots ErrorReporter instead of being posted every time.
 
     Returns False if the error_log_channel is not defined in the Config,
         if the error_log_channel can not be resolved to an actual channel, or if the message fails to send.
@@ -104,27 +105,12 @@ async def log_error_msg(bot: 'GGBot', error_messages: Optional[Union[str, List[s
         # Convert it into a single string.
         error_messages = "\n".join(error_messages)
     elif isinstance(error_messages, Exception):
-        error_messages = full_stack()
-        code_block = True  # Override code block for exceptions.
+        return await bot.error_reporter.report_exception(error_messages, full_stack(), header)
     else:
         if error_messages == "":  # Empty
             return True  # Should this be True? False isn't really accurate either....
 
-    # Try to get the channel from discord.py.
-    error_log_channel = bot.get_channel(bot.config['error_log_channel'])
-    if error_log_channel is None:
-        return False
-
-    # If the header option is used, include the header message at the front of the message
-    if header is not None:
-        error_messages = f"{header}\n{error_messages}"
-    # Attempt to send the message
-    try:
-        await send_long_msg(error_log_channel, error_messages, code_block=code_block)
-        return True
-    except discord.DiscordException as e:
-        log.exception(f"Error sending log to Global Error Discord Channel!: {e}")
-        return False
+    return await bot.error_reporter.report_text(error_messages, header, code_block)
 
 
 def full_stack():
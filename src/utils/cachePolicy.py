@@ -0,0 +1,130 @@
+"""
+Decides at ingest time if a message is worth caching.
+A message only needs to be cached if its deletion or edit would actually be logged somewhere.
+The routing configuration each guild uses for that is kept in memory so on_message doesn't need to query the DB.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import time
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Optional, Dict, Set, NamedTuple
+
+import discord
+
+import db
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+CACHED_EVENT_TYPES = ("message_delete", "message_edit")  # The events that need messages from the message cache.
+POLICY_MAX_AGE = 10 * 60  # Seconds before a guilds policy is reloaded, even if nothing told us it changed.
+
+
+class GuildCachePolicy(NamedTuple):
+    version: int  # The db.guild_config_versions value this was loaded at.
+    loaded_at: float
+    ignored_categories: Set[int]
+    channel_overrides: Dict[int, Optional[int]]  # Channel ID: Log channel ID, or None if the channel is ignored.
+    user_overrides: Dict[int, Optional[int]]  # User ID: Log channel ID, or None if the user is ignored.
+    events_routed: bool  # If message_delete or message_edit logs have somewhere to go without any overrides.
+    user_overrides_routed: bool  # If any user override sends logs to a channel.
+
+    def should_cache(self, channel_id: int, category_id: Optional[int], author_id: int, is_webhook: bool) -> bool:
+        # Mirrors the checks done by the delete and edit logs (is_category_ignored & get_event_or_guild_logging_channel).
+        if category_id is not None and category_id in self.ignored_categories:
+            return False
+
+        if is_webhook:
+            # Proxied messages are logged under the system owners account, which we don't know yet.
+            # If any user override could route it's logs somewhere, that account might be the one, so it has to be cached.
+            if self.user_overrides_routed:
+                return True
+        elif author_id in self.user_overrides:
+            return self.user_overrides[author_id] is not None
+
+        if channel_id in self.channel_overrides:
+            return self.channel_overrides[channel_id] is not None
+
+        return self.events_routed
+
+
+class MessageCachePolicy:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.policies: Dict[int, GuildCachePolicy] = {}
+        self.loading: Dict[int, asyncio.Task] = {}  # Guild ID: The load of it's policy that is in progress.
+        self.skipped = 0  # Number of messages that were not cached because nothing would log them.
+
+
+    async def should_cache(self, message: discord.Message) -> bool:
+        policy = await self.get_policy(message.guild.id)
+        if policy is None:
+            return True  # Couldn't load the config. Better to cache too much than to miss logs.
+
+        category_id = message.channel.category_id if isinstance(message.channel, discord.TextChannel) else None
+        should_cache = policy.should_cache(message.channel.id, category_id, message.author.id, message.webhook_id is not None)
+        if not should_cache:
+            self.skipped += 1
+        return should_cache
+
+
+    async def get_policy(self, guild_id: int) -> Optional[GuildCachePolicy]:
+        policy = self.policies.get(guild_id)
+        if policy is not None and policy.version == db.guild_config_versions[guild_id] and time.monotonic() - policy.loaded_at < POLICY_MAX_AGE:
+            return policy
+
+        # Every message that arrives while a guild's policy is loading would otherwise run the same queries, so they share one load.
+        loading = self.loading.get(guild_id)
+        if loading is None:
+            loading = self.bot.loop.create_task(self.load_and_store_policy(guild_id))
+            self.loading[guild_id] = loading
+        # Shielded so a cancelled message handler doesn't cancel the load for the others waiting on it.
+        return await asyncio.shield(loading)
+
+
+    async def load_and_store_policy(self, guild_id: int) -> Optional[GuildCachePolicy]:
+        try:
+            policy = await self.load_policy(guild_id)
+            if policy is not None:
+                self.policies[guild_id] = policy
+            return policy
+        finally:
+            del self.loading[guild_id]
+
+
+    async def load_policy(self, guild_id: int) -> Optional[GuildCachePolicy]:
+        version = db.guild_config_versions[guild_id]
+        pool = self.bot.db_pool
+
+        ignored_categories = await db.get_ignored_categories(pool, guild_id)
+        channel_overrides = await db.get_channel_overrides(pool, guild_id)
+        user_overrides = await db.get_users_overrides(pool, guild_id)
+        # get_log_channel can't tell a guild without a log channel apart from a failed query, so the servers row is fetched directly.
+        routing = await db.get_server_routing(pool, guild_id)
+        if ignored_categories is None or channel_overrides is None or user_overrides is None or routing is None:
+            return None  # One of the queries failed.
+        log_configs = routing.log_configs
+        log_channel_id = routing.log_channel_id
+
+        events_routed = False
+        for event_type in CACHED_EVENT_TYPES:
+            event_configs = log_configs[event_type]
+            if event_configs is not None and event_configs.enabled is False:
+                continue
+            if (event_configs is not None and event_configs.log_channel_id is not None) or log_channel_id is not None:
+                events_routed = True
+
+        return GuildCachePolicy(version, time.monotonic(), set(ignored_categories),
+                                {row['channel_id']: row['log_ch'] for row in channel_overrides},
+                                {row['user_id']: row['log_ch'] for row in user_overrides},
+                                events_routed,
+                                any(row['log_ch'] is not None for row in user_overrides))
+
+
+    def forget(self, guild_id: int):
+        self.policies.pop(guild_id, None)
@@ -4,14 +4,19 @@ Methods for generating HTML and TXT archives of a discord chat from a list of di
 Part of the Gabby Gums Discord Logger.
 """
 
+import copy
 import hmac
+import gzip
 import logging
 import hashlib
+import zipfile
 
 from functools import partial
 from datetime import datetime
-from io import StringIO, SEEK_END, SEEK_SET
-from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple, Match
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from io import StringIO, BytesIO, SEEK_END, SEEK_SET
+from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple, Match, BinaryIO
 
 import regex as re
 
@@ -20,13 +25,26 @@ from jinja2 import Template, Environment, FileSystemLoader
 from utils.discordMarkdownParser import markdown
 
 if TYPE_CHECKING:
-    from events.bulkMessageDelete import CompositeMessage, MessageGroups
+    from events.bulkMessageDelete import CompositeMessage, MessageGroups, MessageGroup
     import discord
     from discord.ext import commands
 
 log = logging.getLogger(__name__)
 
-auth_key_pattern = re.compile(r"^<!--([0-9a-f]+)-->$")
+auth_key_pattern = re.compile(rb"^<!--([0-9a-f]+)-->$")  # Legacy (v1) HMAC-SHA3-256 trailer.
+versioned_auth_key_pattern = re.compile(rb"^<!--v2:([a-z0-9-]+):([0-9a-f]+)-->$")
+
+MAC_ALGORITHM = "hmac-sha256"  # Algorithm used for new archives. Must be a key in mac_algorithms.
+
+VERIFY_TAIL_BLOCK_SIZE = 4096  # The authentication code must be within this many bytes of the end of the file.
+VERIFY_CHUNK_SIZE = 64 * 1024
+VERIFY_SPOOL_MAX_MEMORY = 8 * 1024 * 1024  # Decompressed parts larger than this get spooled to disk while being verified.
+VERIFY_MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024  # Compressed parts that decompress to more than this are not verified. (Zip bombs)
+
+ARCHIVE_MESSAGES_PER_PART = 2500  # Target number of messages in each part of a split archive.
+ARCHIVE_COMPRESSION_LEVEL = 6
+ZIP_ENTRY_OVERHEAD = 128  # Rough upper bound on the zip header & central directory bytes for an entry, not counting the file name.
+COMPRESSION_MODES = ("gzip", "zip")
 
 
 def md(_input):
@@ -93,6 +111,210 @@ def blocking_generate_html_archive(channel: 'discord.TextChannel', messages: 'Me
     return archive
 
 
+class ArchivePart(NamedTuple):
+    """Navigation info for one part of a split archive. Passed to the template as `part`."""
+    number: int
+    filename: str
+    prev_filename: Optional[str]
+    next_filename: Optional[str]
+
+
+class ArchiveFile(NamedTuple):
+    """A finished, ready to upload, archive file."""
+    filename: str
+    file: BytesIO
+    size: int
+    sha256: str
+
+
+def part_filename(base_name: str, part_number: Optional[int]) -> str:
+    """Returns the html file name for a part of an archive. Single part archives use part_number=None."""
+    if part_number is None:
+        return f"{base_name}.html"
+    return f"{base_name} (Part {part_number}).html"
+
+
+def split_message_groups(message_groups: 'MessageGroups', max_messages: int) -> List[List['MessageGroup']]:
+    """Splits message groups into chunks of roughly max_messages messages. Message groups are never split up."""
+    chunks = []
+    chunk = []
+    chunk_msg_count = 0
+    for group in message_groups:
+        if len(chunk) > 0 and chunk_msg_count + group.count > max_messages:
+            chunks.append(chunk)
+            chunk = []
+            chunk_msg_count = 0
+        chunk.append(group)
+        chunk_msg_count += group.count
+
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_message_group(group: 'MessageGroup') -> List['MessageGroup']:
+    """Splits a message group in half. The second half gets it's own header."""
+    half = group.count // 2
+    first = copy.copy(group)
+    first.messages = group.messages[:half]
+    second = copy.copy(group)
+    second.messages = group.messages[half:]
+    second.build_header(second.messages[0])
+    return [first, second]
+
+
+async def generate_html_archive_parts(bot: 'commands.bot', channel: 'discord.TextChannel', messages: 'MessageGroups',
+                                      security_key: bytes, max_file_size: int, compression: Optional[str] = None) -> List[ArchiveFile]:
+
+    fn = partial(blocking_generate_html_archive_parts, channel, messages, security_key, max_file_size, compression)
+    archive_files = await bot.loop.run_in_executor(None, fn)
+    return archive_files
+
+
+def blocking_generate_html_archive_parts(channel: 'discord.TextChannel', messages: 'MessageGroups', security_key: bytes,
+                                         max_file_size: int, compression: Optional[str] = None) -> List[ArchiveFile]:
+    """
+    Renders an archive as one or more linked HTML parts, each with its own HMAC so they can be verified individually.
+    Parts that end up larger than max_file_size (after compression, if any) get split in half and re-rendered.
+    A single message that is too big by itself is left out, with a note in the part that would have held it.
+
+    compression may be None for plain HTML files, 'gzip' for one .html.gz per part, or 'zip' to bundle the parts into as few zip files as will fit.
+    """
+    if compression is not None and compression not in COMPRESSION_MODES:
+        raise ValueError(f"Unknown archive compression mode: {compression}")
+
+    base_name = f"{channel.name} - Archive"
+    ctx = {'guild': channel.guild, 'channel': channel}
+    pending = deque(split_message_groups(messages, ARCHIVE_MESSAGES_PER_PART))
+    rendered_parts: List[Tuple[str, bytes, Optional[bytes], str]] = []  # (File name, HTML, Compressed HTML, SHA-256 of the HTML)
+    omitted = 0  # Messages left out that still need to be noted in the next part.
+
+    while len(pending) > 0:
+        groups = pending.popleft()
+        number = len(rendered_parts) + 1
+        multi_part = number > 1 or len(pending) > 0
+
+        filename = part_filename(base_name, number if multi_part else None)
+        prev_filename = part_filename(base_name, number - 1) if number > 1 else None
+        next_filename = part_filename(base_name, number + 1) if len(pending) > 0 else None
+        part = ArchivePart(number, filename, prev_filename, next_filename) if multi_part else None
+
+        html = template.render(ctx=ctx, msg_groups=groups, msg_count=sum(group.count for group in groups), part=part, omitted=omitted).encode('utf-8')
+        trailer, sha_hash = sign_archive(html, security_key)
+        html += trailer
+        compressed = gzip.compress(html, compresslevel=ARCHIVE_COMPRESSION_LEVEL) if compression is not None else None
+
+        part_size = len(compressed) if compressed is not None else len(html)
+        if part_size > max_file_size and len(groups) > 0:
+            if len(groups) > 1:
+                # Too big to upload. Split it in half and try again.
+                half = len(groups) // 2
+                pending.appendleft(groups[half:])
+                pending.appendleft(groups[:half])
+                continue
+            if len(groups) == 1 and groups[0].count > 1:
+                first, second = split_message_group(groups[0])
+                pending.appendleft([second])
+                pending.appendleft([first])
+                continue
+            # A single message that doesn't fit. Uploading it would only fail, so leave it out.
+            log.warning(f"Archive part {number} is a single message of {part_size} bytes. Leaving it out of the archive.")
+            omitted += sum(group.count for group in groups)
+            if len(pending) == 0:
+                pending.append([])  # Still make a part to carry the note.
+            continue
+
+        omitted = 0
+        rendered_parts.append((filename, html, compressed, sha_hash))
+
+    if compression == "zip":
+        return pack_zip_archives(base_name, rendered_parts, max_file_size)
+
+    archive_files = []
+    for filename, html, compressed, sha_hash in rendered_parts:
+        if compressed is not None:
+            archive_files.append(make_archive_file(f"{filename}.gz", compressed))
+        else:
+            archive_files.append(ArchiveFile(filename, BytesIO(html), len(html), sha_hash))
+    return archive_files
+
+
+def pack_zip_archives(base_name: str, rendered_parts: List[Tuple[str, bytes, Optional[bytes], str]], max_file_size: int) -> List[ArchiveFile]:
+    """Greedily packs the rendered parts into as few zip files as possible without exceeding max_file_size.
+    Uses the gzip size of each part as the zip entry size estimate (Both use the same raw deflate stream)."""
+    bundles: List[List[Tuple[str, bytes]]] = []
+    bundle = []
+    bundle_size = 0
+    for filename, html, compressed, _ in rendered_parts:
+        entry_size = len(compressed) + ZIP_ENTRY_OVERHEAD + 2 * len(filename.encode('utf-8'))
+        if len(bundle) > 0 and bundle_size + entry_size > max_file_size:
+            bundles.append(bundle)
+            bundle = []
+            bundle_size = 0
+        bundle.append((filename, html))
+        bundle_size += entry_size
+    if len(bundle) > 0:
+        bundles.append(bundle)
+
+    archive_files = []
+    for i, bundle in enumerate(bundles, start=1):
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ARCHIVE_COMPRESSION_LEVEL) as zip_file:
+            for filename, html in bundle:
+                zip_file.writestr(filename, html)
+
+        zip_name = f"{base_name}.zip" if len(bundles) == 1 else f"{base_name} ({i} of {len(bundles)}).zip"
+        archive_files.append(make_archive_file(zip_name, zip_buffer.getvalue()))
+    return archive_files
+
+
+def make_archive_file(filename: str, data: bytes) -> ArchiveFile:
+    return ArchiveFile(filename, BytesIO(data), len(data), hashlib.sha256(data).hexdigest())
+
+
+def verify_archive_upload(filename: str, data: bytes, security_key: bytes) -> Dict[str, Optional[bool]]:
+    """
+    Verifies every HTML part in an uploaded archive file (html, html.gz, or zip).
+    Returns a dict of the archive part names and whether they are authentic, or None for parts that were too large to verify.
+
+    Plain HTML is verified straight out of the downloaded bytes.
+    Compressed parts are decompressed once into a spooled temp file so that verify_file() can seek around in it cheaply.
+    """
+    lower_name = filename.lower()
+    results = {}
+    if lower_name.endswith(".zip"):
+        with zipfile.ZipFile(BytesIO(data)) as zip_file:
+            for name in zip_file.namelist():
+                if name.lower().endswith(".html"):
+                    if zip_file.getinfo(name).file_size > VERIFY_MAX_DECOMPRESSED_SIZE:
+                        results[name] = None
+                        continue
+                    with zip_file.open(name) as member:
+                        results[name] = verify_compressed_file(member, security_key)
+    elif lower_name.endswith(".gz"):
+        with gzip.GzipFile(fileobj=BytesIO(data)) as gz_file:
+            results[filename] = verify_compressed_file(gz_file, security_key)
+    else:
+        results[filename] = verify_file(BytesIO(data), security_key)
+    return results
+
+
+def verify_compressed_file(file: BinaryIO, security_key: bytes) -> Optional[bool]:
+    """Decompresses a (non-cheaply seekable) stream into a spooled temp file and then verifies it.
+    Returns None without verifying if it decompresses to more than VERIFY_MAX_DECOMPRESSED_SIZE."""
+    with SpooledTemporaryFile(max_size=VERIFY_SPOOL_MAX_MEMORY) as spool:
+        decompressed = 0
+        while True:
+            chunk = file.read(VERIFY_CHUNK_SIZE)
+            if not chunk:
+                break
+            decompressed += len(chunk)
+            if decompressed > VERIFY_MAX_DECOMPRESSED_SIZE:
+                return None
+            spool.write(chunk)
+        return verify_file(spool, security_key)
+
+
 def generate_SHA256_hash(_input: StringIO) -> str:
     """Generates a SHA256 hash for a StringIO Object and seeks the Object back to 0 at the end."""
     _input.seek(0)
@@ -103,6 +325,7 @@ def generate_SHA256_hash(_input: StringIO) -> str:
 
 
 def get_hmac(_input: StringIO, security_key: bytes) -> str:
+    """Legacy (v1) HMAC-SHA3-256 of a StringIO Object. Only kept around for comparison, new archives use sign_archive()."""
     _input.seek(0)
     msg = str(_input.read()).encode('utf-8')
     hasher = hmac.new(security_key, msg, hashlib.sha3_256)  # Create the HMAC Hasher
@@ -111,47 +334,124 @@ def get_hmac(_input: StringIO, security_key: bytes) -> str:
     return hash
 
 
-def write_hmac(_input: StringIO, security_key: bytes):
-    """Generates a Hash-base Message Authentication Code for a given StringIO Object and writes it to the end of the file."""
+def blake2b_mac(security_key: bytes):
+    # BLAKE2b keys are limited to 64 bytes. Hash longer keys down to size.
+    key = security_key if len(security_key) <= 64 else hashlib.blake2b(security_key).digest()
+    return hashlib.blake2b(key=key, digest_size=32)
 
-    _input.seek(0)  # Seek the StringIO back to the beginning so it can be read.
 
-    hash = get_hmac(_input, security_key)
-    # log.info(f"Got HMAC: {hash}")
-    _input.seek(0, SEEK_END)  # Make sure we are at the end of the file so we can write the hmac
-    _input.write(f"\n<!--{hash}-->")  # Write the hash to the StringIO
+def hmac_sha256_mac(security_key: bytes):
+    return hmac.new(security_key, digestmod=hashlib.sha256)
+
+
+def hmac_sha3_256_mac(security_key: bytes):
+    return hmac.new(security_key, digestmod=hashlib.sha3_256)
+
+
+# Keyed hash constructors for the v2 trailer, by the name used in the trailer.
+mac_algorithms = {
+    "blake2b": blake2b_mac,
+    "hmac-sha256": hmac_sha256_mac,
+    "hmac-sha3-256": hmac_sha3_256_mac,
+}
+
+
+def iter_chunks(data: bytes, chunk_size: int = VERIFY_CHUNK_SIZE):
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
 
-    _input.seek(0)  # Finally Seek the StringIO back to the beginning so it's ready the next time it needs to be read.
 
+def sign_archive(body: bytes, security_key: bytes, algorithm: str = MAC_ALGORITHM) -> Tuple[bytes, str]:
+    """
+    Computes the versioned authentication trailer for an archive body and the public SHA-256 hash of the signed file.
+    Both hashes are fed the same chunks in a single pass over the body.
 
-def verify_file(file: StringIO, security_key: bytes) -> bool:
+    Returns the trailer (to be appended to the body) and the SHA-256 hex digest of body + trailer.
+    """
+    mac = mac_algorithms[algorithm](security_key)
+    public_hash = hashlib.sha256()
+    for chunk in iter_chunks(body):
+        mac.update(chunk)
+        public_hash.update(chunk)
 
-    file.seek(0, SEEK_END)  # Seek to the end of the file. so we can iterate backward.
-    pos = file.tell()  # store the position that is the end of the file.
-    # log.info(f"Pos: {pos}")
+    trailer = f"\n<!--v2:{algorithm}:{mac.hexdigest()}-->".encode('utf-8')
+    public_hash.update(trailer)
+    return trailer, public_hash.hexdigest()
 
-    file.seek(0, SEEK_END)  # Seek back to the end of the file.
-    while pos > 0 and file.read(1) != '\n':  # Go backwards through the file until we hit a new line or the start of the file.
-        pos -= 1
-        file.seek(pos, SEEK_SET)
-    # log.info(f"Pos after seeking: {pos}")
-    auth_code = None
-    if pos > 0:
-        file.seek(pos+1, SEEK_SET)  # Go forward one char to get tot he start of the last line. This is where the auth code lies.
-        auth_code = file.readline()  # Grab the auth code
 
-        file.seek(pos, SEEK_SET)  # Go back to the new line
-        file.truncate()  # And delete everything after it so we can get back to a HMACable file.
+def write_hmac(_input: StringIO, security_key: bytes) -> str:
+    """Generates a Message Authentication Code for a given StringIO Object and writes it to the end of the file.
+    Returns the SHA-256 hash of the signed file."""
+
+    body = _input.getvalue().encode('utf-8')
+    trailer, sha_hash = sign_archive(body, security_key)
+    _input.seek(0, SEEK_END)  # Make sure we are at the end of the file so we can write the trailer
+    _input.write(trailer.decode('utf-8'))
+
+    _input.seek(0)  # Finally Seek the StringIO back to the beginning so it's ready the next time it needs to be read.
+    return sha_hash
+
+
+def find_auth_code(file: BinaryIO) -> Tuple[int, Optional[bytes]]:
+    """
+    Locates the authentication code on the last line of an archive file.
+    Only the final block of the file is read and searched (once, backwards) for the last new line.
+
+    Returns the length of the authenticated body (everything before the last new line) and the last line.
+    If there is no new line in the final block, (0, None) is returned.
+    """
+    file.seek(0, SEEK_END)
+    file_length = file.tell()
+    block_start = max(0, file_length - VERIFY_TAIL_BLOCK_SIZE)
+    file.seek(block_start, SEEK_SET)
+    final_block = file.read()
+
+    newline_pos = final_block.rfind(b"\n")
+    if newline_pos < 0:
+        return 0, None
+    return block_start + newline_pos, final_block[newline_pos + 1:]
+
+
+def get_hmac_from_stream(file: BinaryIO, security_key: bytes, length: int, algorithm: str = "hmac-sha3-256") -> str:
+    """Computes the MAC of the first `length` bytes of a binary stream, reading it in chunks."""
+    hasher = mac_algorithms[algorithm](security_key)
+    file.seek(0, SEEK_SET)
+    remaining = length
+    while remaining > 0:
+        chunk = file.read(min(VERIFY_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def verify_file(file: BinaryIO, security_key: bytes) -> bool:
+    """Verifies the authentication code at the end of a (seekable, binary) archive file."""
+
+    body_length, auth_code = find_auth_code(file)
 
     if auth_code is not None:
-        auth_code_match: Match = auth_key_pattern.match(auth_code)
+        algorithm = None
+        auth_code_match = versioned_auth_key_pattern.match(auth_code)
         if auth_code_match is not None:
-            auth_code = auth_code_match.group(1)
-            log.info(f"Got auth code: {auth_code}")
-            hash = get_hmac(file, security_key)
+            algorithm = auth_code_match.group(1).decode('ascii')
+            auth_code = auth_code_match.group(2).decode('ascii')
+            if algorithm not in mac_algorithms:
+                log.info(f"Unknown authentication code algorithm: {algorithm}")
+                return False
+        else:
+            auth_code_match = auth_key_pattern.match(auth_code)
+            if auth_code_match is not None:
+                algorithm = "hmac-sha3-256"  # Legacy trailer.
+                auth_code = auth_code_match.group(1).decode('ascii')
+
+        if algorithm is not None:
+            log.info(f"Got {algorithm} auth code: {auth_code}")
+            hash = get_hmac_from_stream(file, security_key, body_length, algorithm)
             log.info(f"files hmac: {hash}")
 
-            # if hash == auth_code:
             if hmac.compare_digest(hash, auth_code):
                 log.info("File is unmodified.")
                 return True
@@ -0,0 +1,180 @@
+"""
+Transparent compression for the content of cached messages.
+Cached content is written for every message but only read back on the rare edit or delete,
+so it's stored compressed (when enabled) in messages.content_compressed and only decompressed on those read paths.
+
+Uses zstd (optionally with a dictionary trained on chat text) when the zstandard package is installed, zlib otherwise.
+Every compressed value starts with a one byte codec tag so either can always be read back no matter the current settings.
+Trained dictionaries are saved by their ID in the dictionary directory and never overwritten. Every saved dictionary is loaded
+so content compressed with an older one can still be read, but only the newest is used to compress.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import os
+import zlib
+import logging
+from typing import Optional, Dict, List
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESSION_ERRORS = (zlib.error, UnicodeDecodeError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+log = logging.getLogger(__name__)
+
+MIN_COMPRESS_LENGTH = 64  # Content shorter than this (in bytes) is stored as is. The savings aren't worth it.
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+DICTIONARY_SIZE = 64 * 1024  # Size of trained zstd dictionaries.
+DICTIONARY_EXTENSION = ".dict"
+
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b's'  # The dictionary id (if any) is stored in the zstd frame header.
+
+
+class ContentCompressor:
+
+    def __init__(self):
+        self.enabled = False
+        self.dictionary: Optional['zstandard.ZstdCompressionDict'] = None
+        self.dictionaries: Dict[int, 'zstandard.ZstdCompressionDict'] = {}  # All known dictionaries by ID, for decompressing.
+        self.compressor: Optional['zstandard.ZstdCompressor'] = None
+
+
+    def configure(self, enabled: bool, dictionary_dir: Optional[str] = None):
+        self.enabled = enabled
+        self.dictionary = None
+        if dictionary_dir is not None:
+            if zstandard is None:
+                log.warning("A message cache compression dictionary directory is configured but zstandard is not installed. Falling back to zlib.")
+            else:
+                self.load_dictionaries(dictionary_dir)
+
+        self.build_compressor()
+        log.info(f"Message cache compression: {'enabled' if enabled else 'disabled'} using {'zstd' if zstandard is not None else 'zlib'}"
+                 f"{' with a dictionary' if self.dictionary is not None else ''}.")
+
+
+    def load_dictionaries(self, dictionary_dir: str):
+        """Loads every saved dictionary for decompressing and uses the most recently saved one for compressing."""
+        try:
+            names = [name for name in os.listdir(dictionary_dir) if name.endswith(DICTIONARY_EXTENSION)]
+        except FileNotFoundError:
+            log.info(f"No message cache compression dictionaries found in {dictionary_dir}")
+            return
+
+        paths = sorted((os.path.join(dictionary_dir, name) for name in names), key=os.path.getmtime)
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    self.add_dictionary(f.read(), use=True)
+            except (OSError, zstandard.ZstdError) as e:
+                log.warning(f"Could not load the message cache compression dictionary at {path}: {e}")
+
+
+    def build_compressor(self):
+        if zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self.dictionary, write_content_size=True)
+
+
+    def add_dictionary(self, data: bytes, use: bool = False):
+        dictionary = zstandard.ZstdCompressionDict(data)
+        self.dictionaries[dictionary.dict_id()] = dictionary
+        if use:
+            self.dictionary = dictionary
+
+
+    def compress(self, content: Optional[str]) -> Optional[bytes]:
+        """Returns the compressed content, or None if compression is disabled or wouldn't make the content any smaller."""
+        if not self.enabled or content is None:
+            return None
+        return self.encode(content)
+
+
+    def encode(self, content: str) -> Optional[bytes]:
+        """Compresses the content with the current settings, even if compression is disabled."""
+        raw = content.encode('utf-8')
+        if len(raw) < MIN_COMPRESS_LENGTH:
+            return None
+
+        if self.compressor is not None:
+            compressed = CODEC_ZSTD + self.compressor.compress(raw)
+        else:
+            compressed = CODEC_ZLIB + zlib.compress(raw, ZLIB_LEVEL)
+        return compressed if len(compressed) < len(raw) else None
+
+
+    def decompress(self, data: bytes) -> Optional[str]:
+        try:
+            return self.decompress_codec(data)
+        except DECOMPRESSION_ERRORS as e:
+            log.warning(f"Could not decompress cached message content: {e}")
+            return None
+
+
+    def decompress_codec(self, data: bytes) -> Optional[str]:
+        codec = data[:1]
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data[1:]).decode('utf-8')
+
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                log.warning("Found zstd compressed content in the message cache but zstandard is not installed.")
+                return None
+            dict_id = zstandard.get_frame_parameters(data[1:]).dict_id
+            dictionary = self.dictionaries.get(dict_id) if dict_id != 0 else None
+            if dict_id != 0 and dictionary is None:
+                log.warning(f"Missing message cache compression dictionary {dict_id}.")
+                return None
+            return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data[1:]).decode('utf-8')
+
+        log.warning(f"Unknown message cache compression codec: {codec}")
+        return None
+
+
+def compression_ratio(samples: List[str], dictionary: Optional[bytes] = None) -> float:
+    """
+    Total compressed size / total raw size over the samples, counting anything not worth compressing at it's raw size.
+    Uses it's own compressor (with the given dictionary, if any) so it can run in an executor while messages keep being cached.
+    """
+    compressor = ContentCompressor()
+    compressor.enabled = True
+    if dictionary is not None:
+        compressor.add_dictionary(dictionary, use=True)
+    compressor.build_compressor()
+
+    raw_size = 0
+    stored_size = 0
+    for sample in samples:
+        raw = len(sample.encode('utf-8'))
+        compressed = compressor.encode(sample)
+        raw_size += raw
+        stored_size += len(compressed) if compressed is not None else raw
+    return stored_size / raw_size if raw_size > 0 else 1.0
+
+
+def train_dictionary(samples: List[str]) -> bytes:
+    """Trains a zstd dictionary on a sample of cached message content. Blocking, run in an executor."""
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed.")
+    dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, [sample.encode('utf-8') for sample in samples], level=ZSTD_LEVEL)
+    return dictionary.as_bytes()
+
+
+def save_dictionary(dictionary_dir: str, dictionary: bytes) -> str:
+    """
+    Saves a dictionary as <dictionary ID>.dict in the dictionary directory and returns the path. Blocking, run in an executor.
+    Raises FileExistsError rather than overwriting a saved dictionary, as cached content may still need it to be read.
+    """
+    dict_id = zstandard.ZstdCompressionDict(dictionary).dict_id()
+    os.makedirs(dictionary_dir, exist_ok=True)
+    path = os.path.join(dictionary_dir, f"{dict_id}{DICTIONARY_EXTENSION}")
+    with open(path, 'xb') as f:
+        f.write(dictionary)
+    return path
+
+
+content_compressor = ContentCompressor()
@@ -0,0 +1,183 @@
+"""
+Deduplicated reporting to the global error log channel.
+Errors are fingerprinted by their type and stack (or by their header for warnings that aren't exceptions).
+The first occurrence of a fingerprint is posted right away, repeats within FINGERPRINT_COOLDOWN are only counted,
+and every REPORT_INTERVAL a summary with the count and the first and last samples of each repeated error is posted.
+This keeps a PluralKit or database outage from flooding the channel and using up the rate limits that logs need.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import re
+import time
+import hashlib
+import logging
+import traceback
+from datetime import datetime
+from typing import TYPE_CHECKING, Optional, Dict
+
+import discord
+from discord.ext import tasks
+
+from miscUtils import send_long_msg
+from utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 5 * 60  # Seconds between summaries of repeated errors.
+FINGERPRINT_COOLDOWN = 60 * 60  # Seconds before an error that was already posted in full gets posted in full again.
+MAX_IMMEDIATE_REPORTS = 5  # New errors posted right away per interval. Any more are only included in the next summary.
+MAX_FINGERPRINTS = 100  # Distinct errors tracked per interval. Any more are only counted.
+MAX_SUMMARY_MESSAGES = 5  # Errors summarized with samples per interval. The rest are listed with their counts only.
+MAX_SAMPLE_LENGTH = 800  # Characters kept from each sample.
+
+
+def fingerprint_exception(exception: BaseException) -> str:
+    stack = traceback.extract_tb(exception.__traceback__)
+    key = type(exception).__qualname__ + "|" + "|".join(f"{frame.filename}:{frame.name}:{frame.lineno}" for frame in stack)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def fingerprint_text(text: str) -> str:
+    # IDs and counts change from one occurrence to the next, so they aren't part of the fingerprint.
+    key = re.sub(r"\d+", "#", text)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def truncate(text: str, keep_end: bool) -> str:
+    if len(text) <= MAX_SAMPLE_LENGTH:
+        return text
+    # The end of a traceback is where the error is.
+    return "..." + text[-MAX_SAMPLE_LENGTH:] if keep_end else text[:MAX_SAMPLE_LENGTH] + "..."
+
+
+class ErrorGroup:
+
+    def __init__(self, title: str, sample: str, code_block: bool):
+        self.title = title
+        self.code_block = code_block
+        self.count = 1
+        self.first_sample = sample
+        self.last_sample = sample
+        self.first_seen = datetime.utcnow()
+        self.last_seen = self.first_seen
+
+    def add(self, sample: str):
+        self.count += 1
+        self.last_sample = sample
+        self.last_seen = datetime.utcnow()
+
+    def format_sample(self, sample: str) -> str:
+        return f"```python\n{sample}```" if self.code_block else sample
+
+    def format(self) -> str:
+        summary = f"**{self.count}x** {self.title} between {self.first_seen:%H:%M:%S} and {self.last_seen:%H:%M:%S} UTC\n" \
+                  f"First:\n{self.format_sample(self.first_sample)}"
+        if self.count > 1:
+            summary += f"\nLast:\n{self.format_sample(self.last_sample)}"
+        return summary
+
+
+class ErrorReporter:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.groups: Dict[str, ErrorGroup] = {}  # Fingerprint: Errors that were not posted right away this interval.
+        self.last_posted: Dict[str, float] = {}  # Fingerprint: When it was last posted in full.
+        self.immediate_reports = 0
+        self.overflow = 0
+
+
+    def start(self):
+        self.send_summaries.start()
+
+
+    def get_channel(self) -> Optional[discord.TextChannel]:
+        if self.bot.config is None or 'error_log_channel' not in self.bot.config:
+            return None
+        return self.bot.get_channel(self.bot.config['error_log_channel'])
+
+
+    async def report_exception(self, exception: BaseException, message: str, header: Optional[str] = None) -> bool:
+        """Reports an exception. message should be the formatted traceback."""
+        title = f"{header} {type(exception).__name__}" if header is not None else type(exception).__name__
+        return await self.report(message, title, fingerprint_exception(exception), header, code_block=True)
+
+
+    async def report_text(self, message: str, header: Optional[str] = None, code_block: bool = False, fingerprint: Optional[str] = None) -> bool:
+        """Reports a warning. Messages are grouped by their header (or first line) with any numbers ignored unless a fingerprint is given."""
+        title = header if header is not None else message.split("\n", 1)[0][:100]
+        return await self.report(message, title, fingerprint or fingerprint_text(title), header, code_block)
+
+
+    async def report(self, message: str, title: str, fingerprint: str, header: Optional[str], code_block: bool) -> bool:
+        """Returns False if there is no error log channel or the message could not be sent."""
+        error_log_channel = self.get_channel()
+        if error_log_channel is None:
+            return False
+
+        last_posted = self.last_posted.get(fingerprint)
+        recently_posted = last_posted is not None and time.monotonic() - last_posted < FINGERPRINT_COOLDOWN
+        if recently_posted or self.immediate_reports >= MAX_IMMEDIATE_REPORTS:
+            self.add_to_summary(fingerprint, title, truncate(message, keep_end=code_block), code_block)
+            return True
+
+        self.last_posted[fingerprint] = time.monotonic()
+        self.immediate_reports += 1
+        metrics.inc("errors_reported_total", result="posted")
+
+        try:
+            await send_long_msg(error_log_channel, f"{header}\n{message}" if header is not None else message, code_block=code_block)
+            return True
+        except discord.DiscordException as e:
+            log.exception(f"Error sending log to Global Error Discord Channel!: {e}")
+            return False
+
+
+    def add_to_summary(self, fingerprint: str, title: str, sample: str, code_block: bool):
+        group = self.groups.get(fingerprint)
+        if group is not None:
+            group.add(sample)
+        elif len(self.groups) < MAX_FINGERPRINTS:
+            self.groups[fingerprint] = ErrorGroup(title, sample, code_block)
+        else:
+            self.overflow += 1
+        metrics.inc("errors_reported_total", result="summarized")
+
+
+    # noinspection PyCallingNonCallable
+    @tasks.loop(seconds=REPORT_INTERVAL)
+    async def send_summaries(self):
+        groups = sorted(self.groups.values(), key=lambda group: group.count, reverse=True)
+        overflow = self.overflow
+        self.groups = {}
+        self.overflow = 0
+        self.immediate_reports = 0
+
+        now = time.monotonic()
+        self.last_posted = {fingerprint: posted for fingerprint, posted in self.last_posted.items() if now - posted < FINGERPRINT_COOLDOWN}
+
+        error_log_channel = self.get_channel()
+        if error_log_channel is None or (len(groups) == 0 and overflow == 0):
+            return
+
+        try:
+            for group in groups[:MAX_SUMMARY_MESSAGES]:
+                await error_log_channel.send(group.format())
+
+            remaining = [f"**{group.count}x** {group.title}" for group in groups[MAX_SUMMARY_MESSAGES:]]
+            if overflow > 0:
+                remaining.append(f"**{overflow}x** other errors")
+            if len(remaining) > 0:
+                summary = "Also in the last {} minutes:\n{}".format(REPORT_INTERVAL // 60, "\n".join(remaining))
+                await error_log_channel.send(summary[:2000])
+        except discord.DiscordException as e:
+            log.exception(f"Error sending error summary to Global Error Discord Channel!: {e}")
+
+
+    @send_summaries.before_loop
+    async def before_send_summaries(self):
+        await self.bot.wait_until_ready()
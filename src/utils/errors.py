@@ -24,7 +24,7 @@ permissions_error_support_link = "https://discord.gg/yJU7FKN"
 async def handle_permissions_error(bot: 'GGBot', errored_channel: discord.TextChannel, event_type: str, exception: Exception, event_payload: EventPayload):
 
     guild: discord.Guild = errored_channel.guild
-    bot.has_permission_problems.append(guild.id)
+    bot.has_permission_problems.add(guild.id)
 
     ch_perm: discord.Permissions = guild.me.permissions_in(errored_channel)
     sent_msg = False
@@ -0,0 +1,242 @@
+"""
+Fair scheduling for event handlers.
+discord.py starts every event handler as soon as the event arrives, so one guild that purges thousands of messages or is being raided
+can tie up the DB pool, the executor and our send budget while every other guild's logs wait behind it.
+
+Instead, the handlers of our event cogs are queued here and only a limited number run at a time. Each event belongs to a priority lane
+(bans, kicks and joins are high priority, edits and avatar changes are low) and the lanes are served in a weighted round robin so
+the low lane is slowed down, never starved. Within a lane, guilds take turns, and no guild can have more than
+MAX_IN_FLIGHT_PER_GUILD handlers running at once. Handlers for the same guild can still finish out of order, just like before.
+A guild can have at most MAX_QUEUED_PER_GUILD handlers waiting. Past that, its oldest waiting handler of the lowest priority
+(no higher than the new one's) is shed, or the new one if everything waiting outranks it. Shed handlers mean lost logs, so they are counted.
+
+Handlers that aren't part of a cog (e.g. on_message and the permission cache listeners) and events without a lane are run right away.
+Work that isn't started by a Discord event, like a coalesced bulk delete archive, can be queued here with submit() as well.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Optional, Dict, List, Deque, NamedTuple, Callable, Any
+
+import discord
+from discord.ext import commands
+
+from utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+HIGH = "high"
+NORMAL = "normal"
+LOW = "low"
+
+EVENT_PRIORITIES = {
+    'on_member_ban': HIGH,
+    'on_member_unban': HIGH,
+    'on_member_join': HIGH,
+    'on_member_remove': HIGH,
+
+    'on_raw_message_delete': NORMAL,
+    'on_raw_bulk_message_delete': NORMAL,
+    'on_guild_channel_create': NORMAL,
+    'on_guild_channel_delete': NORMAL,
+    'on_guild_channel_update': NORMAL,
+    'on_invite_create': NORMAL,
+    'on_invite_delete': NORMAL,
+
+    'on_raw_message_edit': LOW,
+    'on_member_update': LOW,
+    'on_user_update': LOW,
+
+    # Not Discord events. Submitted directly by the cogs.
+    'bulk_message_delete_archive': NORMAL,
+}
+
+LANE_WEIGHTS = {HIGH: 8, NORMAL: 4, LOW: 1}  # Handlers started from each lane per round when every lane has work waiting.
+MAX_CONCURRENT_EVENTS = 64  # Handlers running at once across every guild. Can be overridden in the config with max_concurrent_events.
+MAX_IN_FLIGHT_PER_GUILD = 4  # Handlers running at once for a single guild. Can be overridden in the config with max_events_in_flight_per_guild.
+MAX_QUEUED_PER_GUILD = 2000  # Handlers waiting for a single guild before some are shed. Can be overridden in the config with max_events_queued_per_guild.
+NO_GUILD = 0  # Stand in guild ID for events that don't belong to a guild (e.g. user updates).
+
+
+class ScheduledEvent(NamedTuple):
+    coro: Callable
+    event_name: str
+    priority: str
+    guild_id: int
+    args: tuple
+    kwargs: Dict[str, Any]
+    queued_at: float
+
+
+def event_guild_id(args: tuple) -> int:
+    """Finds the guild an event belongs to from it's first argument. Works for guilds, raw event payloads, members, channels, and invites."""
+    if len(args) == 0:
+        return NO_GUILD
+    first = args[0]
+    if isinstance(first, discord.Guild):
+        return first.id
+
+    guild_id = getattr(first, 'guild_id', None)  # Raw event payloads
+    if guild_id is not None:
+        return guild_id
+
+    guild = getattr(first, 'guild', None)
+    return guild.id if guild is not None else NO_GUILD
+
+
+class EventScheduler:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.max_concurrent = MAX_CONCURRENT_EVENTS
+        self.max_in_flight_per_guild = MAX_IN_FLIGHT_PER_GUILD
+        self.max_queued_per_guild = MAX_QUEUED_PER_GUILD
+        # Priority: {Guild ID: Waiting events}. Guilds are moved to the end after each turn, so iterating gives the round robin order.
+        self.lanes: Dict[str, 'OrderedDict[int, Deque[ScheduledEvent]]'] = {priority: OrderedDict() for priority in LANE_WEIGHTS}
+        self.queued: Dict[str, int] = {priority: 0 for priority in LANE_WEIGHTS}
+        self.in_flight: Dict[int, int] = {}  # Guild ID: Handlers running
+        self.guild_queued: Dict[int, int] = {}  # Guild ID: Handlers waiting, across every lane.
+        self.shedding: Dict[int, int] = {}  # Guild ID: Handlers shed since the guild's queue was last empty.
+        self.shed = 0
+        self.running = 0
+        self.rotation: List[str] = self.build_rotation()
+        self.position = 0
+
+
+    def configure(self, max_concurrent: int, max_in_flight_per_guild: int, max_queued_per_guild: int):
+        self.max_concurrent = max_concurrent
+        self.max_in_flight_per_guild = max_in_flight_per_guild
+        self.max_queued_per_guild = max_queued_per_guild
+
+
+    @staticmethod
+    def build_rotation() -> List[str]:
+        """Interleaves the lanes by weight, e.g. high, normal, low, high, normal, high, ... so no lane waits out a whole round."""
+        rotation = []
+        for i in range(max(LANE_WEIGHTS.values())):
+            rotation.extend(priority for priority, weight in LANE_WEIGHTS.items() if i < weight)
+        return rotation
+
+
+    def should_schedule(self, coro: Callable, event_name: str) -> bool:
+        return event_name in EVENT_PRIORITIES and isinstance(getattr(coro, '__self__', None), commands.Cog)
+
+
+    def submit(self, coro: Callable, event_name: str, *args, **kwargs):
+        priority = EVENT_PRIORITIES[event_name]
+        guild_id = event_guild_id(args)
+        scheduled = ScheduledEvent(coro, event_name, priority, guild_id, args, kwargs, time.perf_counter())
+
+        if self.guild_queued.get(guild_id, 0) >= self.max_queued_per_guild:
+            shed = self.take_sheddable(guild_id, priority)
+            if shed is None:
+                self.shed_event(scheduled)
+                return
+            self.shed_event(shed)
+
+        lane = self.lanes[priority]
+        waiting = lane.get(guild_id)
+        if waiting is None:
+            waiting = deque()
+            lane[guild_id] = waiting
+        waiting.append(scheduled)
+        self.queued[priority] += 1
+        self.guild_queued[guild_id] = self.guild_queued.get(guild_id, 0) + 1
+        self.start_waiting()
+
+
+    def take_sheddable(self, guild_id: int, max_priority: str) -> Optional[ScheduledEvent]:
+        """Removes and returns the guild's oldest waiting handler from the lowest lane that isn't above max_priority, if there is one."""
+        for priority in reversed(list(LANE_WEIGHTS)):
+            waiting = self.lanes[priority].get(guild_id)
+            if waiting is not None:
+                scheduled = waiting.popleft()
+                if len(waiting) == 0:
+                    del self.lanes[priority][guild_id]
+                self.dequeued(scheduled)
+                return scheduled
+            if priority == max_priority:
+                return None
+        return None
+
+
+    def shed_event(self, scheduled: ScheduledEvent):
+        """The handler will never run, so whatever it would have logged is lost."""
+        self.shed += 1
+        metrics.inc("events_shed_total", event=scheduled.event_name, priority=scheduled.priority)
+        shed_for_guild = self.shedding.get(scheduled.guild_id, 0)
+        if shed_for_guild == 0:
+            log.warning(f"Over {self.max_queued_per_guild} event handlers are waiting for guild {scheduled.guild_id}. Shedding {scheduled.priority} priority events.")
+        self.shedding[scheduled.guild_id] = shed_for_guild + 1
+
+
+    def dequeued(self, scheduled: ScheduledEvent):
+        self.queued[scheduled.priority] -= 1
+        remaining = self.guild_queued[scheduled.guild_id] - 1
+        if remaining > 0:
+            self.guild_queued[scheduled.guild_id] = remaining
+            return
+
+        del self.guild_queued[scheduled.guild_id]
+        shed = self.shedding.pop(scheduled.guild_id, 0)
+        if shed > 0:
+            log.warning(f"Caught up on the event backlog for guild {scheduled.guild_id} after shedding {shed} events.")
+
+
+    def start_waiting(self):
+        """Starts queued handlers until we hit the concurrency limit or everything left belongs to guilds that are at their limit."""
+        while self.running < self.max_concurrent:
+            scheduled = self.next_event()
+            if scheduled is None:
+                return
+            self.running += 1
+            self.in_flight[scheduled.guild_id] = self.in_flight.get(scheduled.guild_id, 0) + 1
+            self.bot.loop.create_task(self.run(scheduled))
+
+
+    def next_event(self) -> Optional[ScheduledEvent]:
+        for _ in range(len(self.rotation)):
+            priority = self.rotation[self.position]
+            self.position = (self.position + 1) % len(self.rotation)
+            if self.queued[priority] == 0:
+                continue
+            scheduled = self.take_from_lane(priority)
+            if scheduled is not None:
+                return scheduled
+        return None
+
+
+    def take_from_lane(self, priority: str) -> Optional[ScheduledEvent]:
+        lane = self.lanes[priority]
+        for guild_id, waiting in lane.items():
+            if self.in_flight.get(guild_id, 0) >= self.max_in_flight_per_guild:
+                continue
+            scheduled = waiting.popleft()
+            if len(waiting) == 0:
+                del lane[guild_id]
+            else:
+                lane.move_to_end(guild_id)  # Let the other guilds go first next time.
+            self.dequeued(scheduled)
+            return scheduled
+        return None
+
+
+    async def run(self, scheduled: ScheduledEvent):
+        try:
+            queue_time = (time.perf_counter() - scheduled.queued_at) * 1000
+            metrics.observe("event_queue_time_ms", queue_time, event=scheduled.event_name, priority=scheduled.priority)
+            await self.bot._run_event(scheduled.coro, scheduled.event_name, *scheduled.args, **scheduled.kwargs)
+        finally:
+            self.running -= 1
+            remaining = self.in_flight[scheduled.guild_id] - 1
+            if remaining > 0:
+                self.in_flight[scheduled.guild_id] = remaining
+            else:
+                del self.in_flight[scheduled.guild_id]
+            self.start_waiting()
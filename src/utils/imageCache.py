@@ -0,0 +1,568 @@
+"""
+Attachment downloader and content addressed blob store for the image cache.
+Downloads attachments from restricted feature guilds in the background so the gateway path (and command handling) never waits on them.
+
+Attachments are stored once per unique file at image_cache/blobs/<sha256[0:2]>/<sha256[2:4]>/<sha256>
+and cached messages refer to them as "<sha256>/<filename>".
+Older caches stored files at image_cache/<guild id>/<attachment id>_<filename>, which are still readable.
+Nothing new is written there, and those files are deleted once no cached message refers to them anymore.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+
+from io import BytesIO
+from pathlib import Path
+from datetime import datetime
+from functools import partial
+from collections import deque, OrderedDict
+from typing import TYPE_CHECKING, Optional, Dict, List, Tuple, NamedTuple, Deque
+
+import discord
+from discord.ext import tasks
+
+import db
+import miscUtils
+from imgUtils.attachmentDownscaler import downscale_image
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+IMAGE_CACHE_PATH = Path("./image_cache")
+BLOB_PATH = IMAGE_CACHE_PATH / "blobs"
+EVICTION_INTERVAL = 30  # Minutes between eviction passes.
+BLOB_GC_GRACE = 10  # Minutes a blob is kept after it was last used, even if nothing references it.
+
+# Defaults for the image cache limits. Can be overridden in the config. Set to null in the config to disable a limit.
+IMAGE_CACHE_MAX_MB = 20 * 1024  # Max size of the whole image cache.
+IMAGE_CACHE_GUILD_MAX_MB = 2 * 1024  # Max size of the attachments a single guild can hold in the image cache.
+IMAGE_CACHE_MAX_AGE_DAYS = 30  # Blobs that have not been used in this many days are evicted.
+DOWNLOAD_QUEUE_SIZE = 500  # Max number of attachments waiting to be downloaded. Anything past this is dropped.
+DOWNLOAD_WORKERS = 4  # Number of attachments being downloaded at the same time.
+DOWNLOADS_PER_GUILD = 2  # Max number of workers a single guild can tie up at once.
+BLOB_LOCK_STRIPES = 64  # Locks shared between blob digests. Storing and removing a blob hold it's lock.
+THROUGHPUT_WINDOW = 60  # Seconds of history used for the bytes/sec stat.
+MAX_FILES_PER_MESSAGE = 10  # Discords limit on attachments per message.
+UPLOAD_SIZE_HEADROOM = 64 * 1024  # Leave some room under the upload limit for the rest of the request.
+
+
+class DownloadJob(NamedTuple):
+    guild_id: int
+    message_id: int
+    attachment: discord.Attachment
+
+
+class AttachmentUpload(NamedTuple):
+    """A cached attachment that is going to be re-uploaded. Either streamed from a file on disk or from an in memory (downscaled) copy."""
+    filename: str
+    size: int
+    spoiler: bool
+    path: Optional[Path] = None
+    data: Optional[BytesIO] = None
+
+    def to_file(self) -> discord.File:
+        """Opens the attachment for uploading. Only call right before sending, as it opens the file on disk."""
+        if self.data is not None:
+            return discord.File(self.data, filename=self.filename, spoiler=self.spoiler)
+        return discord.File(str(self.path), filename=self.filename, spoiler=self.spoiler)
+
+
+class DownloaderStats(NamedTuple):
+    queue_depth: int
+    queue_size: int
+    in_progress: int
+    completed: int
+    failed: int
+    dropped: int
+    bytes_downloaded: int
+    bytes_per_sec: float
+
+
+def blob_path(digest: str) -> Path:
+    return BLOB_PATH / digest[0:2] / digest[2:4] / digest
+
+
+def attachment_path(guild_id: int, attachment_name: str) -> Tuple[Path, str]:
+    """Resolves an attachment name stored on a cached message to the file on disk and the filename it was uploaded with."""
+    if "/" in attachment_name:
+        digest, filename = attachment_name.split("/", 1)
+        return blob_path(digest), filename
+    # Legacy per guild file.
+    return IMAGE_CACHE_PATH / str(guild_id) / attachment_name, attachment_name
+
+
+def blob_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobLocks:
+    """
+    Serializes storing and removing blobs with the same digest.
+    Without it, a download could find a blob's file still on disk (and skip writing it) just before the file is deleted
+    by the eviction that removed the blob from the DB, leaving the newly registered blob without a file.
+    """
+
+    def __init__(self):
+        self.locks: Optional[List[asyncio.Lock]] = None  # Made on first use so they belong to the running loop.
+
+    @staticmethod
+    def stripe(digest: str) -> int:
+        return int(digest[:8], 16) % BLOB_LOCK_STRIPES
+
+    def lock(self, digest: str) -> asyncio.Lock:
+        if self.locks is None:
+            self.locks = [asyncio.Lock() for _ in range(BLOB_LOCK_STRIPES)]
+        return self.locks[self.stripe(digest)]
+
+
+blob_locks = BlobLocks()
+
+
+def store_blob(data: bytes, digest: str) -> bool:
+    """Writes the data to the blob store if it isn't already there. Returns True if a new file was written.
+    Hold blob_locks.lock(digest) until the blob is registered in the DB."""
+    path = blob_path(digest)
+    if path.exists():
+        return False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{digest}.{os.getpid()}.{id(data)}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # Atomic, so a half written blob is never visible under it's digest.
+    return True
+
+
+def remove_blobs(digests: List[str]) -> Tuple[int, int]:
+    """Deletes the files for the given blobs. Returns the number of files and bytes removed."""
+    files = 0
+    size = 0
+    for digest in digests:
+        path = blob_path(digest)
+        try:
+            file_size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        files += 1
+        size += file_size
+    return files, size
+
+
+def list_legacy_files(path: Path = IMAGE_CACHE_PATH) -> Dict[int, List[str]]:
+    """Lists the files left in the per guild directories used before the blob store, by guild ID. Blocking, run in an executor."""
+    legacy_files = {}
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return legacy_files
+    for entry in entries:
+        if entry.is_dir() and entry.name.isdigit():
+            legacy_files[int(entry.name)] = [file.name for file in os.scandir(entry.path) if file.is_file()]
+    return legacy_files
+
+
+def remove_legacy_files(legacy_files: Dict[int, List[str]], path: Path = IMAGE_CACHE_PATH) -> Tuple[int, int]:
+    """Deletes the given legacy files and any guild directories left empty. Returns the number of files and bytes removed."""
+    files = 0
+    size = 0
+    for guild_id, filenames in legacy_files.items():
+        guild_path = path / str(guild_id)
+        for filename in filenames:
+            file_path = guild_path / filename
+            try:
+                file_size = file_path.stat().st_size
+                file_path.unlink()
+            except FileNotFoundError:
+                continue
+            files += 1
+            size += file_size
+        try:
+            guild_path.rmdir()
+        except OSError:
+            pass  # Still has files that are in use.
+    return files, size
+
+
+def stat_files(paths: List[Path]) -> Dict[Path, int]:
+    """Gets the size of each file. Files that don't exist are left out."""
+    sizes = {}
+    for path in paths:
+        try:
+            sizes[path] = path.stat().st_size
+        except FileNotFoundError:
+            pass
+    return sizes
+
+
+def plan_upload_batches(uploads: List[AttachmentUpload], max_upload_size: int) -> List[List[AttachmentUpload]]:
+    """Packs the attachments into as few messages as possible, keeping each message under the upload limit.
+    Attachments bigger than max_upload_size must be dealt with before planning."""
+    batches: List[List[AttachmentUpload]] = []
+    batch_sizes: List[int] = []
+    # First fit decreasing. The order of deleted attachments isn't important, getting them all posted is.
+    for upload in sorted(uploads, key=lambda u: u.size, reverse=True):
+        for i, batch in enumerate(batches):
+            if len(batch) < MAX_FILES_PER_MESSAGE and batch_sizes[i] + upload.size <= max_upload_size:
+                batch.append(upload)
+                batch_sizes[i] += upload.size
+                break
+        else:
+            batches.append([upload])
+            batch_sizes.append(upload.size)
+    return batches
+
+
+async def get_attachment_uploads(bot: 'GGBot', guild_id: int, attachment_names: List[str], pool: Optional['db.PoolOrConnection'] = None) -> List[AttachmentUpload]:
+    """Looks up the cached files (and their sizes) for the attachments stored on a cached message. Attachments that are no longer cached are left out.
+    Spoilers are set for attachments that were spoiled originally."""
+    blob_sizes = {}
+    digests = [name.split("/", 1)[0] for name in attachment_names if "/" in name]
+    if len(digests) > 0:
+        blob_sizes = await db.use_attachment_blobs(pool or bot.db_pool, digests) or {}
+
+    legacy_sizes = {}
+    legacy_paths = [attachment_path(guild_id, name)[0] for name in attachment_names if "/" not in name]
+    if len(legacy_paths) > 0:
+        legacy_sizes = await bot.loop.run_in_executor(None, partial(stat_files, legacy_paths))
+
+    uploads = []
+    for name in attachment_names:
+        path, filename = attachment_path(guild_id, name)
+        size = blob_sizes.get(name.split("/", 1)[0]) if "/" in name else legacy_sizes.get(path)
+        if size is None:
+            continue  # The file may have been too old and has since been evicted.
+        uploads.append(AttachmentUpload(filename, size, "SPOILER" in filename, path=path))
+    return uploads
+
+
+async def shrink_oversized_uploads(bot: 'GGBot', uploads: List[AttachmentUpload], max_upload_size: int) -> Tuple[List[AttachmentUpload], List[AttachmentUpload]]:
+    """Downscales any attachments that are too big to upload. Returns the attachments that can be uploaded and those that could not be shrunk."""
+    ready = []
+    too_big = []
+    for upload in uploads:
+        if upload.size <= max_upload_size:
+            ready.append(upload)
+            continue
+
+        shrunk = await bot.loop.run_in_executor(None, partial(downscale_image, upload.path, max_upload_size))
+        if shrunk is None:
+            too_big.append(upload)
+            continue
+
+        data, extension = shrunk
+        filename = f"{Path(upload.filename).stem}{extension}"
+        ready.append(upload._replace(filename=filename, size=len(data.getbuffer()), data=data))
+    return ready, too_big
+
+
+def scan_image_cache(path: Path = IMAGE_CACHE_PATH) -> Tuple[int, int]:
+    """Walks the whole image cache and returns the number of files and bytes in it. Slow, only used to reconcile disk_usage."""
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.stat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                continue  # Removed while we were walking.
+            files += 1
+    return files, size
+
+
+class DiskUsage:
+    """Running totals of the files and bytes in the image cache, kept up to date as blobs are written and removed.
+    Periodically reconciled with a full scan of the image cache as legacy files and crashes aren't accounted for here."""
+
+    def __init__(self):
+        self.reconciled_files: Optional[int] = None  # Unknown until the first reconcile.
+        self.reconciled_bytes: Optional[int] = None
+        self.reconciled_at: Optional[datetime] = None
+        self.files_written = 0
+        self.bytes_written = 0
+        self.files_removed = 0
+        self.bytes_removed = 0
+        self.files_at_reconcile = (0, 0)  # (Files written, Files removed) at the last reconcile.
+        self.bytes_at_reconcile = (0, 0)  # (Bytes written, Bytes removed) at the last reconcile.
+
+    @property
+    def files(self) -> Optional[int]:
+        if self.reconciled_files is None:
+            return None
+        written, removed = self.files_at_reconcile
+        return max(self.reconciled_files + (self.files_written - written) - (self.files_removed - removed), 0)
+
+    @property
+    def bytes(self) -> Optional[int]:
+        if self.reconciled_bytes is None:
+            return None
+        written, removed = self.bytes_at_reconcile
+        return max(self.reconciled_bytes + (self.bytes_written - written) - (self.bytes_removed - removed), 0)
+
+    def written(self, files: int, size: int):
+        self.files_written += files
+        self.bytes_written += size
+
+    def removed(self, files: int, size: int):
+        self.files_removed += files
+        self.bytes_removed += size
+
+    def reconcile(self, files: int, size: int):
+        self.reconciled_files = files
+        self.reconciled_bytes = size
+        self.reconciled_at = datetime.utcnow()
+        self.files_at_reconcile = (self.files_written, self.files_removed)
+        self.bytes_at_reconcile = (self.bytes_written, self.bytes_removed)
+
+
+disk_usage = DiskUsage()
+
+
+class AttachmentDownloader:
+    """
+    Bounded download queue for the image cache.
+    Messages are cached without their attachments and each attachment is added to the cached message once it has been written to the blob store.
+    Each guild has it's own queue and workers take turns between the guilds that have a free download slot,
+    so a guild that floods the queue can't leave every worker waiting on it while other guilds' attachments sit behind it.
+    """
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        # Guild ID: Waiting downloads. Guilds are moved to the end after each turn, so iterating gives the round robin order.
+        self.guild_queues: 'OrderedDict[int, Deque[DownloadJob]]' = OrderedDict()
+        self.queued = 0
+        self.guild_downloads: Dict[int, int] = {}  # Guild ID: Downloads in progress
+        self.job_ready = asyncio.Event()
+        self.workers: List[asyncio.Task] = []
+
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.bytes_downloaded = 0
+        self.recent_downloads: Deque[Tuple[float, int]] = deque()  # (Time finished, Bytes)
+
+
+    def start(self):
+        for _ in range(DOWNLOAD_WORKERS):
+            self.workers.append(self.bot.loop.create_task(self.worker()))
+
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+
+    def enqueue(self, message: discord.Message) -> int:
+        """Queues all the attachments on a message for download. Never blocks. Returns the number of attachments queued."""
+        queued = 0
+        for attachment in message.attachments:
+            if self.queued >= DOWNLOAD_QUEUE_SIZE:
+                self.dropped += 1
+                log.warning(f"Attachment download queue is full. Dropping {attachment.id} from {message.guild.id}")
+                continue
+            guild_queue = self.guild_queues.get(message.guild.id)
+            if guild_queue is None:
+                guild_queue = deque()
+                self.guild_queues[message.guild.id] = guild_queue
+            guild_queue.append(DownloadJob(message.guild.id, message.id, attachment))
+            self.queued += 1
+            queued += 1
+        if queued > 0:
+            self.job_ready.set()
+        return queued
+
+
+    def take_job(self) -> Optional[DownloadJob]:
+        """Takes the next download from the first guild (in round robin order) that isn't already using all of it's download slots."""
+        for guild_id, guild_queue in self.guild_queues.items():
+            if self.guild_downloads.get(guild_id, 0) >= DOWNLOADS_PER_GUILD:
+                continue
+            job = guild_queue.popleft()
+            if len(guild_queue) == 0:
+                del self.guild_queues[guild_id]
+            else:
+                self.guild_queues.move_to_end(guild_id)  # Let the other guilds go first next time.
+            self.queued -= 1
+            self.guild_downloads[guild_id] = self.guild_downloads.get(guild_id, 0) + 1
+            return job
+        return None
+
+
+    async def worker(self):
+        while True:
+            job = self.take_job()
+            if job is None:
+                # Nothing we can start right now. Wait for a new download or for a guild to free up a slot.
+                self.job_ready.clear()
+                await self.job_ready.wait()
+                continue
+
+            try:
+                self.in_progress += 1
+                try:
+                    await self.download(job)
+                finally:
+                    self.in_progress -= 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                log.exception(f"Failed to cache attachment {job.attachment.id} from {job.guild_id}")
+                await miscUtils.log_error_msg(self.bot, e)
+            finally:
+                remaining = self.guild_downloads[job.guild_id] - 1
+                if remaining > 0:
+                    self.guild_downloads[job.guild_id] = remaining
+                else:
+                    del self.guild_downloads[job.guild_id]
+                self.job_ready.set()
+
+
+    async def download(self, job: DownloadJob):
+        log.info("Saving Attachment from {}".format(job.guild_id))
+
+        data = await job.attachment.read()
+        digest = await self.bot.loop.run_in_executor(None, partial(blob_digest, data))
+        async with blob_locks.lock(digest):  # The file can't be removed between checking for it and registering the blob.
+            written = await self.bot.loop.run_in_executor(None, partial(store_blob, data, digest))
+            if written:
+                disk_usage.written(1, len(data))
+            self.record_download(len(data))
+
+            # If the message was deleted while the attachment was downloading, the blob is left unreferenced and gets collected later.
+            await db.add_cached_attachment(self.bot.db_pool, job.guild_id, job.message_id, digest, len(data), job.attachment.filename)
+
+
+    def record_download(self, size: int):
+        now = time.monotonic()
+        self.completed += 1
+        self.bytes_downloaded += size
+        self.recent_downloads.append((now, size))
+        self.trim_recent_downloads(now)
+
+
+    def trim_recent_downloads(self, now: float):
+        while len(self.recent_downloads) > 0 and self.recent_downloads[0][0] < now - THROUGHPUT_WINDOW:
+            self.recent_downloads.popleft()
+
+
+    def stats(self) -> DownloaderStats:
+        self.trim_recent_downloads(time.monotonic())
+        recent_bytes = sum(size for _, size in self.recent_downloads)
+        return DownloaderStats(self.queued, DOWNLOAD_QUEUE_SIZE, self.in_progress, self.completed, self.failed,
+                               self.dropped, self.bytes_downloaded, recent_bytes / THROUGHPUT_WINDOW)
+
+
+class ImageCacheEvictor:
+    """
+    Keeps the image cache within its limits.
+    Works entirely off the attachment_blobs/attachment_refs tables, the blob store is never walked.
+    Only the legacy per guild directories are listed, until the last of their files has been deleted.
+    """
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.evicted = 0
+        self.released = 0
+        self.legacy_swept = False  # Set once there are no legacy files left.
+
+
+    def start(self):
+        self.evict.start()
+
+
+    def stop(self):
+        self.evict.cancel()
+
+
+    def limit(self, key: str, default: int) -> Optional[int]:
+        config = self.bot.config or {}
+        return config.get(key, default)
+
+
+    async def remove_blobs(self, digests: Optional[List[str]]):
+        """Deletes the files of blobs that were removed from the DB, unless a download has registered them again since."""
+        if not digests:
+            return
+
+        stripes: Dict[int, List[str]] = {}
+        for digest in set(digests):
+            stripes.setdefault(blob_locks.stripe(digest), []).append(digest)
+
+        for stripe in stripes.values():
+            async with blob_locks.lock(stripe[0]):
+                registered = await db.get_attachment_blob_sizes(self.bot.db_pool, stripe)
+                if registered is None:
+                    log.warning(f"Could not check if {len(stripe)} attachment blobs were registered again. Leaving their files in place.")
+                    continue
+                removable = [digest for digest in stripe if digest not in registered]
+                if len(removable) > 0:
+                    files, size = await self.bot.loop.run_in_executor(None, partial(remove_blobs, removable))
+                    disk_usage.removed(files, size)
+
+
+    async def release(self, digests: Optional[List[str]]):
+        """Removes the blobs released by deleting cached messages."""
+        if digests:
+            self.released += len(digests)
+            await self.remove_blobs(digests)
+
+
+    # noinspection PyCallingNonCallable
+    @tasks.loop(minutes=EVICTION_INTERVAL)
+    async def evict(self):
+        pool = self.bot.db_pool
+        removed = await db.delete_unused_attachment_blobs(pool, BLOB_GC_GRACE) or []
+
+        max_age_days = self.limit('image_cache_max_age_days', IMAGE_CACHE_MAX_AGE_DAYS)
+        if max_age_days is not None:
+            removed += await db.evict_old_attachment_blobs(pool, max_age_days) or []
+
+        guild_max_mb = self.limit('image_cache_guild_max_mb', IMAGE_CACHE_GUILD_MAX_MB)
+        if guild_max_mb is not None:
+            removed += await db.evict_guild_attachments_over_quota(pool, guild_max_mb * 1024 * 1024) or []
+
+        max_mb = self.limit('image_cache_max_mb', IMAGE_CACHE_MAX_MB)
+        if max_mb is not None:
+            removed += await db.evict_attachment_blobs_over_quota(pool, max_mb * 1024 * 1024) or []
+
+        if len(removed) > 0:
+            await self.remove_blobs(removed)
+            self.evicted += len(removed)
+            log.info(f"Evicted {len(removed)} attachment blobs from the image cache.")
+
+        if not self.legacy_swept:
+            await self.sweep_legacy_files()
+
+
+    async def sweep_legacy_files(self):
+        """Deletes the files in the legacy per guild directories that no cached message refers to anymore."""
+        legacy_files = await self.bot.loop.run_in_executor(None, list_legacy_files)
+        if len(legacy_files) == 0:
+            self.legacy_swept = True
+            return
+
+        referenced = await db.get_legacy_attachment_names(self.bot.db_pool)
+        if referenced is None:
+            return  # Couldn't check. Try again next pass.
+
+        unreferenced = {guild_id: [name for name in filenames if name not in referenced.get(guild_id, set())]
+                        for guild_id, filenames in legacy_files.items()}
+        files, size = await self.bot.loop.run_in_executor(None, partial(remove_legacy_files, unreferenced))
+        disk_usage.removed(files, size)
+        if files > 0:
+            log.info(f"Removed {files} legacy files ({size / 1024 / 1024:.2f} MB) from the image cache.")
+
+
+    @evict.before_loop
+    async def before_evict(self):
+        await self.bot.wait_until_ready()
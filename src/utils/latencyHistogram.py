@@ -0,0 +1,122 @@
+"""
+Fixed memory latency histograms.
+Latencies are counted in log spaced buckets so memory use depends on the range of latencies seen, not the number of calls,
+and percentiles can be read back with a bounded relative error.
+Recent calls are also kept in short time slots so stats can be reported over sliding windows.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import math
+import time
+from collections import deque
+from typing import Dict, Optional, Deque, Tuple
+
+BUCKET_GROWTH = 1.1  # Each bucket is 10% wider than the one before it, so reported percentiles are within ~5% of the real value.
+MIN_LATENCY = 0.01  # ms. Everything at or below this lands in the first bucket.
+SLOT_SECONDS = 10  # Granularity of the sliding windows.
+MAX_WINDOW = 15 * 60  # Seconds of slots to keep. The longest window that can be reported on.
+
+WINDOWS: Dict[str, Optional[int]] = {'1m': 60, '15m': 15 * 60, 'all': None}  # Window name: Length in seconds, or None for since startup.
+
+_LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+
+def bucket_index(latency: float) -> int:
+    if latency <= MIN_LATENCY:
+        return 0
+    return int(math.log(latency / MIN_LATENCY) / _LOG_GROWTH) + 1
+
+
+def bucket_value(index: int) -> float:
+    """The value reported for latencies in the bucket. The geometric middle of the buckets range."""
+    if index == 0:
+        return MIN_LATENCY
+    return MIN_LATENCY * BUCKET_GROWTH ** (index - 0.5)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}  # Sparse. Only buckets that have seen a call are stored.
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency: float):
+        index = bucket_index(latency)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def merge(self, other: 'Histogram'):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, percent: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'calls': self.count,
+            'errors': self.errors,
+            'avg': self.mean(),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class WindowedHistogram:
+    """A Histogram of everything since startup, plus one per SLOT_SECONDS for the last MAX_WINDOW seconds."""
+
+    def __init__(self):
+        self.since_start = Histogram()
+        self.slots: Deque[Tuple[int, Histogram]] = deque()  # (Slot number, Histogram) oldest first.
+
+    def _current_slot(self) -> Histogram:
+        slot_number = int(time.monotonic() // SLOT_SECONDS)
+        if len(self.slots) == 0 or self.slots[-1][0] != slot_number:
+            self.slots.append((slot_number, Histogram()))
+            oldest_kept = slot_number - MAX_WINDOW // SLOT_SECONDS
+            while self.slots[0][0] <= oldest_kept:
+                self.slots.popleft()
+        return self.slots[-1][1]
+
+    def add(self, latency: float):
+        self.since_start.add(latency)
+        self._current_slot().add(latency)
+
+    def error(self):
+        self.since_start.errors += 1
+        self._current_slot().errors += 1
+
+    def window(self, seconds: Optional[int]) -> Histogram:
+        """Merges the slots covering roughly the last `seconds` seconds (rounded up to whole slots). None gets everything since startup."""
+        if seconds is None:
+            return self.since_start
+        first_slot = int(time.monotonic() // SLOT_SECONDS) - seconds // SLOT_SECONDS
+        histogram = Histogram()
+        for slot_number, slot in self.slots:
+            if slot_number > first_slot:
+                histogram.merge(slot)
+        return histogram
@@ -0,0 +1,147 @@
+"""
+Durable delivery for logs.
+Before a log (that doesn't carry a file) is sent, its embed is written to the log_outbox table.
+The entry is removed once Discord has accepted the log. If Discord errors (5xx) or can't be reached the entry is kept and
+a background sender retries it with exponential backoff, which also picks up anything left over from before a restart.
+Delivery is at least once: a crash between Discord accepting a log and the entry being removed will send it again.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Optional
+
+import aiohttp
+import discord
+from discord.ext import tasks
+
+import db
+from utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+OUTBOX_INTERVAL = 30  # Seconds between checks for logs that need to be retried.
+OUTBOX_BATCH_SIZE = 100  # Max logs retried per check.
+OUTBOX_CLAIM_SECONDS = 10 * 60  # How long a log being sent is left alone by the background sender.
+RETRY_BASE_DELAY = 30  # Seconds before the first retry. Doubles with each failed attempt.
+RETRY_MAX_DELAY = 60 * 60
+MAX_ATTEMPTS = 10  # Logs that still couldn't be delivered after this many attempts are dropped.
+
+
+def retry_delay(attempts: int) -> int:
+    return min(RETRY_BASE_DELAY * 2 ** attempts, RETRY_MAX_DELAY)
+
+
+class LogOutbox:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+
+
+    def start(self):
+        self.send_due.start()
+
+
+    def stop(self):
+        self.send_due.cancel()
+
+
+    async def add(self, log_ch: discord.TextChannel, event_type: str, embed: discord.Embed, pool: Optional[db.PoolOrConnection] = None) -> Optional[int]:
+        """Adds a log to the outbox without sending it. Pass a unit of work in a transaction to add it atomically with other changes.
+        The returned ID should be passed to send_log."""
+        return await db.add_outbox_log(pool or self.bot.db_pool, log_ch.guild.id, log_ch.id, event_type, embed.to_dict(), OUTBOX_CLAIM_SECONDS)
+
+
+    async def send(self, log_ch: discord.TextChannel, event_type: str, embed: discord.Embed, outbox_id: Optional[int] = None) -> Optional[discord.Message]:
+        """
+        Sends a log through the outbox. outbox_id is for logs that were already added to the outbox with add().
+        Returns None if the log couldn't be sent now and will be retried. Other errors (e.g. Forbidden) are raised.
+        """
+        if outbox_id is None:
+            outbox_id = await self.add(log_ch, event_type, embed)
+            if outbox_id is None:
+                # Couldn't persist it. Still try to deliver it, just without the safety net.
+                return await self.bot.log_queue.send(log_ch, event_type, embed=embed)
+        return await self.deliver(log_ch, event_type, embed, outbox_id, attempts=0)
+
+
+    async def deliver(self, log_ch: discord.TextChannel, event_type: str, embed: discord.Embed, outbox_id: int, attempts: int) -> Optional[discord.Message]:
+        try:
+            message = await self.bot.log_queue.send(log_ch, event_type, embed=embed)
+        except discord.HTTPException as e:
+            if e.status >= 500:
+                await self.retry_later(outbox_id, attempts, e)
+                return None
+            await db.remove_outbox_log(self.bot.db_pool, outbox_id)  # Retrying won't help.
+            self.dropped += 1
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            await self.retry_later(outbox_id, attempts, e)
+            return None
+
+        await db.remove_outbox_log(self.bot.db_pool, outbox_id)
+        self.delivered += 1
+        return message
+
+
+    async def retry_later(self, outbox_id: int, attempts: int, error: Exception):
+        if attempts + 1 >= MAX_ATTEMPTS:
+            log.warning(f"Dropping log {outbox_id} after {attempts + 1} failed attempts: {error}")
+            await db.remove_outbox_log(self.bot.db_pool, outbox_id)
+            self.dropped += 1
+            return
+
+        delay = retry_delay(attempts)
+        log.warning(f"Could not deliver log {outbox_id} ({error}). Retrying in {delay} seconds.")
+        await db.retry_outbox_log(self.bot.db_pool, outbox_id, delay)
+        self.retried += 1
+
+
+    async def resend(self, outbox_log: db.OutboxLog):
+        try:
+            channel = await self.bot.get_channel_safe(outbox_log.channel_id)
+        except discord.HTTPException as e:
+            await self.retry_later(outbox_log.id, outbox_log.attempts, e)
+            return
+        if channel is None:
+            await db.remove_outbox_log(self.bot.db_pool, outbox_log.id)  # The log channel is gone.
+            self.dropped += 1
+            return
+
+        if not self.bot.log_permissions.can_send(channel, embed=True, file=False):
+            # Permissions may have been removed since the log was queued. Sending it would only get a 403.
+            await db.remove_outbox_log(self.bot.db_pool, outbox_log.id)
+            self.dropped += 1
+            await self.bot.log_permissions.log_lost(channel, outbox_log.event_type, "missing_permissions")
+            return
+
+        try:
+            await self.deliver(channel, outbox_log.event_type, discord.Embed.from_dict(outbox_log.payload), outbox_log.id, outbox_log.attempts)
+        except discord.HTTPException as e:
+            log.info(f"Dropped log {outbox_log.id} for {outbox_log.channel_id}: {e}")
+
+
+    # noinspection PyCallingNonCallable
+    @tasks.loop(seconds=OUTBOX_INTERVAL)
+    async def send_due(self):
+        due = await db.claim_due_outbox_logs(self.bot.db_pool, OUTBOX_BATCH_SIZE, OUTBOX_CLAIM_SECONDS) or []
+        if len(due) > 0:
+            log.info(f"Retrying {len(due)} undelivered logs.")
+            # Sent together so logs to the same channel can share a message. The log queue keeps them in order.
+            results = await asyncio.gather(*[self.resend(outbox_log) for outbox_log in due], return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    log.error("Error retrying a log", exc_info=result)
+            metrics.inc("log_outbox_resent_total", len(due))
+
+
+    @send_due.before_loop
+    async def before_send_due(self):
+        await self.bot.wait_until_ready()
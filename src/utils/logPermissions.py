@@ -0,0 +1,117 @@
+"""
+Cached permission checks for log channels.
+Logs that would be rejected by Discord for missing permissions are skipped instead of being sent,
+as every rejected request counts towards Discord's invalid request limit. Each skipped log is counted,
+and the guild is warned about the problem at most once per channel every WARNING_COOLDOWN.
+
+The bots effective permissions in a channel are only recalculated after the guilds channels, roles, or the bots own member change.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import time
+import logging
+from typing import TYPE_CHECKING, Optional, Dict, Tuple
+
+import discord
+
+from utils.errors import handle_permissions_error
+from utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+WARNING_COOLDOWN = 6 * 60 * 60  # Seconds between permission warnings for the same log channel.
+
+
+class LogPermissions:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.permissions: Dict[int, Dict[int, discord.Permissions]] = {}  # Guild ID: {Channel ID: The bots permissions in the channel}
+        self.last_warned: Dict[Tuple[int, int], float] = {}  # (Guild ID, Channel ID): When the guild was last warned.
+        self.skipped = 0
+
+
+    def start(self):
+        for event in ("on_guild_channel_update", "on_guild_channel_delete", "on_guild_role_update", "on_guild_role_delete",
+                      "on_member_update", "on_guild_update", "on_guild_remove"):
+            self.bot.add_listener(getattr(self, event), event)
+
+
+    def get(self, channel: discord.TextChannel) -> discord.Permissions:
+        guild_permissions = self.permissions.setdefault(channel.guild.id, {})
+        permissions = guild_permissions.get(channel.id)
+        if permissions is None:
+            permissions = channel.permissions_for(channel.guild.me)
+            guild_permissions[channel.id] = permissions
+        return permissions
+
+
+    def can_send(self, channel: discord.TextChannel, embed: bool, file: bool, via_log_queue: bool = True) -> bool:
+        """via_log_queue should be False for messages sent directly with channel.send, as they never go through the log webhook."""
+        if via_log_queue and self.bot.log_queue.webhooks.enabled and channel.id in self.bot.log_queue.webhooks.webhooks:
+            return True  # Webhook sends don't depend on the bots permissions.
+        permissions = self.get(channel)
+        return permissions.read_messages and permissions.send_messages and (permissions.embed_links or not embed) and (permissions.attach_files or not file)
+
+
+    async def log_lost(self, channel: discord.TextChannel, event_type: str, reason: str, exception: Optional[Exception] = None):
+        """Counts a log that couldn't be sent and warns the guild, unless it was warned about the channel recently."""
+        self.skipped += 1
+        metrics.inc("logs_lost_total", event_type=event_type, reason=reason)
+
+        key = (channel.guild.id, channel.id)
+        now = time.monotonic()
+        last_warned = self.last_warned.get(key)
+        if last_warned is not None and now - last_warned < WARNING_COOLDOWN:
+            return
+        self.last_warned[key] = now
+        await handle_permissions_error(self.bot, channel, event_type, exception, None)
+
+
+    def invalidate(self, guild_id: int):
+        self.permissions.pop(guild_id, None)
+
+
+    def invalidate_warnings(self, guild_id: int):
+        for key in [key for key in self.last_warned if key[0] == guild_id]:
+            del self.last_warned[key]
+
+    # ----- Invalidation Events ----- #
+
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        # Category overwrites can be synced to their channels, so any channel change could affect others.
+        if before.overwrites != after.overwrites or before.category_id != after.category_id:
+            self.invalidate(after.guild.id)
+
+
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.permissions.get(channel.guild.id, {}).pop(channel.id, None)
+
+
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.permissions != after.permissions:
+            self.invalidate(after.guild.id)
+
+
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.invalidate(role.guild.id)
+
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if after.id == self.bot.user.id and before.roles != after.roles:
+            self.invalidate(after.guild.id)
+            self.invalidate_warnings(after.guild.id)  # Someone is likely fixing our permissions. Let them know right away if it's still broken.
+
+
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            self.invalidate(after.id)
+
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.invalidate(guild.id)
+        self.invalidate_warnings(guild.id)
@@ -0,0 +1,175 @@
+"""
+Per log channel outbound queue.
+Logs headed for the same channel are sent in order, and logs that queue up together (e.g. while the channel is rate limited)
+are packed into a single message with up to 10 embeds instead of one message each.
+
+discord.py 1.7 can only send a single embed per message, so batches are posted directly to the create message endpoint.
+When webhook delivery is enabled, logs are sent through the channels log webhook instead whenever one is available.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Optional, Dict, List, Deque, NamedTuple
+
+import discord
+from discord.http import Route
+
+from utils.metrics import metrics
+from utils.logWebhooks import LogWebhooks
+
+if TYPE_CHECKING:
+    from bot import GGBot
+
+log = logging.getLogger(__name__)
+
+LOG_BATCH_WINDOW = 0.25  # Seconds to wait for other logs to the same channel before sending the first one.
+MAX_EMBEDS_PER_MESSAGE = 10  # Discord limit.
+MAX_EMBED_CHARACTERS_PER_MESSAGE = 6000  # Discord limit on the combined length of every embed in a message.
+
+
+class QueuedLog(NamedTuple):
+    event_type: str
+    embed: Optional[discord.Embed]
+    file: Optional[discord.File]
+    future: asyncio.Future
+
+
+class ChannelQueue:
+
+    def __init__(self, channel: discord.TextChannel):
+        self.channel = channel
+        self.logs: Deque[QueuedLog] = deque()
+        self.worker: Optional[asyncio.Task] = None
+
+
+def take_batch(logs: Deque[QueuedLog]) -> List[QueuedLog]:
+    """Takes the next batch of logs off the front of the queue. Logs with a file (or without an embed) are always sent on their own."""
+    first = logs.popleft()
+    batch = [first]
+    if first.file is not None or first.embed is None:
+        return batch
+
+    characters = len(first.embed)
+    while len(logs) > 0 and len(batch) < MAX_EMBEDS_PER_MESSAGE:
+        queued_log = logs[0]
+        if queued_log.file is not None or queued_log.embed is None:
+            break
+        if characters + len(queued_log.embed) > MAX_EMBED_CHARACTERS_PER_MESSAGE:
+            break
+        characters += len(queued_log.embed)
+        batch.append(logs.popleft())
+    return batch
+
+
+def set_result(queued_log: QueuedLog, message: Optional[discord.Message]):
+    if not queued_log.future.done():
+        queued_log.future.set_result(message)
+
+
+def set_exception(queued_log: QueuedLog, exception: Exception):
+    if not queued_log.future.done():
+        queued_log.future.set_exception(exception)
+
+
+class OutboundLogQueue:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.channels: Dict[int, ChannelQueue] = {}
+        self.webhooks = LogWebhooks(bot)
+
+
+    async def send(self, log_ch: discord.TextChannel, event_type: str, embed: Optional[discord.Embed] = None,
+                   file: Optional[discord.File] = None) -> Optional[discord.Message]:
+        """Queues a log and waits for it to be sent. Raises the same exceptions TextChannel.send would."""
+        channel_queue = self.channels.get(log_ch.id)
+        if channel_queue is None:
+            channel_queue = ChannelQueue(log_ch)
+            self.channels[log_ch.id] = channel_queue
+        channel_queue.channel = log_ch  # Keep the freshest channel object around.
+
+        future = self.bot.loop.create_future()
+        channel_queue.logs.append(QueuedLog(event_type, embed, file, future))
+        if channel_queue.worker is None:
+            channel_queue.worker = self.bot.loop.create_task(self.run_channel(channel_queue))
+        return await future
+
+
+    async def run_channel(self, channel_queue: ChannelQueue):
+        """Sends everything queued for a channel, then exits. A new worker is started by the next log."""
+        try:
+            await asyncio.sleep(LOG_BATCH_WINDOW)  # Give logs from events that happened at the same time a chance to queue up.
+            while len(channel_queue.logs) > 0:
+                # Anything queued while this batch is being sent (or rate limited) goes out in the next one.
+                await self.send_batch(channel_queue.channel, take_batch(channel_queue.logs))
+        finally:
+            for queued_log in channel_queue.logs:  # Only if we were cancelled.
+                queued_log.future.cancel()
+            channel_queue.logs.clear()
+            channel_queue.worker = None
+            if self.channels.get(channel_queue.channel.id) is channel_queue:
+                del self.channels[channel_queue.channel.id]
+
+
+    async def send_batch(self, channel: discord.TextChannel, batch: List[QueuedLog]):
+        try:
+            message = await self.deliver(channel, batch)
+        except asyncio.CancelledError:
+            for queued_log in batch:
+                queued_log.future.cancel()
+            raise
+        except discord.Forbidden as e:
+            for queued_log in batch:  # Nothing in the batch can be sent. Let each send_log handle it as before.
+                set_exception(queued_log, e)
+            return
+        except discord.HTTPException as e:
+            if len(batch) == 1:
+                set_exception(batch[0], e)
+                return
+            # Don't let one bad embed lose the rest of the batch.
+            log.warning(f"Failed to send a batch of {len(batch)} logs to {channel.id}, sending them one at a time: {e}")
+            for queued_log in batch:
+                await self.send_batch(channel, [queued_log])
+            return
+        except Exception as e:
+            for queued_log in batch:
+                set_exception(queued_log, e)
+            return
+
+        for queued_log in batch:
+            set_result(queued_log, message)
+
+
+    async def deliver(self, channel: discord.TextChannel, batch: List[QueuedLog]) -> discord.Message:
+        batched = "true" if len(batch) > 1 else "false"
+        if self.webhooks.enabled:
+            webhook = await self.webhooks.get_webhook(channel)
+            if webhook is not None:
+                try:
+                    message = await self.webhooks.send(webhook, batch)
+                    metrics.inc("log_messages_sent_total", batched=batched, via="webhook")
+                    return message
+                except discord.HTTPException as e:
+                    if e.status not in (401, 404):
+                        raise
+                    # The webhook was deleted. Send this batch as the bot and make a new webhook next time.
+                    log.info(f"The log webhook for {channel.id} is gone: {e}")
+                    await self.webhooks.forget(channel.id)
+                    if batch[0].file is not None:
+                        batch[0].file.reset()
+
+        if len(batch) == 1:
+            message = await channel.send(embed=batch[0].embed, file=batch[0].file)
+        else:
+            message = await self.send_embeds(channel, [queued_log.embed for queued_log in batch])
+        metrics.inc("log_messages_sent_total", batched=batched, via="bot")
+        return message
+
+
+    async def send_embeds(self, channel: discord.TextChannel, embeds: List[discord.Embed]) -> discord.Message:
+        route = Route('POST', '/channels/{channel_id}/messages', channel_id=channel.id)
+        data = await self.bot.http.request(route, json={'embeds': [embed.to_dict() for embed in embeds]})
+        return self.bot._connection.create_message(channel=channel, data=data)
@@ -0,0 +1,155 @@
+"""
+Logging setup.
+Log records are put on a queue by the thread that logs them and written out by a QueueListener on it's own thread,
+so writing to stdout never stalls the event loop. Output is one JSON object per line by default (log_format: "json"),
+or the classic text format with log_format: "text".
+
+Log levels can be set per module with log_levels in the config (e.g. {"discord": "WARNING", "events.messageDelete": "DEBUG"}),
+and noisy modules can be limited to a number of records per second with log_rate_limits (e.g. {"bot": 20}).
+Both apply by logger name, so they only cover modules that log through `log = logging.getLogger(__name__)`,
+not calls straight to the root logger (logging.info() etc.) which is only used by GabbyGums.py itself.
+Warnings and errors are never rate limited. Records dropped by the rate limit (or because the queue is full) are counted,
+and the number suppressed is attached to the next record that gets through.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import sys
+import json
+import time
+import queue
+import logging
+import logging.handlers
+from datetime import datetime
+from typing import Optional, Dict
+
+from utils.metrics import metrics
+from utils.tracing import current_trace
+
+log = logging.getLogger(__name__)
+
+LOG_QUEUE_SIZE = 10000  # Records waiting to be written. Records logged while the queue is full are dropped.
+TEXT_FORMAT = "[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('trace', 'trace_tags', 'suppressed'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `rate` records per second (with bursts of up to `rate`) below WARNING from the configured loggers and their children."""
+
+    def __init__(self, rate_limits: Dict[str, float]):
+        super().__init__()
+        self.rate_limits = rate_limits
+        self.buckets: Dict[str, list] = {}  # Logger name: [Tokens, Last refill time]
+        self.suppressed: Dict[str, int] = {}  # Logger name: Records dropped since the last one that got through.
+
+
+    def find_limit(self, logger_name: str) -> Optional[str]:
+        name = logger_name
+        while True:
+            if name in self.rate_limits:
+                return name
+            if "." not in name:
+                return None
+            name = name.rsplit(".", 1)[0]
+
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        limited_name = self.find_limit(record.name)
+        if limited_name is None:
+            return True
+
+        rate = self.rate_limits[limited_name]
+        now = time.monotonic()
+        bucket = self.buckets.get(limited_name)
+        if bucket is None:
+            bucket = [rate, now]
+            self.buckets[limited_name] = bucket
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            self.suppressed[limited_name] = self.suppressed.get(limited_name, 0) + 1
+            metrics.inc("log_records_dropped_total", logger=limited_name, reason="rate_limited")
+            return False
+
+        bucket[0] -= 1
+        suppressed = self.suppressed.pop(limited_name, 0)
+        if suppressed > 0:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Drops records instead of blocking when the queue is full, and formats exceptions here while the traceback is still around."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.exception_formatter = logging.Formatter()
+
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The record is handed to another thread, so anything that isn't safe to use there is resolved now.
+        active_trace = current_trace.get()
+        if active_trace is not None:
+            record.trace = active_trace.name
+            record.trace_tags = dict(active_trace.tags)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total", logger=record.name, reason="queue_full")
+
+
+def setup_logging(config: Dict) -> logging.handlers.QueueListener:
+    """Routes all logging through a queue. The returned listener should be stopped on shutdown to flush what's left."""
+    output_handler = logging.StreamHandler(sys.stderr)
+    if config.get('log_format', "json") == "json":
+        output_handler.setFormatter(JsonFormatter())
+    else:
+        output_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    rate_limits = config.get('log_rate_limits', {})
+    if len(rate_limits) > 0:
+        queue_handler.addFilter(RateLimitFilter(rate_limits))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.get('log_level', "INFO"))
+
+    for logger_name, level in config.get('log_levels', {}).items():
+        logging.getLogger(logger_name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output_handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,109 @@
+"""
+Webhook delivery for logs.
+When log_delivery is set to "webhook" in the config, logs are sent through a webhook Gabby Gums creates in each log channel.
+Every webhook has it's own rate limits, so busy log channels don't use up the bots send budget, and can carry 10 embeds per message.
+Channels where Gabby Gums can't manage webhooks (and has no stored webhook) keep getting logs sent by the bot.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from typing import TYPE_CHECKING, Optional, Dict, List, Set
+
+import aiohttp
+import discord
+
+import db
+
+if TYPE_CHECKING:
+    from bot import GGBot
+    from utils.logQueue import QueuedLog
+
+log = logging.getLogger(__name__)
+
+WEBHOOK_NAME = "Gabby Gums Logs"
+
+
+class LogWebhooks:
+
+    def __init__(self, bot: 'GGBot'):
+        self.bot = bot
+        self.webhooks: Dict[int, discord.Webhook] = {}  # Log channel ID: Webhook
+        self.checked_db: Set[int] = set()  # Channels whose stored webhook (if any) has already been loaded.
+        self.locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+
+    @property
+    def enabled(self) -> bool:
+        config = self.bot.config or {}
+        return config.get('log_delivery', "bot") == "webhook"
+
+
+    async def get_webhook(self, channel: discord.TextChannel) -> Optional[discord.Webhook]:
+        """Gets the log webhook for the channel, creating it if needed. Returns None if there isn't one and it can't be made."""
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
+
+        async with self.locks[channel.id]:  # Make sure logs that queue up at the same time don't each create a webhook.
+            webhook = self.webhooks.get(channel.id)
+            if webhook is None:
+                webhook = await self.load_webhook(channel)
+                if webhook is not None:
+                    self.webhooks[channel.id] = webhook
+        return webhook
+
+
+    async def load_webhook(self, channel: discord.TextChannel) -> Optional[discord.Webhook]:
+        if channel.id not in self.checked_db:
+            stored = await db.get_log_webhook(self.bot.db_pool, channel.id)
+            self.checked_db.add(channel.id)
+            if stored is not None:
+                return self.partial_webhook(stored.webhook_id, stored.webhook_token)
+
+        # Checked every time so granting the permission takes effect without a restart.
+        if not channel.permissions_for(channel.guild.me).manage_webhooks:
+            return None
+
+        try:
+            # Reuse a webhook we made before if it's still there (e.g. after the DB entry was lost).
+            existing = [webhook for webhook in await channel.webhooks()
+                        if webhook.user is not None and webhook.user.id == self.bot.user.id and webhook.token is not None]
+            if len(existing) > 0:
+                webhook = existing[0]
+            else:
+                webhook = await channel.create_webhook(name=WEBHOOK_NAME, reason="Used to deliver Gabby Gums logs.")
+        except discord.HTTPException as e:
+            log.warning(f"Could not get a log webhook for {channel.id} in {channel.guild.id}: {e}")
+            return None
+
+        await db.set_log_webhook(self.bot.db_pool, channel.guild.id, channel.id, webhook.id, webhook.token)
+        return self.partial_webhook(webhook.id, webhook.token)
+
+
+    def partial_webhook(self, webhook_id: int, token: str) -> discord.Webhook:
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        return discord.Webhook.partial(webhook_id, token, adapter=discord.AsyncWebhookAdapter(self.session))
+
+
+    async def forget(self, channel_id: int):
+        """Drops a webhook that no longer works. A new one will be made the next time the channel is logged to."""
+        self.webhooks.pop(channel_id, None)
+        await db.remove_log_webhook(self.bot.db_pool, channel_id)
+
+
+    async def send(self, webhook: discord.Webhook, batch: List['QueuedLog']) -> discord.WebhookMessage:
+        embeds = [queued_log.embed for queued_log in batch if queued_log.embed is not None]
+        file = batch[0].file if len(batch) == 1 else None  # Logs with files are always sent on their own.
+        return await webhook.send(embeds=embeds if len(embeds) > 0 else None, file=file, wait=True,
+                                  username=self.bot.user.name, avatar_url=str(self.bot.user.avatar_url))
+
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
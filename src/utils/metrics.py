@@ -0,0 +1,180 @@
+"""
+Process wide metrics and an optional local HTTP endpoint that serves them in the Prometheus text format.
+Counters and latencies are recorded as things happen. Gauges (and counters that are already kept elsewhere)
+are registered as callbacks and only read when the endpoint is scraped.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import logging
+import asyncio
+from collections import defaultdict
+from typing import Dict, Tuple, Callable, Optional, List, Union
+
+from aiohttp import web
+
+from utils.latencyHistogram import WindowedHistogram, Histogram
+
+log = logging.getLogger(__name__)
+
+PREFIX = "gabbygums_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SUMMARY_WINDOW = 60  # Seconds. Summary quantiles are computed over this sliding window. _sum and _count are since startup.
+QUANTILES = (0.5, 0.95, 0.99)
+
+LabelSet = Tuple[Tuple[str, str], ...]
+GaugeValue = Union[Optional[float], Dict[LabelSet, Optional[float]]]  # Either a single value, or values by label set. None values are skipped.
+
+
+def labels(**kwargs) -> LabelSet:
+    return tuple(sorted((key, str(value)) for key, value in kwargs.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_set: LabelSet, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(label_set) + ([extra] if extra is not None else [])
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.help: Dict[str, str] = {}
+        self.counters: Dict[str, Dict[LabelSet, float]] = defaultdict(lambda: defaultdict(int))
+        self.latencies: Dict[str, Dict[LabelSet, WindowedHistogram]] = defaultdict(lambda: defaultdict(WindowedHistogram))
+        self.latency_sources: Dict[str, Tuple[str, Dict[str, WindowedHistogram]]] = {}  # Name: (Label name, Histograms kept elsewhere by label value)
+        self.callbacks: Dict[str, Tuple[str, Callable[[], GaugeValue]]] = {}  # Name: (Prometheus type, Callback)
+
+
+    def describe(self, name: str, help_text: str):
+        self.help[PREFIX + name] = help_text
+
+
+    def inc(self, name: str, value: float = 1, **label_values):
+        self.counters[PREFIX + name][labels(**label_values)] += value
+
+
+    def observe(self, name: str, latency: float, **label_values):
+        """Records a latency in ms."""
+        self.latencies[PREFIX + name][labels(**label_values)].add(latency)
+
+
+    def add_latency_source(self, name: str, label_name: str, histograms: Dict[str, WindowedHistogram], help_text: str):
+        """Exports histograms that are kept elsewhere (e.g. db.db_perf), labeled with their key."""
+        self.latency_sources[PREFIX + name] = (label_name, histograms)
+        self.describe(name, help_text)
+
+
+    def add_gauge(self, name: str, callback: Callable[[], GaugeValue], help_text: str, metric_type: str = "gauge"):
+        """Registers a value that's read when the metrics are scraped. Use metric_type='counter' for running totals kept elsewhere."""
+        self.callbacks[PREFIX + name] = (metric_type, callback)
+        self.describe(name, help_text)
+
+
+    def render(self) -> str:
+        lines: List[str] = []
+
+        for name, values in self.counters.items():
+            self._header(lines, name, "counter")
+            for label_set, value in values.items():
+                lines.append(f"{name}{_format_labels(label_set)} {_format_value(value)}")
+
+        for name, histograms in self.latencies.items():
+            self._header(lines, name, "summary")
+            for label_set, histogram in list(histograms.items()):
+                self._render_summary(lines, name, label_set, histogram)
+
+        for name, (label_name, histograms) in self.latency_sources.items():
+            self._header(lines, name, "summary")
+            for key, histogram in list(histograms.items()):
+                self._render_summary(lines, name, labels(**{label_name: key}), histogram)
+
+        for name, (metric_type, callback) in self.callbacks.items():
+            try:
+                value = callback()
+            except Exception as e:
+                log.warning(f"Could not read the metric {name}: {e}")
+                continue
+            self._header(lines, name, metric_type)
+            values = value if isinstance(value, dict) else {(): value}
+            for label_set, label_value in values.items():
+                if label_value is not None:
+                    lines.append(f"{name}{_format_labels(label_set)} {_format_value(label_value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def _header(self, lines: List[str], name: str, metric_type: str):
+        if name in self.help:
+            lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+
+    @staticmethod
+    def _render_summary(lines: List[str], name: str, label_set: LabelSet, histogram: WindowedHistogram):
+        recent: Histogram = histogram.window(SUMMARY_WINDOW)
+        for quantile in QUANTILES:
+            lines.append(f"{name}{_format_labels(label_set, ('quantile', str(quantile)))} {_format_value(recent.percentile(quantile * 100))}")
+        total = histogram.window(None)
+        lines.append(f"{name}_sum{_format_labels(label_set)} {_format_value(total.total)}")
+        lines.append(f"{name}_count{_format_labels(label_set)} {total.count}")
+
+
+metrics = Metrics()
+
+
+class RateLimitCounter(logging.Handler):
+    """Counts the 429s discord.py reports. discord.py handles the retries itself and only surfaces them as log warnings."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def emit(self, record: logging.LogRecord):
+        message = record.msg if isinstance(record.msg, str) else ""
+        if message.startswith("We are being rate limited"):
+            metrics.inc("discord_rate_limited_total", scope="route")
+        elif message.startswith("Global rate limit has been hit"):
+            metrics.inc("discord_rate_limited_total", scope="global")
+
+
+class MetricsServer:
+    """Serves the metrics on /metrics. Runs on the bots event loop, rendering is cheap enough not to need an executor."""
+
+    def __init__(self):
+        self.runner: Optional[web.AppRunner] = None
+
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        log.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+def executor_queue_depth(loop: asyncio.AbstractEventLoop) -> Optional[int]:
+    """Jobs waiting for a thread in the loops default executor. None if the executor hasn't been created yet."""
+    executor = getattr(loop, '_default_executor', None)
+    work_queue = getattr(executor, '_work_queue', None)
+    return work_queue.qsize() if work_queue is not None else None
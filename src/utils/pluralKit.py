@@ -7,11 +7,15 @@ API Endpoint functions include:
 Part of the Gabby Gums Discord Logger.
 """
 
+import time
 import logging
 from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple, NamedTuple
 
 import aiohttp
 
+from utils import tracing
+from utils.metrics import metrics
+
 log = logging.getLogger(__name__)
 
 
@@ -27,47 +31,64 @@ class UnknownPKError(Exception):
     pass
 
 
+def record_request(endpoint: str, result: str, start: float):
+    duration = (time.perf_counter() - start) * 1000
+    metrics.inc("pk_api_requests_total", endpoint=endpoint, result=result)
+    metrics.observe("pk_api_latency_ms", duration, endpoint=endpoint)
+    tracing.add_stage("pk_lookup", start, duration)
+
+
 async def get_pk_system_from_userid(user_id: int) -> Optional[Dict]:
     """Gets a PK system from the PluralKit API using a Discord UserID"""
+    start = time.perf_counter()
     try:
         async with aiohttp.ClientSession() as session:
             async with session.get(f'https://api.pluralkit.me/v1/a/{user_id}') as r:
                 if r.status == 200:  # We received a valid response from the PK API.
-                    logging.debug(f"User has an associated PK Account linked to their Discord Account.")
+                    log.debug(f"User has an associated PK Account linked to their Discord Account.")
 
                     # Convert the JSON response to a dict
                     pk_response = await r.json()
-                    logging.debug(f"Got system: {pk_response}")
+                    log.debug(f"Got system: {pk_response}")
 
+                    record_request("a", "found", start)
                     return pk_response
                 elif r.status == 404:
                     # No PK Account found.
                     log.debug("No PK Account found.")
+                    record_request("a", "not_found", start)
                     return None
                 else:
+                    record_request("a", "error", start)
                     raise UnknownPKError(f"Received Status Code: {r.status} ({r.reason}) for /a/{user_id}")
 
     except aiohttp.ClientError as e:
+        record_request("a", "connection_error", start)
         raise CouldNotConnectToPKAPI  # Really not strictly necessary, but it makes the code a bit nicer I think.
 
 
 async def get_pk_message(message_id: int) -> Optional[Dict]:
     """Attempts to retrieve details on a proxied/pre-proxied message"""
+    start = time.perf_counter()
     try:
         async with aiohttp.ClientSession() as session:
             async with session.get('https://api.pluralkit.me/v1/msg/{}'.format(message_id)) as r:
                 if r.status == 200:  # We received a valid response from the PK API. The message is probably a pre-proxied message.
-                    logging.debug(f"Message {message_id} is still on the PK api.")
+                    log.debug(f"Message {message_id} is still on the PK api.")
                     # Convert the JSON response to a dict, Cache the details of the proxied message, and then bail.
                     pk_response = await r.json()
+                    record_request("msg", "found", start)
                     return pk_response
                 elif r.status == 404:
                     # msg was not a proxied message
+                    record_request("msg", "not_found", start)
                     return None
                 else:
+                    record_request("msg", "error", start)
                     raise UnknownPKError(f"Received Status Code: {r.status} ({r.reason}) for /msg/{message_id}")
 
     except aiohttp.ClientError as e:
+        record_request("msg", "connection_error", start)
         raise CouldNotConnectToPKAPI
 
 
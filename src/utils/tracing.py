@@ -0,0 +1,116 @@
+"""
+Lightweight per event tracing.
+Every dispatched event handler runs inside a Trace (started by GGBot._run_event) and the code it calls marks the stages it goes through
+(cache fetch, PK lookup, routing, embed/archive build, send) with `stage()`. The active trace is found through a context variable,
+so nothing needs to be passed down and stages outside of a trace cost next to nothing.
+Stage timings are exported as metrics, and traces slower than the threshold are kept in a ring buffer for g!slow_traces.
+
+Part of the Gabby Gums Discord Logger.
+"""
+
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional, Dict, List, Tuple, Deque
+
+from utils.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+SLOW_TRACE_MS = 2000  # Traces that take longer than this are kept. Can be overridden in the config with slow_trace_ms.
+SLOW_TRACE_BUFFER = 50  # Number of slow traces to keep.
+
+
+class Trace:
+
+    def __init__(self, name: str, tags: Dict[str, str]):
+        self.name = name
+        self.tags = tags
+        self.started_at = datetime.utcnow()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None  # ms. Set once finished.
+        self.stages: List[Tuple[str, float, float]] = []  # (Stage, Offset from the start of the trace in ms, Duration in ms)
+
+    def add_stage(self, name: str, start: float, duration: float):
+        self.stages.append((name, (start - self.start) * 1000, duration))
+
+    def finish(self):
+        self.duration = (time.perf_counter() - self.start) * 1000
+
+    def format(self) -> str:
+        tags = " ".join(f"{key}={value}" for key, value in self.tags.items())
+        lines = [f"{self.started_at:%Y-%m-%d %H:%M:%S} {self.name} {self.duration:.1f} ms {tags}".rstrip()]
+        for name, offset, duration in self.stages:
+            lines.append(f"  +{offset:8.1f} ms  {name:<16} {duration:8.1f} ms")
+        return "\n".join(lines)
+
+
+class Tracer:
+
+    def __init__(self):
+        self.slow_threshold = SLOW_TRACE_MS
+        self.slow_traces: Deque[Trace] = deque(maxlen=SLOW_TRACE_BUFFER)
+        self.finished = 0
+        self.slow = 0
+
+
+    def configure(self, slow_threshold: float):
+        self.slow_threshold = slow_threshold
+
+
+    def record(self, trace: Trace):
+        self.finished += 1
+        for name, _, duration in trace.stages:
+            metrics.observe("event_stage_latency_ms", duration, event=trace.name, stage=name)
+        if trace.duration >= self.slow_threshold:
+            self.slow += 1
+            self.slow_traces.append(trace)
+
+
+tracer = Tracer()
+current_trace: 'ContextVar[Optional[Trace]]' = ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def trace(name: str, **tags):
+    """Runs the block as a new trace. Any trace that was already active is restored afterwards."""
+    new_trace = Trace(name, {key: str(value) for key, value in tags.items()})
+    token = current_trace.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        current_trace.reset(token)
+        new_trace.finish()
+        tracer.record(new_trace)
+
+
+@contextmanager
+def stage(name: str):
+    """Times the block as a stage of the active trace. Does nothing if there isn't one."""
+    active_trace = current_trace.get()
+    if active_trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        active_trace.add_stage(name, start, (time.perf_counter() - start) * 1000)
+
+
+def add_stage(name: str, start: float, duration: float):
+    """Adds a stage that was timed separately. start is a time.perf_counter() value and duration is in ms."""
+    active_trace = current_trace.get()
+    if active_trace is not None:
+        active_trace.add_stage(name, start, duration)
+
+
+def tag(**tags):
+    """Adds tags (e.g. the guild ID) to the active trace."""
+    active_trace = current_trace.get()
+    if active_trace is not None:
+        active_trace.tags.update({key: str(value) for key, value in tags.items()})